@@ -3,31 +3,109 @@ from tkinter import ttk, messagebox, filedialog
 import sqlite3
 import pandas as pd
 import datetime
+import logging
 import os
 from datetime import datetime as dt
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import seaborn as sns
 import warnings
+from costing import CostingEngine
+from data_io import EXPORT_TABLES, export_tables
+from db_targets import is_read_only, target_from_env
+from diagnostics import MainLoopWatchdog, ProfileCapture, QueryStatsWindow, WatchdogWindow
+from erp_logging import parse_levels, start_logging, swallowed, swallowed_errors
+from erp_schema import ERP_SCHEMA, check_migrated
+from forecasting import DemandForecaster
+from profit_loss import ProfitAndLoss
+from query_stats import QueryStats, connect
+from report_cache import ReportCache
+from replenishment import DRAFT_STATUS, ReplenishmentEngine
+from report_engine import ReportEngine, TreeviewOutput, reports_for
+from rollups import RollupStore
+from sales import SalesLedger
+from stock_levels import LOW_STOCK, OUT_OF_STOCK, STATUS_LABELS, StockLevels
+from tracing import Tracer
 warnings.filterwarnings('ignore')
 
+dashboard_log = logging.getLogger('erp.dashboard')
+forecast_log = logging.getLogger('erp.forecast')
+
+# Delay before the startup forecast refit, once the window has been drawn
+FORECAST_DELAY_MS = 2000
+
 class ERPSystem:
     def __init__(self, root):
         self.root = root
         self.root.title("Integrated ERP System")
         self.root.geometry("1400x800")
         
+        # JSON logs are written on a listener thread, ERP_LOG_LEVELS sets levels per subsystem
+        self.log_session = start_logging(os.environ.get('ERP_LOG_FILE', os.path.join('logs', 'erp_system_english.log')),
+                                         parse_levels(os.environ.get('ERP_LOG_LEVELS')))
+        
+        # Action timings for the node-exporter textfile collector, JSON lines for a .jsonl path
+        self.tracer = Tracer(os.environ.get('ERP_METRICS_FILE', 'erp_system_english_metrics.prom'))
+        self.tracer.add_counters('erp_swallowed_errors_total', "Errors handled by falling back to a default",
+                                 swallowed_errors.snapshot)
+        self.tracer.start()
+        
         # Create database
         self.create_database()
         
+        # Watch the main loop for stalls, started before any callback is registered
+        self.watchdog = MainLoopWatchdog(self.root, log_path='erp_system_english_stalls.jsonl').start()
+        self.capture = ProfileCapture()
+        
         # Create user interface
         self.setup_ui()
         
     def create_database(self):
-        """Create database and tables"""
-        self.conn = sqlite3.connect('erp_system_english.db')
+        """Open the database and set up its services"""
+        # Statements are timed for the diagnostics window, slow ones are logged with their plan
+        self.query_stats = QueryStats(log_path='erp_system_english_slow_queries.jsonl')
+        # $ERP_DATABASE_MODE opens the file read-only for reporting, or works in memory
+        path, self.db_mode = target_from_env('erp_system_english.db')
+        self.conn = connect(path, self.query_stats, self.db_mode)
+        self.read_only = is_read_only(self.db_mode)
+        if self.read_only:
+            self.root.title(self.root.title() + " (read-only)")
         self.cursor = self.conn.cursor()
         
+        # Daily sales and purchases rollups used by period reports
+        self.rollups = RollupStore(self.conn, ERP_SCHEMA)
+        
+        # Maintained stock balances and low stock alerts
+        self.stock_levels = StockLevels(self.conn, ERP_SCHEMA)
+        
+        # Cost layers and maintained inventory valuation
+        self.costing = CostingEngine(self.conn, ERP_SCHEMA)
+        
+        # Demand forecasts, refitted over the days since the last run
+        self.forecaster = DemandForecaster(self.conn)
+        
+        # Reorder point calculation and draft purchase invoices
+        self.replenishment = ReplenishmentEngine(self.conn)
+        
+        # Profit and loss read from the sales rollups and expenses
+        self.profit_loss = ProfitAndLoss(self.conn)
+        
+        # Invoice saving shared with the API
+        self.sales = SalesLedger(self.conn, ERP_SCHEMA, self.stock_levels, self.costing, self.rollups)
+        
+        if not self.read_only:
+            self.create_tables()
+            return
+        
+        # Every upkeep step writes, so a read-only database must have been migrated already
+        try:
+            check_migrated(self.conn, ERP_SCHEMA)
+        except ValueError as e:
+            messagebox.showerror("Read-only Database", f"Cannot open {path}:\n{e}")
+            raise SystemExit(1)
+    
+    def create_tables(self):
+        """Create tables and bring the derived tables up to date"""
         # Customers table
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS customers (
@@ -101,6 +179,7 @@ class ERPSystem:
                 quantity INTEGER,
                 price REAL,
                 total REAL,
+                unit_cost REAL,
                 FOREIGN KEY (invoice_number) REFERENCES sales(invoice_number),
                 FOREIGN KEY (product_code) REFERENCES products(product_code)
             )
@@ -136,6 +215,24 @@ class ERPSystem:
         
         self.conn.commit()
         
+        self.rollups.create_tables()
+        self.stock_levels.create_tables()
+        self.costing.create_tables()
+        if self.costing.backfill_sales_costs():
+            self.rollups.rebuild()
+        self.forecaster.create_tables()
+        # Refitting can take a while after backdated sales, so it waits until the window is up
+        self.root.after(FORECAST_DELAY_MS, self.refit_forecasts)
+        self.replenishment.create_tables()
+        self.profit_loss.create_indexes()
+    
+    def refit_forecasts(self):
+        """Bring the demand forecasts up to yesterday"""
+        try:
+            self.forecaster.fit()
+        except Exception:
+            swallowed(forecast_log, "Could not refit the demand forecasts")
+    
     def setup_ui(self):
         """Create main user interface"""
         # Create menu bar
@@ -157,6 +254,19 @@ class ERPSystem:
         reports_menu.add_command(label="Customers Report", command=self.show_customers_report)
         reports_menu.add_command(label="Suppliers Report", command=self.show_suppliers_report)
         
+        # Diagnostics menu
+        diagnostics_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Diagnostics", menu=diagnostics_menu)
+        diagnostics_menu.add_command(label="Query Statistics", command=self.show_query_stats)
+        diagnostics_menu.add_command(label="Responsiveness", command=self.show_responsiveness)
+        diagnostics_menu.add_separator()
+        self.profiling_var = tk.BooleanVar(value=False)
+        diagnostics_menu.add_checkbutton(label="Profile CPU (cProfile)", variable=self.profiling_var,
+                                         command=self.toggle_profiling)
+        self.memory_tracking_var = tk.BooleanVar(value=False)
+        diagnostics_menu.add_checkbutton(label="Track Memory (tracemalloc)", variable=self.memory_tracking_var,
+                                         command=self.toggle_memory_tracking)
+        
         # Create Notebook (tabs)
         self.notebook = ttk.Notebook(self.root)
         self.notebook.pack(fill='both', expand=True, padx=10, pady=10)
@@ -645,6 +755,7 @@ class ERPSystem:
         ttk.Button(buttons_frame, text="Save Invoice", command=self.save_purchases_invoice).pack(side='left', padx=5)
         ttk.Button(buttons_frame, text="New Invoice", command=self.clear_purchases_form).pack(side='left', padx=5)
         ttk.Button(buttons_frame, text="Delete Item", command=self.delete_purchases_item).pack(side='left', padx=5)
+        ttk.Button(buttons_frame, text="Suggest Orders", command=self.suggest_orders).pack(side='left', padx=5)
     
     def create_inventory_tab(self):
         """Create inventory tab"""
@@ -701,13 +812,7 @@ class ERPSystem:
         ttk.Label(selection_frame, text="Report Type:").grid(row=0, column=0, padx=10, pady=5, sticky='e')
         
         self.report_type = tk.StringVar()
-        reports = [
-            ("Daily Sales", "sales_daily"),
-            ("Monthly Sales", "sales_monthly"),
-            ("Top Customers", "top_customers"),
-            ("Low Stock", "low_stock"),
-            ("Out of Stock", "out_of_stock")
-        ]
+        reports = [(report.title, report.report_id) for report in reports_for(ERP_SCHEMA)]
         
         report_combo = ttk.Combobox(selection_frame, textvariable=self.report_type, width=30, state='readonly')
         report_combo['values'] = [name for name, _ in reports]
@@ -717,6 +822,29 @@ class ERPSystem:
         ttk.Button(selection_frame, text="Generate Report", command=self.generate_report).grid(row=0, column=2, padx=10, pady=5)
         ttk.Button(selection_frame, text="Export", command=self.export_report).grid(row=0, column=3, padx=10, pady=5)
         
+        # Report parameters
+        ttk.Label(selection_frame, text="From:").grid(row=1, column=0, padx=10, pady=5, sticky='e')
+        self.report_from_entry = ttk.Entry(selection_frame, width=15)
+        self.report_from_entry.grid(row=1, column=1, padx=10, pady=5, sticky='w')
+        
+        ttk.Label(selection_frame, text="To:").grid(row=1, column=2, padx=10, pady=5, sticky='e')
+        self.report_to_entry = ttk.Entry(selection_frame, width=15)
+        self.report_to_entry.grid(row=1, column=3, padx=10, pady=5, sticky='w')
+        
+        ttk.Label(selection_frame, text="Customer:").grid(row=2, column=0, padx=10, pady=5, sticky='e')
+        self.report_customer_combo = ttk.Combobox(selection_frame, width=30)
+        self.report_customer_combo.grid(row=2, column=1, padx=10, pady=5)
+        
+        ttk.Label(selection_frame, text="Product:").grid(row=2, column=2, padx=10, pady=5, sticky='e')
+        self.report_product_combo = ttk.Combobox(selection_frame, width=30)
+        self.report_product_combo.grid(row=2, column=3, padx=10, pady=5)
+        
+        ttk.Label(selection_frame, text="Status:").grid(row=2, column=4, padx=10, pady=5, sticky='e')
+        self.report_status_combo = ttk.Combobox(selection_frame, width=10, values=['', 'open', 'closed'])
+        self.report_status_combo.grid(row=2, column=5, padx=10, pady=5)
+        
+        self.load_report_filter_combos()
+        
         # Report display frame
         display_frame = ttk.LabelFrame(self.reports_tab, text="Report Results")
         display_frame.pack(fill='both', expand=True, padx=10, pady=10)
@@ -731,6 +859,8 @@ class ERPSystem:
         )
         self.report_tree.pack(fill='both', expand=True)
         scrollbar.config(command=self.report_tree.yview)
+        
+        self.report_engine = ReportEngine(self.conn, ERP_SCHEMA, cache=ReportCache(), read_only=self.read_only)
     
     # ===== Customer Functions =====
     
@@ -754,6 +884,7 @@ class ERPSystem:
             self.clear_customer_fields()
             self.load_customers()
             self.load_customers_combo()
+            self.load_report_filter_combos()
             
         except sqlite3.IntegrityError:
             messagebox.showerror("Error", "This customer code already exists")
@@ -966,14 +1097,17 @@ class ERPSystem:
             ''', (data['product_code'], data['product_name'], data['unit_of_measure'],
                   float(data['purchase_price'] or 0), float(data['sale_price'] or 0),
                   int(data['minimum_limit'] or 10)))
+            stock_changes = self.stock_levels.evaluate(self.cursor, [data['product_code']])
             
             self.conn.commit()
+            self.stock_levels.notify(stock_changes)
             messagebox.showinfo("Success", "Product added successfully")
             self.clear_product_fields()
             self.load_products()
             self.load_products_combo()
             self.load_products_combo_purchases()
             self.load_products_combo_inventory()
+            self.load_report_filter_combos()
             
         except sqlite3.IntegrityError:
             messagebox.showerror("Error", "This product code already exists")
@@ -1002,8 +1136,11 @@ class ERPSystem:
             ''', (data['product_name'], data['unit_of_measure'],
                   float(data['purchase_price'] or 0), float(data['sale_price'] or 0),
                   int(data['minimum_limit'] or 10), data['product_code']))
+            # Minimum limit may have changed
+            stock_changes = self.stock_levels.evaluate(self.cursor, [data['product_code']])
             
             self.conn.commit()
+            self.stock_levels.notify(stock_changes)
             messagebox.showinfo("Success", "Product updated successfully")
             self.clear_product_fields()
             self.load_products()
@@ -1026,7 +1163,9 @@ class ERPSystem:
             product_code = self.products_tree.item(selected[0])['values'][0]
             
             self.cursor.execute("DELETE FROM products WHERE product_code=?", (product_code,))
+            stock_changes = self.stock_levels.evaluate(self.cursor, [product_code])
             self.conn.commit()
+            self.stock_levels.notify(stock_changes)
             
             messagebox.showinfo("Success", "Product deleted successfully")
             self.clear_product_fields()
@@ -1154,43 +1293,30 @@ class ERPSystem:
                 return
             
             customer_code = customer.split(' - ')[0]
-            total = float(self.sales_total_label.cget('text'))
             discount = float(self.sales_discount_entry.get() or 0)
-            net = total - discount
-            
-            # Save invoice header
-            self.cursor.execute('''
-                INSERT INTO sales (invoice_number, invoice_date, customer_code, 
-                                 total_invoice, discount, net_invoice, invoice_status)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (invoice_number, invoice_date, customer_code, total, discount, net, 'open'))
             
-            # Save invoice items
+            lines = []
             for item in self.sales_items_tree.get_children():
                 values = self.sales_items_tree.item(item)['values']
-                product_code = values[0]
-                quantity = int(values[2])
-                price = float(values[3])
-                item_total = float(values[4])
-                
-                self.cursor.execute('''
-                    INSERT INTO sales_details (invoice_number, product_code, quantity, price, total)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (invoice_number, product_code, quantity, price, item_total))
-                
-                # Update inventory
-                self.cursor.execute('''
-                    INSERT INTO inventory (product_code, movement, quantity, reference)
-                    VALUES (?, ?, ?, ?)
-                ''', (product_code, 'out', quantity, invoice_number))
-            
-            self.conn.commit()
+                lines.append((values[0], int(values[2]), float(values[3])))
+            
+            # Header, lines, stock movements, costs and rollups in one transaction
+            with self.tracer.span('sale'):
+                with self.tracer.span('database'):
+                    _, stock_changes = self.sales.save_invoice(
+                        self.cursor, invoice_number, customer_code, lines, discount, invoice_date)
+                    
+                    self.conn.commit()
+                self.stock_levels.notify(stock_changes)
             messagebox.showinfo("Success", "Sales invoice saved successfully")
-            self.clear_sales_form()
-            
+            with self.tracer.span('sale/clear_form'):
+                self.clear_sales_form()
+        
         except sqlite3.IntegrityError:
+            self.conn.rollback()
             messagebox.showerror("Error", "This invoice number already exists")
         except Exception as e:
+            self.conn.rollback()
             messagebox.showerror("Error", f"An error occurred: {str(e)}")
     
     def clear_sales_form(self):
@@ -1306,39 +1432,54 @@ class ERPSystem:
             discount = float(self.purchases_discount_entry.get() or 0)
             net = total - discount
             
-            # Save invoice header
-            self.cursor.execute('''
-                INSERT INTO purchases (invoice_number, invoice_date, supplier_code, 
-                                     total_invoice, discount, net_invoice, invoice_status)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (invoice_number, invoice_date, supplier_code, total, discount, net, 'open'))
-            
-            # Save invoice items
-            for item in self.purchases_items_tree.get_children():
-                values = self.purchases_items_tree.item(item)['values']
-                product_code = values[0]
-                quantity = int(values[2])
-                price = float(values[3])
-                item_total = float(values[4])
+            with self.tracer.span('purchase'):
+                with self.tracer.span('lines'):
+                    # Save invoice header
+                    self.cursor.execute('''
+                        INSERT INTO purchases (invoice_number, invoice_date, supplier_code, 
+                                             total_invoice, discount, net_invoice, invoice_status)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', (invoice_number, invoice_date, supplier_code, total, discount, net, 'open'))
+            
+                    # Save invoice items
+                    movements = []
+                    for item in self.purchases_items_tree.get_children():
+                        values = self.purchases_items_tree.item(item)['values']
+                        product_code = values[0]
+                        quantity = int(values[2])
+                        price = float(values[3])
+                        item_total = float(values[4])
                 
-                self.cursor.execute('''
-                    INSERT INTO purchase_details (invoice_number, product_code, quantity, price, total)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (invoice_number, product_code, quantity, price, item_total))
+                        self.cursor.execute('''
+                            INSERT INTO purchase_details (invoice_number, product_code, quantity, price, total)
+                            VALUES (?, ?, ?, ?, ?)
+                        ''', (invoice_number, product_code, quantity, price, item_total))
                 
-                # Update inventory
-                self.cursor.execute('''
-                    INSERT INTO inventory (product_code, movement, quantity, reference)
-                    VALUES (?, ?, ?, ?)
-                ''', (product_code, 'in', quantity, invoice_number))
-            
-            self.conn.commit()
+                        # Update inventory
+                        self.cursor.execute('''
+                            INSERT INTO inventory (product_code, movement, quantity, reference)
+                            VALUES (?, ?, ?, ?)
+                        ''', (product_code, 'in', quantity, invoice_number))
+                        movements.append((product_code, 'in', quantity))
+                        self.costing.receive(self.cursor, product_code, quantity, price, invoice_number)
+                
+                with self.tracer.span('rollups'):
+                    self.rollups.add_purchase_invoice(self.cursor, invoice_number)
+                with self.tracer.span('stock_levels'):
+                    stock_changes = self.stock_levels.apply_movements(self.cursor, movements)
+            
+                with self.tracer.span('commit'):
+                    self.conn.commit()
+                self.stock_levels.notify(stock_changes)
             messagebox.showinfo("Success", "Purchase invoice saved successfully")
-            self.clear_purchases_form()
-            
+            with self.tracer.span('purchase/clear_form'):
+                self.clear_purchases_form()
+        
         except sqlite3.IntegrityError:
+            self.conn.rollback()
             messagebox.showerror("Error", "This invoice number already exists")
         except Exception as e:
+            self.conn.rollback()
             messagebox.showerror("Error", f"An error occurred: {str(e)}")
     
     def clear_purchases_form(self):
@@ -1361,6 +1502,23 @@ class ERPSystem:
     
     # ===== Inventory Functions =====
     
+    def suggest_orders(self):
+        """Recalculate reorder points and write draft purchase invoices"""
+        try:
+            self.forecaster.fit()
+            result = self.replenishment.run(write_drafts=True)
+            
+            message = f"{result['to_order']} of {result['products']} products need ordering.\n"
+            message += f"{len(result['invoices'])} draft purchase invoices created"
+            for invoice_number, supplier_code, lines, total in result['invoices']:
+                message += f"\n{invoice_number} - {supplier_code}: {lines} items, {total:.2f}"
+            if result['unassigned']:
+                message += f"\n\n{result['unassigned']} products have no purchase history to pick a supplier from"
+            messagebox.showinfo("Reorder Suggestions", message)
+            
+        except Exception as e:
+            messagebox.showerror("Error", f"Error calculating reorder suggestions: {str(e)}")
+    
     def load_products_combo_inventory(self):
         """Load products into inventory combo box"""
         self.cursor.execute("SELECT product_code, product_name FROM products ORDER BY product_name")
@@ -1384,19 +1542,18 @@ class ERPSystem:
                 p.product_code,
                 p.product_name,
                 p.unit_of_measure,
-                COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'), 0) as in_quantity,
-                COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'), 0) as out_quantity,
-                (COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'), 0) -
-                 COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'), 0)) as balance,
+                COALESCE(b.qty_in, 0) as in_quantity,
+                COALESCE(b.qty_out, 0) as out_quantity,
+                COALESCE(b.balance, 0) as balance,
                 p.minimum_limit,
-                CASE 
-                    WHEN (COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'), 0) -
-                          COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'), 0)) <= 0 THEN 'Out of Stock'
-                    WHEN (COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'), 0) -
-                          COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'), 0)) < p.minimum_limit THEN 'Low'
+                CASE a.status
+                    WHEN 'out' THEN 'Out of Stock'
+                    WHEN 'low' THEN 'Low'
                     ELSE 'Normal'
                 END as status
             FROM products p
+            LEFT JOIN stock_balances b ON b.product_key = p.product_code
+            LEFT JOIN stock_alerts a ON a.product_key = p.product_code
             WHERE p.product_code = ?
         ''', (product_code,))
         
@@ -1414,19 +1571,18 @@ class ERPSystem:
                 p.product_code,
                 p.product_name,
                 p.unit_of_measure,
-                COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'), 0) as in_quantity,
-                COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'), 0) as out_quantity,
-                (COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'), 0) -
-                 COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'), 0)) as balance,
+                COALESCE(b.qty_in, 0) as in_quantity,
+                COALESCE(b.qty_out, 0) as out_quantity,
+                COALESCE(b.balance, 0) as balance,
                 p.minimum_limit,
-                CASE 
-                    WHEN (COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'), 0) -
-                          COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'), 0)) <= 0 THEN 'Out of Stock'
-                    WHEN (COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'), 0) -
-                          COALESCE((SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'), 0)) < p.minimum_limit THEN 'Low'
+                CASE a.status
+                    WHEN 'out' THEN 'Out of Stock'
+                    WHEN 'low' THEN 'Low'
                     ELSE 'Normal'
                 END as status
             FROM products p
+            LEFT JOIN stock_balances b ON b.product_key = p.product_code
+            LEFT JOIN stock_alerts a ON a.product_key = p.product_code
             ORDER BY p.product_code
         ''')
         
@@ -1436,214 +1592,32 @@ class ERPSystem:
     
     # ===== Reports Functions =====
     
+    def load_report_filter_combos(self):
+        """Load customers and products into report filter combo boxes"""
+        self.cursor.execute("SELECT customer_code, customer_name FROM customers ORDER BY customer_name")
+        self.report_customer_combo['values'] = [''] + [f"{code} - {name}" for code, name in self.cursor.fetchall()]
+        self.cursor.execute("SELECT product_code, product_name FROM products ORDER BY product_name")
+        self.report_product_combo['values'] = [''] + [f"{code} - {name}" for code, name in self.cursor.fetchall()]
+    
+    def get_report_params(self):
+        """Read report parameters from the filter fields"""
+        return {
+            'date_from': self.report_from_entry.get().strip(),
+            'date_to': self.report_to_entry.get().strip(),
+            'customer': self.report_customer_combo.get().split(' - ')[0].strip(),
+            'product': self.report_product_combo.get().split(' - ')[0].strip(),
+            'status': self.report_status_combo.get().strip(),
+        }
+    
     def generate_report(self):
         """Generate selected report"""
-        # Clear previous report
-        for item in self.report_tree.get_children():
-            self.report_tree.delete(item)
-        
-        report_type = self.report_type.get()
-        
-        if report_type == 'Daily Sales':
-            self.generate_daily_sales_report()
-        elif report_type == 'Monthly Sales':
-            self.generate_monthly_sales_report()
-        elif report_type == 'Top Customers':
-            self.generate_top_customers_report()
-        elif report_type == 'Low Stock':
-            self.generate_low_stock_report()
-        elif report_type == 'Out of Stock':
-            self.generate_out_of_stock_report()
-    
-    def generate_daily_sales_report(self):
-        """Generate daily sales report"""
-        self.cursor.execute('''
-            SELECT 
-                s.invoice_number,
-                s.invoice_date,
-                c.customer_name,
-                s.total_invoice,
-                s.discount,
-                s.net_invoice,
-                s.invoice_status
-            FROM sales s
-            JOIN customers c ON s.customer_code = c.customer_code
-            WHERE DATE(s.invoice_date) = DATE('now')
-            ORDER BY s.invoice_number DESC
-        ''')
-        
-        report_data = self.cursor.fetchall()
-        
-        # Setup report columns
-        columns = ("Invoice Number", "Date", "Customer", "Total", "Discount", "Net Total", "Status")
-        self.report_tree['columns'] = columns
-        
-        for col in columns:
-            self.report_tree.heading(col, text=col)
-            self.report_tree.column(col, width=120)
-        
-        # Fill data
-        for row in report_data:
-            self.report_tree.insert('', 'end', values=row)
-    
-    def generate_monthly_sales_report(self):
-        """Generate monthly sales report"""
-        self.cursor.execute('''
-            SELECT 
-                strftime('%Y-%m', s.invoice_date) as month,
-                COUNT(*) as invoice_count,
-                SUM(s.total_invoice) as total,
-                SUM(s.discount) as discount,
-                SUM(s.net_invoice) as net_total
-            FROM sales s
-            GROUP BY strftime('%Y-%m', s.invoice_date)
-            ORDER BY month DESC
-        ''')
-        
-        report_data = self.cursor.fetchall()
-        
-        # Setup report columns
-        columns = ("Month", "Invoice Count", "Total", "Discount", "Net Total")
-        self.report_tree['columns'] = columns
-        
-        for col in columns:
-            self.report_tree.heading(col, text=col)
-            self.report_tree.column(col, width=150)
-        
-        # Fill data
-        for row in report_data:
-            self.report_tree.insert('', 'end', values=row)
-    
-    def generate_top_customers_report(self):
-        """Generate top customers report"""
-        self.cursor.execute('''
-            SELECT 
-                c.customer_name,
-                COUNT(s.invoice_number) as invoice_count,
-                SUM(s.net_invoice) as total_purchases
-            FROM customers c
-            LEFT JOIN sales s ON c.customer_code = s.customer_code
-            GROUP BY c.customer_code
-            HAVING total_purchases > 0
-            ORDER BY total_purchases DESC
-            LIMIT 20
-        ''')
-        
-        report_data = self.cursor.fetchall()
-        
-        # Setup report columns
-        columns = ("Customer Name", "Invoice Count", "Total Purchases")
-        self.report_tree['columns'] = columns
-        
-        for col in columns:
-            self.report_tree.heading(col, text=col)
-            self.report_tree.column(col, width=200)
-        
-        # Fill data
-        for row in report_data:
-            self.report_tree.insert('', 'end', values=row)
-    
-    def generate_low_stock_report(self):
-        """Generate low stock report"""
-        self.cursor.execute('''
-            SELECT 
-                p.product_name,
-                (COALESCE((
-                    SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-                ), 0) -
-                COALESCE((
-                    SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-                ), 0)) as balance,
-                p.minimum_limit,
-                CASE 
-                    WHEN (COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-                    ), 0) -
-                    COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-                    ), 0)) <= 0 THEN 'Out of Stock'
-                    WHEN (COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-                    ), 0) -
-                    COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-                    ), 0)) < p.minimum_limit THEN 'Low'
-                    ELSE 'Normal'
-                END as status
-            FROM products p
-            WHERE (COALESCE((
-                SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-            ), 0) -
-            COALESCE((
-                SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-            ), 0)) < p.minimum_limit
-            ORDER BY balance ASC
-        ''')
-        
-        report_data = self.cursor.fetchall()
-        
-        # Setup report columns
-        columns = ("Product Name", "Current Balance", "Minimum Limit", "Status")
-        self.report_tree['columns'] = columns
-        
-        for col in columns:
-            self.report_tree.heading(col, text=col)
-            self.report_tree.column(col, width=150)
-        
-        # Fill data
-        for row in report_data:
-            self.report_tree.insert('', 'end', values=row)
-    
-    def generate_out_of_stock_report(self):
-        """Generate out of stock report"""
-        self.cursor.execute('''
-            SELECT 
-                p.product_name,
-                (COALESCE((
-                    SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-                ), 0) -
-                COALESCE((
-                    SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-                ), 0)) as balance,
-                p.minimum_limit,
-                CASE 
-                    WHEN (COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-                    ), 0) -
-                    COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-                    ), 0)) <= 0 THEN 'Out of Stock'
-                    WHEN (COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-                    ), 0) -
-                    COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-                    ), 0)) < p.minimum_limit THEN 'Low'
-                    ELSE 'Normal'
-                END as status
-            FROM products p
-            WHERE (COALESCE((
-                SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-            ), 0) -
-            COALESCE((
-                SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-            ), 0)) < p.minimum_limit
-            ORDER BY balance ASC
-        ''')
-        
-        report_data = self.cursor.fetchall()
-        
-        # Setup report columns
-        columns = ("Product Name", "Current Balance", "Minimum Limit", "Status")
-        self.report_tree['columns'] = columns
-        
-        for col in columns:
-            self.report_tree.heading(col, text=col)
-            self.report_tree.column(col, width=150)
-        
-        # Fill data
-        for row in report_data:
-            self.report_tree.insert('', 'end', values=row)
+        try:
+            report = self.report_engine.find_by_title(self.report_type.get())
+            with self.tracer.span(f"report/{report.report_id}"):
+                self.report_engine.run(report.report_id, TreeviewOutput(self.report_tree),
+                                       self.get_report_params())
+        except Exception as e:
+            messagebox.showerror("Error", f"Error generating report: {str(e)}")
     
     # ===== Dashboard Functions =====
     
@@ -1653,26 +1627,30 @@ class ERPSystem:
             self.cursor.execute("SELECT SUM(net_invoice) FROM sales WHERE DATE(invoice_date) = DATE('now')")
             result = self.cursor.fetchone()[0]
             return f"{result or 0:.2f}"
-        except:
+        except Exception:
+            swallowed(dashboard_log, "Could not read today's sales")
             return "0.00"
     
     def get_total_purchases(self):
         """Get total purchases"""
         try:
-            self.cursor.execute("SELECT SUM(net_invoice) FROM purchases WHERE DATE(invoice_date) = DATE('now')")
+            self.cursor.execute(
+                "SELECT SUM(net_invoice) FROM purchases WHERE DATE(invoice_date) = DATE('now') AND invoice_status != ?",
+                (DRAFT_STATUS,))
             result = self.cursor.fetchone()[0]
             return f"{result or 0:.2f}"
-        except:
+        except Exception:
+            swallowed(dashboard_log, "Could not read today's purchases")
             return "0.00"
     
     def get_net_profit(self):
-        """Get net profit"""
+        """Get today's net profit after cost of goods sold and expenses"""
         try:
-            sales = float(self.get_total_sales())
-            purchases = float(self.get_total_purchases())
-            profit = sales - purchases
+            today = datetime.date.today()
+            profit = self.profit_loss.statement(today, today)['net_profit']
             return f"{profit:.2f}"
-        except:
+        except sqlite3.Error:
+            swallowed(dashboard_log, "Could not compute today's net profit")
             return "0.00"
     
     def get_customers_count(self):
@@ -1680,7 +1658,8 @@ class ERPSystem:
         try:
             self.cursor.execute("SELECT COUNT(*) FROM customers")
             return self.cursor.fetchone()[0]
-        except:
+        except Exception:
+            swallowed(dashboard_log, "Could not count customers")
             return "0"
     
     def get_products_count(self):
@@ -1688,35 +1667,34 @@ class ERPSystem:
         try:
             self.cursor.execute("SELECT COUNT(*) FROM products")
             return self.cursor.fetchone()[0]
-        except:
+        except Exception:
+            swallowed(dashboard_log, "Could not count products")
             return "0"
     
     def get_inventory_value(self):
         """Get inventory value"""
         try:
-            self.cursor.execute('''
-                SELECT SUM(
-                    (COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-                    ), 0) -
-                    COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-                    ), 0)) * p.purchase_price
-                )
-                FROM products p
-            ''')
-            result = self.cursor.fetchone()[0]
-            return f"{result or 0:.2f}"
-        except:
+            return f"{self.costing.inventory_value():.2f}"
+        except Exception:
+            swallowed(dashboard_log, "Could not compute the inventory value")
             return "0.00"
     
     def get_monthly_sales(self):
-        """Get monthly sales"""
-        # Dummy for demonstration - can be developed
-        return pd.DataFrame({
-            'month': ['January', 'February', 'March', 'April', 'May', 'June'],
-            'sales': [15000, 18000, 22000, 19000, 25000, 28000]
-        })
+        """Get monthly sales with the forecast for the coming days"""
+        self.cursor.execute('''
+            SELECT strftime('%Y-%m', day) AS month, SUM(net)
+            FROM sales_daily
+            WHERE day >= DATE('now', 'start of month', '-5 months')
+            GROUP BY month
+            ORDER BY month
+        ''')
+        rows = self.cursor.fetchall()
+        months = [month for month, _ in rows]
+        sales = [total or 0 for _, total in rows]
+        
+        months.append(f"Next {self.forecaster.horizon_days}d (forecast)")
+        sales.append(self.forecaster.forecast_revenue())
+        return pd.DataFrame({'month': months, 'sales': sales})
     
     def get_top_customers(self):
         """Get top customers"""
@@ -1728,10 +1706,12 @@ class ERPSystem:
     
     def get_inventory_status(self):
         """Get inventory status"""
-        # Dummy for demonstration - can be developed
+        alert_counts = self.stock_levels.alert_counts()
+        self.cursor.execute("SELECT COUNT(*) FROM products")
+        normal = self.cursor.fetchone()[0] - sum(alert_counts.values())
         return pd.DataFrame({
-            'status': ['Normal', 'Low', 'Out of Stock'],
-            'count': [50, 15, 5]
+            'status': [STATUS_LABELS[None], STATUS_LABELS[LOW_STOCK], STATUS_LABELS[OUT_OF_STOCK]],
+            'count': [normal, alert_counts[LOW_STOCK], alert_counts[OUT_OF_STOCK]]
         })
     
     def get_sales_purchases_comparison(self):
@@ -1766,31 +1746,73 @@ class ERPSystem:
             return
         
         try:
-            with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-                # Export all tables
-                tables = {
-                    'Customers': "SELECT * FROM customers",
-                    'Suppliers': "SELECT * FROM suppliers",
-                    'Products': "SELECT * FROM products",
-                    'Sales': "SELECT * FROM sales",
-                    'Sales_Details': "SELECT * FROM sales_details",
-                    'Purchases': "SELECT * FROM purchases",
-                    'Inventory': "SELECT * FROM inventory"
-                }
-                
-                for sheet_name, query in tables.items():
-                    df = pd.read_sql_query(query, self.conn)
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
+            export_tables(self.conn, EXPORT_TABLES[ERP_SCHEMA], file_path)
             
             messagebox.showinfo("Success", f"Data exported to {file_path}")
             
         except Exception as e:
             messagebox.showerror("Error", f"An export error occurred: {str(e)}")
     
+    def show_query_stats(self):
+        """Show statement timings and the slow query log"""
+        QueryStatsWindow(self.root, self.query_stats)
+    
+    def show_responsiveness(self):
+        """Show main loop stalls and what caused them"""
+        WatchdogWindow(self.root, self.watchdog)
+    
+    def toggle_profiling(self):
+        """Start or stop a cProfile capture around what the user does next"""
+        try:
+            if self.profiling_var.get():
+                self.capture.start_profile()
+                messagebox.showinfo("Profiling", "CPU profiling started.\n"
+                                    "Do the slow action, then uncheck Diagnostics > Profile CPU.")
+            else:
+                folder = self.capture.stop_profile()
+                if folder:
+                    messagebox.showinfo("Profiling", f"CPU profile saved to:\n{os.path.abspath(folder)}")
+        except (OSError, ValueError) as e:
+            self.profiling_var.set(self.capture.profiler is not None)
+            messagebox.showerror("Error", f"Profiling failed: {str(e)}")
+    
+    def toggle_memory_tracking(self):
+        """Start or stop a tracemalloc capture around what the user does next"""
+        try:
+            if self.memory_tracking_var.get():
+                self.capture.start_memory()
+                messagebox.showinfo("Memory Tracking", "Memory tracking started.\n"
+                                    "Do the action to check, then uncheck Diagnostics > Track Memory.")
+            else:
+                folder = self.capture.stop_memory()
+                if folder:
+                    messagebox.showinfo("Memory Tracking", f"Memory snapshot saved to:\n{os.path.abspath(folder)}")
+        except OSError as e:
+            self.memory_tracking_var.set(self.capture.memory_start is not None)
+            messagebox.showerror("Error", f"Memory tracking failed: {str(e)}")
+    
     def export_report(self):
-        """Export report to Excel"""
-        # Can be developed in future versions
-        messagebox.showinfo("Export", "Export functionality will be developed in future versions")
+        """Export report to Excel, CSV or Parquet"""
+        try:
+            report = self.report_engine.find_by_title(self.report_type.get())
+            
+            file_path = filedialog.asksaveasfilename(
+                defaultextension=".xlsx",
+                initialfile=f"{report.report_id}.xlsx",
+                filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv"),
+                           ("Parquet files", "*.parquet"), ("All files", "*.*")]
+            )
+            
+            if not file_path:
+                return
+            
+            # Re-run the report query instead of reading rows back from the table
+            count = self.report_engine.export(report.report_id, file_path, self.get_report_params())
+            
+            messagebox.showinfo("Success", f"{count} rows exported to {file_path}")
+            
+        except Exception as e:
+            messagebox.showerror("Error", f"Error exporting report: {str(e)}")
     
     def show_sales_report(self):
         """Show sales report"""
@@ -1817,6 +1839,10 @@ class ERPSystem:
     
     def __del__(self):
         """Close database connection"""
+        if hasattr(self, 'tracer'):
+            self.tracer.close()
+        if hasattr(self, 'log_session'):
+            self.log_session.stop()
         if hasattr(self, 'conn'):
             self.conn.close()
 
@@ -0,0 +1,585 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import math
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from erp import open_database
+from erp_schema import profile
+from sales import SalesLedger
+from stock_levels import DEFAULT_RESERVATION_HOURS, STATUS_LABELS, InsufficientStock, stock_status
+from write_queue import DEFAULT_WINDOW, WriteCoordinator
+
+
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+MAX_INVOICE_LINES = 500
+# Largest quantity a line may ask for, well inside SQLite's 64-bit integers
+MAX_QUANTITY = 1_000_000
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Longest a quotation may hold stock
+MAX_RESERVATION_HOURS = 24 * 90
+# Idle keep-alive connections are closed after this many seconds
+KEEP_ALIVE_SECONDS = 30
+# Dates and timestamps as the desktop apps store them, which SQLite's DATE() reads
+DATE_FORMAT = re.compile(r'\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?)?')
+
+STATUS_TEXT = {
+    200: 'OK',
+    201: 'Created',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    409: 'Conflict',
+    413: 'Payload Too Large',
+    422: 'Unprocessable Entity',
+    500: 'Internal Server Error',
+}
+
+log = logging.getLogger('erp.api')
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def reject_constant(name):
+    """Refuse the NaN and Infinity literals Python's JSON decoder accepts"""
+    raise ValueError(f"{name} is not valid JSON")
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        url = urlsplit(target)
+        self.path = unquote(url.path).rstrip('/') or '/'
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        """Decode the request body as a JSON object"""
+        try:
+            data = json.loads(self.body or b'null', parse_constant=reject_constant)
+        except ValueError:
+            raise HttpError(400, "Request body is not valid JSON")
+        if not isinstance(data, dict):
+            raise HttpError(400, "Request body must be a JSON object")
+        return data
+
+    def page(self):
+        """Get the (after, limit) keyset paging parameters"""
+        try:
+            limit = int(self.query.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            raise HttpError(400, "limit must be an integer")
+        return self.query.get('after'), max(1, min(limit, MAX_PAGE_SIZE))
+
+    @property
+    def keep_alive(self):
+        return self.headers.get('connection', '').lower() != 'close'
+
+
+# ===== Validation =====
+
+def is_amount(value):
+    """Check a JSON value is a finite, non-negative number"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) and value >= 0
+
+
+def parse_items(items):
+    """Validate request items and return (product_code, quantity, price) lines"""
+    if not isinstance(items, list) or not items:
+        raise HttpError(422, "items must be a non-empty list")
+    if len(items) > MAX_INVOICE_LINES:
+        raise HttpError(422, f"A request has at most {MAX_INVOICE_LINES} items")
+
+    lines = []
+    for number, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            raise HttpError(422, f"Item {number} must be an object")
+        product_code = item.get('product_code')
+        quantity = item.get('quantity')
+        price = item.get('price')
+        if not isinstance(product_code, (str, int)) or isinstance(product_code, bool) or str(product_code) == '':
+            raise HttpError(422, f"Item {number}: product_code is required")
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or not 0 < quantity <= MAX_QUANTITY:
+            raise HttpError(422, f"Item {number}: quantity must be an integer between 1 and {MAX_QUANTITY}")
+        if price is not None and not is_amount(price):
+            raise HttpError(422, f"Item {number}: price must be a non-negative number")
+        lines.append((str(product_code), quantity, price))
+    return lines
+
+
+def parse_date(value, name):
+    """Validate a YYYY-MM-DD date or timestamp and return it in normalized form"""
+    if isinstance(value, str) and DATE_FORMAT.fullmatch(value.strip()):
+        value = value.strip()
+        try:
+            if len(value) == 10:
+                return datetime.date.fromisoformat(value).isoformat()
+            return datetime.datetime.fromisoformat(value).isoformat(sep=' ')
+        except ValueError:
+            pass
+    raise HttpError(422, f"{name} must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+
+
+def parse_invoice(data):
+    """Validate an invoice request and return it in normalized form"""
+    customer_code = data.get('customer_code')
+    if not isinstance(customer_code, str) or not customer_code.strip():
+        raise HttpError(422, "customer_code is required")
+
+    lines = parse_items(data.get('items'))
+
+    discount = data.get('discount', 0)
+    if not is_amount(discount):
+        raise HttpError(422, "discount must be a non-negative number")
+
+    invoice_number = data.get('invoice_number')
+    if invoice_number is not None and (not isinstance(invoice_number, str) or not invoice_number.strip()):
+        raise HttpError(422, "invoice_number must be a non-empty string")
+
+    reservation = data.get('reservation')
+    if reservation is not None and (not isinstance(reservation, str) or not reservation.strip()):
+        raise HttpError(422, "reservation must be a non-empty string")
+
+    invoice_date = data.get('invoice_date')
+    if invoice_date is not None:
+        invoice_date = parse_date(invoice_date, 'invoice_date')
+
+    return {
+        'customer_code': customer_code.strip(),
+        'lines': lines,
+        'discount': discount,
+        'invoice_number': invoice_number.strip() if invoice_number else None,
+        'invoice_date': invoice_date,
+        'reservation': reservation.strip() if reservation else None,
+    }
+
+
+def parse_reservation(data):
+    """Validate a stock reservation request"""
+    reference = data.get('reference')
+    if not isinstance(reference, str) or not reference.strip():
+        raise HttpError(422, "reference is required")
+
+    hours = data.get('hours', DEFAULT_RESERVATION_HOURS)
+    if not isinstance(hours, (int, float)) or isinstance(hours, bool) or not 0 < hours <= MAX_RESERVATION_HOURS:
+        raise HttpError(422, f"hours must be a number between 0 and {MAX_RESERVATION_HOURS}")
+
+    return {
+        'reference': reference.strip(),
+        'lines': parse_items(data.get('items')),
+        'hours': hours,
+    }
+
+
+# ===== Database Access =====
+
+class ReadPool:
+    def __init__(self, path, size=4):
+        self.path = path
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='api-read')
+
+    def connection(self):
+        """Get this reader thread's connection"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA query_only = ON")
+            self.local.conn = conn
+        return conn
+
+    async def run(self, func, *args):
+        """Run a read function with a reader connection on the pool"""
+        def call():
+            cursor = self.connection().cursor()
+            try:
+                return func(cursor, *args)
+            finally:
+                cursor.close()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class SerialWriter:
+    def __init__(self, path, queue_size=1000, window=DEFAULT_WINDOW):
+        self.path = path
+        # Clients wait here once queue_size writes are in flight
+        self.slots = asyncio.Semaphore(queue_size)
+        # All writes run on one thread with one connection, batched into group commits
+        self.coordinator = WriteCoordinator(self.open, window)
+        self.services = None
+        self.sales = None
+
+    async def start(self):
+        """Open the writer connection and start taking writes"""
+        await asyncio.get_running_loop().run_in_executor(None, self.coordinator.start)
+
+    def open(self):
+        services = open_database(self.path)
+        # Readers keep working while the writer commits
+        services.conn.execute("PRAGMA journal_mode = WAL")
+        self.sales = SalesLedger(services.conn, services.schema, services.stock_levels,
+                                 services.costing, services.rollups)
+        self.services = services
+        return services.conn
+
+    def pending(self):
+        """Get the number of writes waiting for the writer"""
+        return self.coordinator.pending()
+
+    async def submit(self, func, *args):
+        """Queue a write and wait until it is committed"""
+        async with self.slots:
+            result, stock_changes = await asyncio.wrap_future(self.coordinator.submit(func, *args))
+        self.services.stock_levels.notify(stock_changes)
+        return result
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.coordinator.close)
+
+
+# ===== Service =====
+
+class ErpApi:
+    def __init__(self, path, readers=4, queue_size=1000, window=DEFAULT_WINDOW):
+        self.path = path
+        self.reads = ReadPool(path, readers)
+        self.writer = SerialWriter(path, queue_size, window)
+        self.schema = None
+        self.profile = None
+        self.routes = [
+            ('GET', ('health',), self.health),
+            ('GET', ('customers',), self.list_customers),
+            ('GET', ('customers', None), self.get_customer),
+            ('GET', ('products',), self.list_products),
+            ('GET', ('products', None), self.get_product),
+            ('GET', ('stock', None), self.get_stock),
+            ('GET', ('invoices', None), self.get_invoice),
+            ('POST', ('invoices',), self.create_invoice),
+            ('POST', ('reservations',), self.create_reservation),
+            ('DELETE', ('reservations', None), self.delete_reservation),
+        ]
+
+    async def start(self):
+        await self.writer.start()
+        self.schema = self.writer.services.schema
+        self.profile = profile(self.schema)
+
+    async def close(self):
+        await self.writer.close()
+        self.reads.close()
+
+    def route(self, request):
+        """Find the handler and path arguments of a request"""
+        parts = tuple(part for part in request.path.split('/') if part)
+        allowed = False
+        for method, pattern, handler in self.routes:
+            if len(pattern) != len(parts):
+                continue
+            if all(expected is None or expected == part for expected, part in zip(pattern, parts)):
+                if method == request.method:
+                    return handler, [part for expected, part in zip(pattern, parts) if expected is None]
+                allowed = True
+        if allowed:
+            raise HttpError(405, f"{request.method} is not allowed on {request.path}")
+        raise HttpError(404, f"No such resource: {request.path}")
+
+    async def handle(self, request):
+        """Dispatch a request and return (status, payload)"""
+        handler, args = self.route(request)
+        return await handler(request, *args)
+
+    # ===== Reads =====
+
+    async def health(self, request):
+        return 200, {'status': 'ok', 'schema': self.schema, 'queued_writes': self.writer.pending()}
+
+    async def list_customers(self, request):
+        after, limit = request.page()
+
+        def read(cursor):
+            cursor.execute('''
+                SELECT customer_code, customer_name, phone, address, email FROM customers
+                WHERE ? IS NULL OR customer_code > ?
+                ORDER BY customer_code LIMIT ?
+            ''', (after, after, limit))
+            return [dict(zip(('customer_code', 'customer_name', 'phone', 'address', 'email'), row))
+                    for row in cursor.fetchall()]
+
+        rows = await self.reads.run(read)
+        return 200, {'customers': rows, 'next': rows[-1]['customer_code'] if len(rows) == limit else None}
+
+    async def get_customer(self, request, customer_code):
+        def read(cursor):
+            cursor.execute('''
+                SELECT customer_code, customer_name, phone, address, email FROM customers
+                WHERE customer_code = ?
+            ''', (customer_code,))
+            return cursor.fetchone()
+
+        row = await self.reads.run(read)
+        if row is None:
+            raise HttpError(404, f"Customer {customer_code} not found")
+        return 200, dict(zip(('customer_code', 'customer_name', 'phone', 'address', 'email'), row))
+
+    def product_query(self, where):
+        key = self.profile['inventory_key']
+        return f'''
+            SELECT p.product_code, p.product_name, p.{self.profile['unit']}, p.{self.profile['sale_price']},
+                   p.minimum_limit, COALESCE(b.balance, 0)
+            FROM products p
+            LEFT JOIN stock_balances b ON b.product_key = p.{key}
+            {where}
+        '''
+
+    def product_dict(self, row):
+        product = dict(zip(('product_code', 'product_name', 'unit', 'price', 'minimum_limit', 'balance'), row))
+        product['status'] = STATUS_LABELS[stock_status(product['balance'], product['minimum_limit'])]
+        return product
+
+    async def list_products(self, request):
+        after, limit = request.page()
+        search = request.query.get('q')
+        sql = self.product_query('''
+            WHERE (? IS NULL OR p.product_code > ?)
+              AND (? IS NULL OR p.product_name LIKE '%' || ? || '%')
+            ORDER BY p.product_code LIMIT ?
+        ''')
+
+        def read(cursor):
+            cursor.execute(sql, (after, after, search, search, limit))
+            return [self.product_dict(row) for row in cursor.fetchall()]
+
+        rows = await self.reads.run(read)
+        return 200, {'products': rows, 'next': rows[-1]['product_code'] if len(rows) == limit else None}
+
+    async def get_product(self, request, product_code):
+        sql = self.product_query("WHERE p.product_code = ?")
+
+        def read(cursor):
+            cursor.execute(sql, (product_code,))
+            return cursor.fetchone()
+
+        row = await self.reads.run(read)
+        if row is None:
+            raise HttpError(404, f"Product {product_code} not found")
+        return 200, self.product_dict(row)
+
+    async def get_stock(self, request, product_code):
+        status, product = await self.get_product(request, product_code)
+        stock = {key: product[key] for key in ('product_code', 'balance', 'minimum_limit', 'status')}
+
+        def read(cursor):
+            cursor.execute(f'''
+                SELECT COALESCE(SUM(r.quantity), 0) FROM products p
+                JOIN stock_reservations r ON r.product_key = p.{self.profile['inventory_key']}
+                WHERE p.product_code = ? AND r.expires_at > CURRENT_TIMESTAMP
+            ''', (product_code,))
+            return cursor.fetchone()[0]
+
+        stock['reserved'] = await self.reads.run(read)
+        stock['available'] = stock['balance'] - stock['reserved']
+        return status, stock
+
+    async def get_invoice(self, request, invoice_number):
+        invoice = await self.reads.run(self.writer.sales.get_invoice, invoice_number)
+        if invoice is None:
+            raise HttpError(404, f"Invoice {invoice_number} not found")
+        return 200, invoice
+
+    # ===== Writes =====
+
+    async def create_invoice(self, request):
+        invoice = parse_invoice(request.json())
+        saved = await self.writer.submit(self.save_invoice, invoice)
+        return 201, saved
+
+    def save_invoice(self, cursor, invoice):
+        """Check and save an invoice on the writer connection"""
+        cursor.execute("SELECT 1 FROM customers WHERE customer_code = ?", (invoice['customer_code'],))
+        if cursor.fetchone() is None:
+            raise HttpError(422, f"Customer {invoice['customer_code']} not found")
+
+        codes = list(dict.fromkeys(code for code, _, _ in invoice['lines']))
+        cursor.execute(f'''
+            SELECT product_code, {self.profile['sale_price']} FROM products
+            WHERE product_code IN ({', '.join('?' for _ in codes)})
+        ''', codes)
+        prices = {str(code): price or 0 for code, price in cursor.fetchall()}
+        missing = [code for code in codes if code not in prices]
+        if missing:
+            raise HttpError(422, f"Products not found: {', '.join(missing)}")
+
+        # Lines without a price are sold at the catalog price
+        lines = [(code, quantity, prices[code] if price is None else price)
+                 for code, quantity, price in invoice['lines']]
+        total = sum(quantity * price for _, quantity, price in lines)
+        if invoice['discount'] > total:
+            raise HttpError(422, "discount is larger than the invoice total")
+
+        invoice_number = invoice['invoice_number'] or self.writer.sales.next_invoice_number(cursor)
+        try:
+            return self.writer.sales.save_invoice(cursor, invoice_number, invoice['customer_code'], lines,
+                                                  invoice['discount'], invoice['invoice_date'],
+                                                  invoice['reservation'])
+        except sqlite3.IntegrityError:
+            raise HttpError(409, f"Invoice {invoice_number} already exists")
+        except InsufficientStock as e:
+            raise HttpError(409, str(e))
+
+    async def create_reservation(self, request):
+        reservation = parse_reservation(request.json())
+        saved = await self.writer.submit(self.save_reservation, reservation)
+        return 201, saved
+
+    def save_reservation(self, cursor, reservation):
+        """Hold stock for a quotation on the writer connection"""
+        try:
+            expires_at = self.writer.sales.reserve(cursor, reservation['reference'], reservation['lines'],
+                                                   reservation['hours'])
+        except InsufficientStock as e:
+            raise HttpError(409, str(e))
+        except ValueError as e:
+            raise HttpError(422, str(e))
+        saved = {'reference': reservation['reference'], 'expires_at': expires_at,
+                 'lines': len(reservation['lines'])}
+        return saved, []
+
+    async def delete_reservation(self, request, reference):
+        released = await self.writer.submit(self.release_reservation, reference)
+        if not released:
+            raise HttpError(404, f"Reservation {reference} not found")
+        return 200, {'reference': reference, 'released': released}
+
+    def release_reservation(self, cursor, reference):
+        return self.writer.services.stock_levels.release(cursor, reference), []
+
+    # ===== HTTP =====
+
+    async def serve_connection(self, reader, writer):
+        """Serve requests on one keep-alive connection"""
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), KEEP_ALIVE_SECONDS)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HttpError as e:
+                    await write_response(writer, e.status, {'error': str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+
+                try:
+                    status, payload = await self.handle(request)
+                except HttpError as e:
+                    status, payload = e.status, {'error': str(e)}
+                except Exception as e:
+                    log.exception("%s %s failed", request.method, request.path)
+                    status, payload = 500, {'error': f"{type(e).__name__}: {e}"}
+                await write_response(writer, status, payload, request.keep_alive)
+                if not request.keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def read_request(reader):
+    """Read one HTTP/1.1 request, or None when the client closed the connection"""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise HttpError(400, "Incomplete request")
+    except asyncio.LimitOverrunError:
+        raise HttpError(413, "Request headers too large")
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, _ = lines[0].split(' ', 2)
+    except ValueError:
+        raise HttpError(400, "Malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HttpError(400, "Invalid Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, "Request body too large")
+    body = await reader.readexactly(length) if length else b''
+    return Request(method.upper(), target, headers, body)
+
+
+async def write_response(writer, status, payload, keep_alive=True):
+    """Write a JSON response"""
+    body = json.dumps(payload, default=str).encode('utf-8')
+    head = (f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+async def serve(path, host, port, readers=4, queue_size=1000, ready=None, window=DEFAULT_WINDOW):
+    """Run the API until cancelled"""
+    api = ErpApi(path, readers, queue_size, window)
+    await api.start()
+    server = await asyncio.start_server(api.serve_connection, host, port, limit=MAX_HEADER_BYTES)
+    if ready is not None:
+        ready(server)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await api.close()
+
+
+def main():
+    """Run the local HTTP API from the command line"""
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON API for tills and integrations")
+    parser.add_argument('database', help="SQLite database file")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--readers', type=int, default=4, help="Reader threads")
+    parser.add_argument('--queue-size', type=int, default=1000, help="Writes waiting before clients are held back")
+    parser.add_argument('--window', type=float, default=DEFAULT_WINDOW * 1000,
+                        help="Milliseconds the writer waits to group writes into one commit")
+    args = parser.parse_args()
+
+    def ready(server):
+        for sock in server.sockets:
+            print(f"Serving {args.database} on http://{sock.getsockname()[0]}:{sock.getsockname()[1]}", flush=True)
+
+    try:
+        asyncio.run(serve(args.database, args.host, args.port, args.readers, args.queue_size, ready,
+                          args.window / 1000))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+class ApiClient:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, payload=None):
+        """Send one request on a keep-alive connection and return (status, payload)"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.writer.write((f"{method} {path} HTTP/1.1\r\n"
+                           f"Host: {self.host}\r\n"
+                           f"Content-Type: application/json\r\n"
+                           f"Content-Length: {len(body)}\r\n\r\n").encode('latin-1') + body)
+        await self.writer.drain()
+
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        status = int(head[0].split(' ')[1])
+        length = 0
+        for line in head[1:]:
+            if line.lower().startswith('content-length:'):
+                length = int(line.split(':', 1)[1])
+        data = await self.reader.readexactly(length)
+        return status, json.loads(data) if data else None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+
+def percentile(values, fraction):
+    """Get a percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def load_catalog(host, port):
+    """Fetch customer and product codes to build invoices from"""
+    client = ApiClient(host, port)
+    try:
+        _, customers = await client.request('GET', '/customers?limit=1000')
+        _, products = await client.request('GET', '/products?limit=1000')
+    finally:
+        await client.close()
+    return ([row['customer_code'] for row in customers['customers']],
+            [row['product_code'] for row in products['products']])
+
+
+async def run_client(host, port, customers, products, deadline, read_ratio, max_lines, results, seed):
+    """Post invoices and read products until the deadline"""
+    rng = random.Random(seed)
+    client = ApiClient(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            if rng.random() < read_ratio:
+                kind = 'read'
+                method, path, payload = 'GET', f"/products/{rng.choice(products)}", None
+            else:
+                kind = 'invoice'
+                items = [{'product_code': code, 'quantity': rng.randint(1, 3)}
+                         for code in rng.sample(products, rng.randint(1, min(max_lines, len(products))))]
+                method, path, payload = 'POST', '/invoices', {'customer_code': rng.choice(customers),
+                                                              'items': items}
+            start = time.perf_counter()
+            try:
+                status, _ = await client.request(method, path, payload)
+            except (OSError, asyncio.IncompleteReadError):
+                status = 'connection error'
+                await client.close()
+                client = ApiClient(host, port)
+            results.append((kind, status, time.perf_counter() - start))
+    finally:
+        await client.close()
+
+
+async def load_test(url, clients, duration, read_ratio, max_lines, seed):
+    """Run concurrent clients against the API and return the collected samples"""
+    address = urlsplit(url)
+    host, port = address.hostname, address.port or 80
+    customers, products = await load_catalog(host, port)
+    if not customers or not products:
+        raise SystemExit("The database needs customers and products to load-test invoices")
+
+    results = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(run_client(host, port, customers, products, deadline, read_ratio,
+                                      max_lines, results, seed + i)
+                           for i in range(clients)))
+    return results
+
+
+def report(results, duration, clients):
+    """Print throughput and latency per request kind"""
+    print(f"{clients} clients, {duration:.0f} s")
+    print(f"{'kind':<10}{'ok':>9}{'failed':>8}{'per sec':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for kind in ('invoice', 'read'):
+        samples = [(status, elapsed) for sample_kind, status, elapsed in results if sample_kind == kind]
+        if not samples:
+            continue
+        ok = sorted(elapsed * 1000 for status, elapsed in samples if status in (200, 201))
+        failed = len(samples) - len(ok)
+        print(f"{kind:<10}{len(ok):>9}{failed:>8}{len(ok) / duration:>10.1f}"
+              f"{percentile(ok, 0.50):>9.1f}{percentile(ok, 0.95):>9.1f}{percentile(ok, 0.99):>9.1f}")
+
+    statuses = {}
+    for _, status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print("responses: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str)))
+    if results:
+        print(f"mean latency: {statistics.mean(elapsed for _, _, elapsed in results) * 1000:.1f} ms")
+
+
+def main():
+    """Load-test a running API from the command line"""
+    parser = argparse.ArgumentParser(description="Load-test the local HTTP API with concurrent clients")
+    parser.add_argument('--url', default='http://127.0.0.1:8765')
+    parser.add_argument('--clients', type=int, default=50, help="Concurrent keep-alive clients")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to run")
+    parser.add_argument('--read-ratio', type=float, default=0.5, help="Share of requests that are product reads")
+    parser.add_argument('--max-lines', type=int, default=5, help="Most items per invoice")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = asyncio.run(load_test(args.url, args.clients, args.duration, args.read_ratio,
+                                    args.max_lines, args.seed))
+    report(results, args.duration, args.clients)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import argparse
+import datetime
+import gzip
+import logging
+import lzma
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from data_io import backup_database
+from db_targets import FILE, file_uri, open_target
+
+
+BACKUP_PREFIX = 'erp_backup_'
+STAMP_FORMAT = '%Y%m%d_%H%M%S'
+# Compression name: (file suffix, opener)
+COMPRESSIONS = {
+    'xz': ('.db.xz', lzma.open),
+    'gz': ('.db.gz', gzip.open),
+    'none': ('.db', None),
+}
+# Writer settings, xz's default preset is ten times slower for a file a third smaller
+COMPRESSION_LEVELS = {'xz': {'preset': 1}, 'gz': {'compresslevel': 6}}
+# File extension: compression it implies
+EXTENSIONS = {'.xz': 'xz', '.gz': 'gz'}
+DEFAULT_COMPRESSION = 'xz'
+DEFAULT_KEEP_DAILY = 7
+DEFAULT_KEEP_WEEKLY = 4
+# Pages copied per step, 4 MB with the default page size
+DEFAULT_STEP_PAGES = 1024
+# Pause after each step so writers on a rollback journal get the lock in between
+DEFAULT_STEP_PAUSE = 0.005
+# Steps in a row another connection's writes may send back to the start
+MAX_RESTARTS = 5
+CHUNK_SIZE = 1024 * 1024
+
+BACKUP_NAME = re.compile(re.escape(BACKUP_PREFIX) + r'(\d{8}_\d{6})\.db(\.xz|\.gz)?$')
+
+log = logging.getLogger('erp.backup')
+
+
+class Restarting(Exception):
+    """Raised from the progress callback to stop a copy writers keep restarting"""
+
+
+class CorruptBackup(ValueError):
+    def __init__(self, path, problems):
+        self.path = path
+        self.problems = problems
+        super().__init__(f"{path} failed the integrity check: {'; '.join(problems[:5])}")
+
+
+def compression_for(path):
+    """Get the compression a backup file name implies"""
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), 'none')
+
+
+def backup_path(directory, compression=DEFAULT_COMPRESSION, now=None):
+    """Get a timestamped backup file name in a directory"""
+    stamp = (now or datetime.datetime.now()).strftime(STAMP_FORMAT)
+    return os.path.join(directory, BACKUP_PREFIX + stamp + COMPRESSIONS[compression][0])
+
+
+def backup_stamp(name):
+    """Get the time in a backup file name, or None for other files"""
+    match = BACKUP_NAME.match(os.path.basename(name))
+    return datetime.datetime.strptime(match.group(1), STAMP_FORMAT) if match else None
+
+
+# ===== Copy and Check =====
+
+def snapshot(conn, target_path, pages=DEFAULT_STEP_PAGES, pause=DEFAULT_STEP_PAUSE, progress=None):
+    """Copy a live database to a file in steps and return the number of pages"""
+    state = {'total': 0, 'remaining': None, 'stalled': 0}
+
+    def step(status, remaining, total):
+        if state['remaining'] is not None and remaining >= state['remaining']:
+            state['stalled'] += 1
+            if state['stalled'] > MAX_RESTARTS:
+                raise Restarting()
+        else:
+            state['stalled'] = 0
+        state.update(total=total, remaining=remaining)
+        if progress:
+            progress(total - remaining, total)
+        if remaining and pause:
+            time.sleep(pause)
+
+    wal = conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == 'wal'
+    if wal and not conn.in_transaction:
+        # Reading from one snapshot keeps other writers from restarting the copy, and
+        # under WAL a reader does not hold them up
+        conn.execute("BEGIN")
+        conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        try:
+            backup_database(conn, target_path, pages, step)
+        finally:
+            conn.rollback()
+        return state['total']
+
+    try:
+        backup_database(conn, target_path, pages, step)
+    except Restarting:
+        # Writers commit faster than the steps copy, so copy the rest in one go and
+        # let them wait for it within their busy timeout
+        log.info("Backup restarted %d times, finishing in one step", state['stalled'])
+        backup_database(conn, target_path)
+        state['total'] = conn.execute("PRAGMA page_count").fetchone()[0]
+    return state['total']
+
+
+def detach_wal(path):
+    """Switch a copied database back to a rollback journal so it stands alone as one file"""
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        conn.close()
+
+
+def check_integrity(path):
+    """Run PRAGMA integrity_check on a database file and return the problems found"""
+    conn = sqlite3.connect(file_uri(path, mode='ro'), uri=True)
+    try:
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+    except sqlite3.DatabaseError as e:
+        # Damage to the header or schema stops the check before it can list anything
+        problems = [str(e)]
+    finally:
+        conn.close()
+    return [] if problems == ['ok'] else problems
+
+
+def compress_file(path, target_path, compression):
+    """Stream a file through a compressor"""
+    opener = COMPRESSIONS[compression][1]
+    with open(path, 'rb') as source, opener(target_path, 'wb', **COMPRESSION_LEVELS[compression]) as target:
+        shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+
+def create_backup(conn, target_path, compression=None, pages=DEFAULT_STEP_PAGES,
+                  pause=DEFAULT_STEP_PAUSE, progress=None):
+    """Write a verified, optionally compressed backup of an open database"""
+    compression = compression or compression_for(target_path)
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    directory = os.path.dirname(os.path.abspath(target_path))
+    os.makedirs(directory, exist_ok=True)
+    # Nothing is written under the final name until the backup has passed its check
+    handle, copy = tempfile.mkstemp(suffix='.db.partial', dir=directory)
+    os.close(handle)
+    partial = target_path + '.partial'
+    started = time.perf_counter()
+    try:
+        page_count = snapshot(conn, copy, pages, pause, progress)
+        detach_wal(copy)
+        problems = check_integrity(copy)
+        if problems:
+            raise CorruptBackup(target_path, problems)
+        if compression == 'none':
+            os.replace(copy, target_path)
+        else:
+            compress_file(copy, partial, compression)
+            os.replace(partial, target_path)
+    finally:
+        for leftover in (copy, partial):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    log.info("Backup written to %s", target_path,
+             extra={'pages': page_count, 'bytes': os.path.getsize(target_path),
+                    'seconds': round(time.perf_counter() - started, 3)})
+    return target_path
+
+
+def verify_backup(path):
+    """Restore a backup to a scratch file and return the integrity problems found"""
+    compression = compression_for(path)
+    if compression == 'none':
+        return check_integrity(path)
+    handle, copy = tempfile.mkstemp(suffix='.db')
+    try:
+        with os.fdopen(handle, 'wb') as target, COMPRESSIONS[compression][1](path, 'rb') as source:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+        return check_integrity(copy)
+    finally:
+        os.remove(copy)
+
+
+# ===== Retention =====
+
+def backups_to_keep(stamps, daily=DEFAULT_KEEP_DAILY, weekly=DEFAULT_KEEP_WEEKLY):
+    """Pick the newest backup of each of the last daily days and weekly ISO weeks"""
+    newest = sorted(stamps, reverse=True)
+    days, weeks = {}, {}
+    for stamp in newest:
+        days.setdefault(stamp.date(), stamp)
+        weeks.setdefault(stamp.isocalendar()[:2], stamp)
+    keep = set(list(days.values())[:daily]) | set(list(weeks.values())[:weekly])
+    # The latest backup is never pruned, whatever the policy
+    keep.update(newest[:1])
+    return keep
+
+
+def prune_backups(directory, daily=DEFAULT_KEEP_DAILY, weekly=DEFAULT_KEEP_WEEKLY):
+    """Delete the backups in a directory the retention policy does not keep, return their paths"""
+    found = {}
+    for name in os.listdir(directory):
+        stamp = backup_stamp(name)
+        if stamp is not None:
+            found.setdefault(stamp, []).append(os.path.join(directory, name))
+    keep = backups_to_keep(found, daily, weekly)
+    removed = []
+    for stamp, paths in sorted(found.items()):
+        if stamp not in keep:
+            for path in paths:
+                os.remove(path)
+                removed.append(path)
+    if removed:
+        log.info("Pruned %d old backups from %s", len(removed), directory)
+    return removed
+
+
+# ===== Background Backups =====
+
+class BackupJob:
+    def __init__(self, database, directory, mode=FILE, conn=None, compression=DEFAULT_COMPRESSION,
+                 keep_daily=DEFAULT_KEEP_DAILY, keep_weekly=DEFAULT_KEEP_WEEKLY,
+                 pages=DEFAULT_STEP_PAGES, pause=DEFAULT_STEP_PAUSE):
+        self.database = database
+        self.directory = directory
+        self.mode = mode
+        # An in-memory database can only be read through its own connection
+        self.conn = conn
+        self.compression = compression
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.pages = pages
+        self.pause = pause
+        self.copied = 0
+        self.total = 0
+        self.path = None
+        self.removed = []
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        """Run the backup on a background thread"""
+        self.thread = threading.Thread(target=self.run, name='erp-backup', daemon=True)
+        self.thread.start()
+        return self
+
+    def done(self):
+        return self.thread is not None and not self.thread.is_alive()
+
+    def progress(self, copied, total):
+        self.copied, self.total = copied, total
+
+    def run(self):
+        # A connection of its own keeps the copy off the application's connection
+        conn = self.conn or open_target(self.database, self.mode)
+        try:
+            self.path = create_backup(conn, backup_path(self.directory, self.compression), self.compression,
+                                      self.pages, self.pause, self.progress)
+            self.removed = prune_backups(self.directory, self.keep_daily, self.keep_weekly)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            log.exception("Backup of %s failed", self.database)
+            self.error = e
+        finally:
+            if conn is not self.conn:
+                conn.close()
+
+
+def main():
+    """Check that backups restore to a sound database"""
+    parser = argparse.ArgumentParser(description="Restore backups to a scratch file and run an integrity check")
+    parser.add_argument('backups', nargs='+', help="Backup files (.db, .db.xz or .db.gz)")
+    args = parser.parse_args()
+    failed = 0
+    for path in args.backups:
+        problems = verify_backup(path)
+        print(f"{path}: {'ok' if not problems else '; '.join(problems[:5])}")
+        failed += bool(problems)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import argparse
+import csv
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from data_io import backup_database
+from db_targets import FILE, SNAPSHOT
+from erp import CountOutput, open_database
+from erp_schema import ERP_SCHEMA, SIMPLE_SCHEMA
+from profit_loss import MONTH
+from report_engine import reports_for
+from sales import SalesLedger
+from synthetic_data import SCALES, DataGenerator
+
+
+# Generated datasets are kept between runs, one file per schema, scale and seed
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), 'erp_bench')
+# Last day of generated data, fixed so every run measures the same database
+DATASET_END = datetime.date(2026, 6, 30)
+# Days of history reports are run over
+REPORT_DAYS = 365
+IMPORT_ROWS = 1000
+
+DEFAULT_THRESHOLD = 0.2
+# Slowdowns smaller than this are noise, whatever their percentage
+DEFAULT_NOISE_MS = 1.0
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms')
+
+EXIT_OK = 0
+EXIT_REGRESSION = 1
+
+
+def percentile(values, fraction):
+    """Get a nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(func, repeat, setup=None, warmup=1):
+    """Time func over repeated runs and return (seconds per run, rows per run)"""
+    timings = []
+    rows = []
+    for run in range(warmup + repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        count = func(argument) if setup else func()
+        elapsed = time.perf_counter() - start
+        if run >= warmup:
+            timings.append(elapsed)
+            rows.append(count or 0)
+    return timings, rows
+
+
+def summarize(timings, rows):
+    """Get latency percentiles and throughput of measured runs"""
+    ordered = sorted(timings)
+    total = sum(timings)
+    return {
+        'runs': len(timings),
+        'rows': sum(rows) // max(len(rows), 1),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+        'mean_ms': round(total / max(len(timings), 1) * 1000, 3),
+        'rows_per_sec': round(sum(rows) / total, 1) if total else 0.0,
+    }
+
+
+# ===== Datasets =====
+
+def ensure_dataset(data_dir, schema, scale, seed):
+    """Get the path of a generated dataset, generating it on first use"""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"{schema}_{scale}_{seed}.db")
+    if not os.path.exists(path):
+        print(f"Generating {schema} {scale} dataset...", file=sys.stderr, flush=True)
+        partial = path + '.partial'
+        if os.path.exists(partial):
+            os.remove(partial)
+        conn = sqlite3.connect(partial)
+        try:
+            DataGenerator(conn, schema, seed, end=DATASET_END).generate(
+                **SCALES[scale], report=lambda message: None)
+        finally:
+            conn.close()
+        os.replace(partial, path)
+    return path
+
+
+def copy_dataset(path):
+    """Copy a dataset to a scratch file for write benchmarks"""
+    handle, copy = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(path))
+    os.close(handle)
+    source = sqlite3.connect(path)
+    try:
+        backup_database(source, copy)
+    finally:
+        source.close()
+    return copy
+
+
+# ===== Cases =====
+
+def read_cases(services):
+    """Get (name, func) for every report and dashboard metric"""
+    conn = services.conn
+    engine = services.report_engine()
+    day = DATASET_END.isoformat()
+    params = {'date_from': (DATASET_END - datetime.timedelta(days=REPORT_DAYS)).isoformat(), 'date_to': day}
+
+    def report_case(report_id):
+        return lambda: engine.run(report_id, CountOutput(), params)
+
+    def scalar_case(sql, args=()):
+        def run():
+            conn.execute(sql, args).fetchone()
+            return 1
+        return run
+
+    def call_case(func, *args):
+        def run():
+            func(*args)
+            return 1
+        return run
+
+    cases = [(f"report:{report.report_id}", report_case(report.report_id))
+             for report in reports_for(services.schema)]
+
+    # Same queries as the desktop dashboards, with the dataset's last day as today
+    cases += [
+        ('dashboard:today_sales', scalar_case(
+            "SELECT SUM(net_invoice) FROM sales WHERE DATE(invoice_date) = ?", (day,))),
+        ('dashboard:customer_count', scalar_case("SELECT COUNT(*) FROM customers")),
+        ('dashboard:product_count', scalar_case("SELECT COUNT(*) FROM products")),
+        ('dashboard:inventory_value', call_case(services.costing.inventory_value)),
+        ('dashboard:alert_counts', call_case(services.stock_levels.alert_counts)),
+        ('dashboard:today_invoices', scalar_case(
+            "SELECT SUM(invoice_count) FROM sales_daily WHERE day = ?", (day,))),
+        ('dashboard:monthly_sales', lambda: len(conn.execute('''
+            SELECT strftime('%Y-%m', day) AS month, SUM(net)
+            FROM sales_daily
+            WHERE day >= DATE(?, 'start of month', '-5 months')
+            GROUP BY month
+        ''', (day,)).fetchall())),
+        ('dashboard:profit_loss', call_case(services.profit_loss.compare, MONTH, DATASET_END)),
+    ]
+    if services.schema == SIMPLE_SCHEMA:
+        cases.append(('dashboard:month_expenses', call_case(
+            services.expenses.total, DATASET_END.replace(day=1).isoformat(), day)))
+    return cases
+
+
+def write_cases(services, work_dir, seed):
+    """Get (name, func, setup, repeat cap) for the write paths and CSV imports"""
+    conn = services.conn
+    rng = random.Random(seed)
+    sales = SalesLedger(conn, services.schema, services.stock_levels, services.costing, services.rollups)
+    importer = services.importer()
+    key = sales.product_key
+    stocked = [str(row[0]) for row in conn.execute(f'''
+        SELECT p.product_code FROM products p
+        JOIN stock_balances b ON b.product_key = p.{key}
+        ORDER BY b.balance DESC LIMIT 50
+    ''')]
+    # Enough stock that no benchmark invoice is refused
+    importer.import_inventory([{'product_code': code, 'movement': 'in', 'quantity': '100000'}
+                               for code in stocked])
+    customers = [row[0] for row in conn.execute("SELECT customer_code FROM customers LIMIT 1000")]
+    counter = {'batch': 0}
+
+    def save_invoice():
+        cursor = conn.cursor()
+        try:
+            lines = [(code, 1, 10.0) for code in rng.sample(stocked, rng.randint(1, 3))]
+            sales.save_invoice(cursor, sales.next_invoice_number(cursor), rng.choice(customers), lines)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return len(lines)
+
+    def add_expense():
+        cursor = conn.cursor()
+        try:
+            services.expenses.add_expense(cursor, 'Benchmark', 10.0, DATASET_END.isoformat(), 'General')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return 1
+
+    def product_code(batch, number):
+        # Simple schema product codes are assigned by the database
+        return f"BP{batch}-{number}" if services.schema == ERP_SCHEMA else ''
+
+    def csv_setup(data_type, header, make_row):
+        def setup():
+            counter['batch'] += 1
+            path = os.path.join(work_dir, f"{data_type}_{counter['batch']}.csv")
+            with open(path, 'w', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file)
+                writer.writerow(header)
+                writer.writerows(make_row(counter['batch'], number) for number in range(IMPORT_ROWS))
+            return path
+        return setup
+
+    def import_case(data_type):
+        def run(path):
+            imported, errors = importer.import_file(data_type, path)
+            os.remove(path)
+            if errors:
+                raise ValueError(f"{len(errors)} {data_type} rows rejected: {errors[0]}")
+            return imported
+        return run
+
+    cases = [
+        ('write:save_invoice', lambda _: save_invoice(), None, None),
+        ('import:customers', import_case('customers'), csv_setup(
+            'customers', ('customer_code', 'customer_name', 'phone'),
+            lambda batch, number: (f"BENCH-{batch}-{number}", f"Bench Customer {number}", '0500000000')), 5),
+        ('import:products', import_case('products'), csv_setup(
+            'products', ('product_code', 'product_name', 'purchase_price', 'sale_price'),
+            lambda batch, number: (product_code(batch, number), f"Bench Product {batch}-{number}", 5, 8)), 5),
+        ('import:inventory', import_case('inventory'), csv_setup(
+            'inventory', ('product_code', 'movement', 'quantity'),
+            lambda batch, number: (rng.choice(stocked), 'in', 5)), 5),
+    ]
+    if services.schema == SIMPLE_SCHEMA:
+        cases.append(('write:add_expense', lambda _: add_expense(), None, None))
+    return cases
+
+
+def run_dataset(schema, scale, seed, data_dir, repeat, patterns=None, in_memory=False):
+    """Benchmark every case against one dataset and return results by case name"""
+    def selected(name):
+        return not patterns or any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+    path = ensure_dataset(data_dir, schema, scale, seed)
+    results = {}
+
+    # A snapshot in memory leaves the disk out of the timings
+    mode = SNAPSHOT if in_memory else FILE
+    services = open_database(path, mode)
+    try:
+        for name, func in read_cases(services):
+            if selected(name):
+                results[name] = summarize(*measure(func, repeat))
+                yield name, results[name]
+    finally:
+        services.conn.close()
+
+    # Writes to a snapshot are thrown away with it, a file needs a scratch copy
+    copy = None if in_memory else copy_dataset(path)
+    work_dir = tempfile.mkdtemp(dir=data_dir)
+    services = open_database(copy or path, mode)
+    try:
+        for name, func, setup, cap in write_cases(services, work_dir, seed):
+            if selected(name):
+                # Each write run must change something, so setup always provides the input
+                results[name] = summarize(*measure(func, min(repeat, cap or repeat),
+                                                   setup or (lambda: None)))
+                yield name, results[name]
+    finally:
+        services.conn.close()
+        if copy:
+            os.remove(copy)
+        for name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+
+
+# ===== Baselines =====
+
+def load_results(path):
+    """Read a results file"""
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_results(results, path):
+    """Write results with the environment they were measured in"""
+    document = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(document, file, indent=2, sort_keys=True)
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, metric='p50_ms', noise_ms=DEFAULT_NOISE_MS):
+    """Get (case, baseline ms, current ms, change, regressed) for cases in both result sets"""
+    rows = []
+    for case in sorted(set(baseline) & set(current)):
+        before = baseline[case][metric]
+        after = current[case][metric]
+        change = (after - before) / before if before else 0.0
+        regressed = change > threshold and after - before >= noise_ms
+        rows.append((case, before, after, change, regressed))
+    return rows
+
+
+def print_comparison(rows, metric):
+    """Print a baseline comparison and return the number of regressions"""
+    print(f"{'case':<44}{'baseline':>11}{'current':>11}{'change':>9}")
+    for case, before, after, change, regressed in rows:
+        print(f"{case:<44}{before:>11.2f}{after:>11.2f}{change:>+9.0%}{'  REGRESSION' if regressed else ''}")
+    regressions = sum(1 for row in rows if row[4])
+    print(f"{metric}: {len(rows)} cases compared, {regressions} regressions")
+    return regressions
+
+
+# ===== Command Line =====
+
+def cmd_run(args):
+    results = {}
+    print(f"{'case':<44}{'rows':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rows/s':>12}")
+    for schema in args.schema:
+        for scale in args.scale:
+            for name, result in run_dataset(schema, scale, args.seed, args.data_dir, args.repeat, args.case,
+                                            args.in_memory):
+                key = f"{schema}/{scale}/{name}"
+                results[key] = result
+                print(f"{key:<44}{result['rows']:>9}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+                      f"{result['p99_ms']:>10.2f}{result['rows_per_sec']:>12.0f}", flush=True)
+
+    if args.output:
+        save_results(results, args.output)
+        print(f"Results saved to {args.output}")
+    if args.baseline:
+        rows = compare(load_results(args.baseline)['results'], results, args.threshold, args.metric, args.noise)
+        if print_comparison(rows, args.metric):
+            return EXIT_REGRESSION
+    return EXIT_OK
+
+
+def cmd_compare(args):
+    rows = compare(load_results(args.baseline)['results'], load_results(args.current)['results'],
+                   args.threshold, args.metric, args.noise)
+    return EXIT_REGRESSION if print_comparison(rows, args.metric) else EXIT_OK
+
+
+def add_threshold_arguments(parser):
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Slowdown that counts as a regression (default: 0.2 for 20%%)")
+    parser.add_argument('--metric', choices=METRICS, default='p50_ms', help="Latency compared")
+    parser.add_argument('--noise', type=float, default=DEFAULT_NOISE_MS,
+                        help="Smallest slowdown in ms that counts")
+
+
+def main(argv=None):
+    """Run or compare benchmarks and return the exit code"""
+    parser = argparse.ArgumentParser(description="Benchmark reports, dashboard metrics, writes and imports")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('run', help="Run the benchmarks")
+    command.add_argument('--schema', nargs='+', choices=(SIMPLE_SCHEMA, ERP_SCHEMA),
+                         default=[SIMPLE_SCHEMA, ERP_SCHEMA])
+    command.add_argument('--scale', nargs='+', choices=SCALES, default=['tiny', 'small'])
+    command.add_argument('--case', action='append', help="Case name pattern, repeatable (e.g. 'report:*')")
+    command.add_argument('--repeat', type=int, default=20, help="Timed runs per case")
+    command.add_argument('--seed', type=int, default=1)
+    command.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help="Where generated datasets are kept")
+    command.add_argument('--in-memory', action='store_true',
+                         help="Run against snapshots of the datasets loaded into memory")
+    command.add_argument('-o', '--output', help="Save results as JSON")
+    command.add_argument('--baseline', help="Results file to compare against")
+    add_threshold_arguments(command)
+    command.set_defaults(handler=cmd_run)
+
+    command = commands.add_parser('compare', help="Compare two results files")
+    command.add_argument('baseline')
+    command.add_argument('current')
+    add_threshold_arguments(command)
+    command.set_defaults(handler=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmark import percentile
+from data_io import backup_database
+from erp import open_database
+from erp_schema import detect_schema, profile
+from sales import SalesLedger
+from stock_levels import InsufficientStock
+
+
+DEFAULT_WORKERS = '1,2,4,8,16'
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+DEFAULT_RETRIES = 5
+# Products a cashier may ring up, drawn from the catalog
+CATALOG_SIZE = 5000
+# Seconds given to the processes to start before the clock runs
+START_GRACE = 1.0
+
+KINDS = ('lookup', 'stock_check', 'save')
+
+
+def is_lock_error(error):
+    """Check a SQLite error means another connection holds the lock"""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def load_catalog(path):
+    """Get the schema, customer codes and (code, name, price) products to sell"""
+    conn = sqlite3.connect(path)
+    try:
+        schema = detect_schema(conn)
+        price = profile(schema)['sale_price']
+        customers = [row[0] for row in conn.execute("SELECT customer_code FROM customers LIMIT 1000")]
+        products = conn.execute(
+            f"SELECT product_code, product_name, {price} FROM products ORDER BY RANDOM() LIMIT ?",
+            (CATALOG_SIZE,)).fetchall()
+    finally:
+        conn.close()
+    if not customers or not products:
+        raise SystemExit("The database needs customers and products to run cashiers")
+    return schema, customers, products
+
+
+def prepare_copy(path, wal):
+    """Copy the database next to it so every step starts from the same data"""
+    handle, copy_path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(os.path.abspath(path)))
+    os.close(handle)
+    source = sqlite3.connect(path)
+    try:
+        backup_database(source, copy_path)
+    finally:
+        source.close()
+    # Create the derived tables before the cashiers start
+    services = open_database(copy_path)
+    if wal:
+        services.conn.execute("PRAGMA journal_mode=WAL")
+    services.conn.close()
+    return copy_path
+
+
+# ===== Cashier =====
+
+class Cashier:
+    def __init__(self, path, name, catalog, options, seed):
+        self.path = path
+        self.name = name
+        self.schema, self.customers, self.products = catalog
+        self.options = options
+        self.rng = random.Random(seed)
+        self.conn = None
+        self.ledger = None
+        self.price = profile(self.schema)['sale_price']
+        self.latencies = {kind: [] for kind in KINDS}
+        self.counts = {'sales': 0, 'lock_retries': 0, 'lock_failures': 0, 'stock_outs': 0}
+        self.errors = {}
+        self.invoices = 0
+
+    def think(self, seconds):
+        if seconds > 0:
+            time.sleep(self.rng.expovariate(1 / seconds))
+
+    def timed(self, kind, func, *args):
+        """Run a step, retrying on lock errors, and record its latency including retries"""
+        start = time.perf_counter()
+        for attempt in range(self.options.retries + 1):
+            try:
+                result = func(*args)
+                break
+            except sqlite3.OperationalError as e:
+                self.conn.rollback()
+                if not is_lock_error(e):
+                    raise
+                if attempt == self.options.retries:
+                    self.counts['lock_failures'] += 1
+                    raise
+                self.counts['lock_retries'] += 1
+                time.sleep(self.rng.uniform(0.005, 0.02) * (attempt + 1))
+        self.latencies[kind].append(time.perf_counter() - start)
+        return result
+
+    def lookup(self, product):
+        """Search products by the first letters of a name, as typed into the product box"""
+        code, name, _ = product
+        prefix = str(name)[:3]
+        rows = self.conn.execute(
+            f"SELECT product_code, product_name, {self.price} FROM products "
+            f"WHERE product_name LIKE ? ORDER BY product_name LIMIT 20", (prefix + '%',)).fetchall()
+        return next((row for row in rows if str(row[0]) == str(code)), product)
+
+    def stock_check(self, lines):
+        """Get the cart lines there is stock for"""
+        cursor = self.conn.cursor()
+        try:
+            keys, quantities = self.ledger.line_quantities(cursor, lines)
+            short = {key for key, _, _ in self.ledger.stock_levels.shortages(cursor, quantities)}
+        finally:
+            cursor.close()
+        return [line for line in lines if keys[str(line[0])] not in short]
+
+    def save(self, invoice_number, lines):
+        cursor = self.conn.cursor()
+        try:
+            _, changes = self.ledger.save_invoice(cursor, invoice_number, self.rng.choice(self.customers), lines)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return changes
+
+    def sell(self):
+        """Ring up one customer: look up items, check stock, save the invoice"""
+        lines = []
+        count = self.rng.randint(self.options.min_lines, self.options.max_lines)
+        for product in self.rng.sample(self.products, min(count, len(self.products))):
+            code, _, price = self.timed('lookup', self.lookup, product)
+            lines.append((code, self.rng.randint(1, 3), float(price or 0)))
+            self.think(self.options.item_think)
+
+        lines = self.timed('stock_check', self.stock_check, lines)
+        if not lines:
+            self.counts['stock_outs'] += 1
+            return
+        self.invoices += 1
+        try:
+            self.timed('save', self.save, f"LT-{self.name}-{self.invoices:06d}", lines)
+            self.counts['sales'] += 1
+        except InsufficientStock:
+            # Another till sold the last units between the check and the save
+            self.counts['stock_outs'] += 1
+
+    def run(self, start_at, stop_at):
+        # Each till has its own connection, opened on the thread that uses it
+        self.conn = sqlite3.connect(self.path, timeout=self.options.busy_timeout / 1000)
+        self.ledger = SalesLedger(self.conn, self.schema)
+        time.sleep(max(0.0, start_at - time.time()))
+        while time.time() < stop_at:
+            try:
+                self.sell()
+            except InsufficientStock:
+                # Running out of stock is the sample data, not a failure of the write path
+                self.counts['stock_outs'] += 1
+            except sqlite3.OperationalError as e:
+                if not is_lock_error(e):
+                    self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+            except Exception as e:
+                self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+            self.think(self.options.think)
+        self.conn.close()
+
+
+def merge(results):
+    """Combine cashier results into one"""
+    merged = {'latencies': {kind: [] for kind in KINDS},
+              'counts': {'sales': 0, 'lock_retries': 0, 'lock_failures': 0, 'stock_outs': 0},
+              'errors': {}}
+    for result in results:
+        for kind in KINDS:
+            merged['latencies'][kind].extend(result['latencies'][kind])
+        for key, value in result['counts'].items():
+            merged['counts'][key] += value
+        for key, value in result['errors'].items():
+            merged['errors'][key] = merged['errors'].get(key, 0) + value
+    return merged
+
+
+def run_process(path, catalog, options, process_index, threads, start_at, stop_at):
+    """Run cashier threads in this process and return their combined results"""
+    cashiers = [Cashier(path, f"{process_index}-{i}", catalog, options,
+                        options.seed * 1000003 + process_index * 1009 + i)
+                for i in range(threads)]
+    workers = [threading.Thread(target=cashier.run, args=(start_at, stop_at)) for cashier in cashiers]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return merge({'latencies': cashier.latencies, 'counts': cashier.counts, 'errors': cashier.errors}
+                 for cashier in cashiers)
+
+
+def run_step(path, catalog, options, workers):
+    """Run a number of cashiers spread over processes and summarize the step"""
+    processes = max(1, min(options.processes, workers))
+    split = [workers // processes + (1 if i < workers % processes else 0) for i in range(processes)]
+    start_at = time.time() + START_GRACE
+    stop_at = start_at + options.duration
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(run_process, path, catalog, options, i, threads, start_at, stop_at)
+                   for i, threads in enumerate(split)]
+        result = merge(future.result() for future in futures)
+    return summarize(workers, processes, options.duration, result)
+
+
+def summarize(workers, processes, duration, result):
+    """Get throughput, latency percentiles and lock counts of a step"""
+    summary = {'workers': workers, 'processes': processes, 'seconds': duration}
+    summary.update(result['counts'])
+    summary['sales_per_sec'] = round(result['counts']['sales'] / duration, 2)
+    summary['lookups_per_sec'] = round(len(result['latencies']['lookup']) / duration, 2)
+    for kind in KINDS:
+        values = sorted(result['latencies'][kind])
+        for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+            summary[f"{kind}_{name}_ms"] = round(percentile(values, fraction) * 1000, 2)
+    summary['errors'] = result['errors']
+    return summary
+
+
+def print_step(summary, header=False):
+    if header:
+        print(f"{'workers':>8}{'sales/s':>9}{'lookup/s':>10}{'save p50':>10}{'p95':>8}{'p99':>9}"
+              f"{'lookup p95':>12}{'check p95':>11}{'retries':>9}{'lock fail':>11}{'stock outs':>12}{'errors':>8}")
+    print(f"{summary['workers']:>8}{summary['sales_per_sec']:>9.1f}{summary['lookups_per_sec']:>10.1f}"
+          f"{summary['save_p50_ms']:>10.1f}{summary['save_p95_ms']:>8.1f}{summary['save_p99_ms']:>9.1f}"
+          f"{summary['lookup_p95_ms']:>12.1f}{summary['stock_check_p95_ms']:>11.1f}"
+          f"{summary['lock_retries']:>9}{summary['lock_failures']:>11}{summary['stock_outs']:>12}"
+          f"{sum(summary['errors'].values()):>8}", flush=True)
+
+
+def parse_workers(text):
+    """Parse '1,2,4,8' into worker counts"""
+    try:
+        counts = [int(part) for part in text.split(',') if part.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Worker counts must be numbers: {text}")
+    if not counts or min(counts) < 1:
+        raise argparse.ArgumentTypeError("Worker counts must be at least 1")
+    return counts
+
+
+def main():
+    """Ramp up simulated cashiers against a copy of a database"""
+    parser = argparse.ArgumentParser(description="Load-test one database with concurrent cashier processes and threads")
+    parser.add_argument('database', help="SQLite database file with customers and products")
+    parser.add_argument('--workers', type=parse_workers, default=parse_workers(DEFAULT_WORKERS),
+                        help=f"Cashier counts to step through (default: {DEFAULT_WORKERS})")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help="Processes the cashiers are spread over, as separate tills would be")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds per step")
+    parser.add_argument('--think', type=float, default=1.0, help="Mean seconds between customers")
+    parser.add_argument('--item-think', type=float, default=0.2, help="Mean seconds between scanned items")
+    parser.add_argument('--min-lines', type=int, default=1)
+    parser.add_argument('--max-lines', type=int, default=5)
+    parser.add_argument('--busy-timeout', type=float, default=DEFAULT_BUSY_TIMEOUT_MS,
+                        help="Milliseconds SQLite waits on a lock before reporting it")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help="Retries after a lock error")
+    parser.add_argument('--wal', action='store_true', help="Switch the copy to WAL journal mode")
+    parser.add_argument('--in-place', action='store_true',
+                        help="Write to the database itself instead of a fresh copy per step")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help="Write the step results as JSON")
+    args = parser.parse_args()
+    if args.min_lines < 1 or args.max_lines < args.min_lines:
+        parser.error("--min-lines must be at least 1 and at most --max-lines")
+
+    catalog = load_catalog(args.database)
+    mode = "WAL" if args.wal else "rollback journal"
+    print(f"{args.database}: {catalog[0]} schema, {mode}, {args.duration:.0f} s per step, "
+          f"think {args.think} s, busy timeout {args.busy_timeout:.0f} ms")
+    if args.in_place:
+        services = open_database(args.database)
+        if args.wal:
+            services.conn.execute("PRAGMA journal_mode=WAL")
+        services.conn.close()
+    results = []
+    for i, workers in enumerate(args.workers):
+        if args.in_place:
+            summary = run_step(args.database, catalog, args, workers)
+        else:
+            path = prepare_copy(args.database, args.wal)
+            try:
+                summary = run_step(path, catalog, args, workers)
+            finally:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+        results.append(summary)
+        print_step(summary, header=i == 0)
+
+    failing = next((summary['workers'] for summary in results if summary['lock_failures']), None)
+    if failing:
+        print(f"Lock failures start at {failing} cashiers")
+    else:
+        print("No lock failures at any step")
+    errors = {}
+    for summary in results:
+        for name, count in summary['errors'].items():
+            errors[name] = errors.get(name, 0) + count
+    if errors:
+        print("Errors: " + ", ".join(f"{name} {count}" for name, count in sorted(errors.items())))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
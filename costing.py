@@ -0,0 +1,385 @@
+import argparse
+import sqlite3
+
+from erp_schema import ERP_SCHEMA, add_column, detect_schema, profile, table_exists
+from rollups import RollupStore
+
+
+AVERAGE_COST = 'average'
+FIFO_COST = 'fifo'
+COSTING_METHODS = (AVERAGE_COST, FIFO_COST)
+
+
+class CostingEngine:
+    def __init__(self, conn, schema=None, method=None):
+        if method is not None and method not in COSTING_METHODS:
+            raise ValueError(f"Unknown costing method: {method}")
+        self.conn = conn
+        self.schema = schema or detect_schema(conn)
+        # Every writer must cost the same layers the same way, so the method is stored with them
+        stored = self.stored_method()
+        if method is not None and stored is not None and method != stored:
+            raise ValueError(f"Inventory is costed by {stored} cost, switching to {method} needs a full rebuild")
+        self.method = method or stored or AVERAGE_COST
+        # Same product key as the inventory table of the schema
+        self.product_key = profile(self.schema)['inventory_key']
+
+    def create_tables(self, backfill=True):
+        """Create cost layer and valuation tables, backfilling them on first use"""
+        is_new = not table_exists(self.conn, 'inventory_valuation')
+
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS inventory_valuation (
+                product_key TEXT PRIMARY KEY,
+                quantity INTEGER NOT NULL DEFAULT 0,
+                total_cost REAL NOT NULL DEFAULT 0,
+                unit_cost REAL NOT NULL DEFAULT 0,
+                cogs_total REAL NOT NULL DEFAULT 0,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS cost_layers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_key TEXT NOT NULL,
+                reference TEXT,
+                quantity INTEGER NOT NULL,
+                remaining INTEGER NOT NULL,
+                unit_cost REAL NOT NULL,
+                received_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS costing_settings (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        ''')
+        self.conn.execute(
+            "INSERT OR IGNORE INTO costing_settings (name, value) VALUES ('method', ?)", (self.method,))
+        # FIFO consumption only ever reads the open layers of one product, oldest first
+        self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_cost_layers_open
+            ON cost_layers (product_key, id) WHERE remaining > 0
+        ''')
+
+        # Sales lines store the unit cost they were issued at
+        add_column(self.conn, 'sales_details', 'unit_cost', 'REAL')
+        self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_sales_details_missing_cost
+            ON sales_details (id) WHERE unit_cost IS NULL
+        ''')
+        self.conn.commit()
+        self.method = self.stored_method()
+
+        if is_new and backfill:
+            self.rebuild()
+        return is_new
+
+    def stored_method(self):
+        """Get the costing method the cost layers are kept with, None before they are created"""
+        if not table_exists(self.conn, 'costing_settings'):
+            return None
+        row = self.conn.execute("SELECT value FROM costing_settings WHERE name = 'method'").fetchone()
+        return row[0] if row else None
+
+    def change_method(self, method):
+        """Switch the costing method, recosting every layer and sales line with it"""
+        if method not in COSTING_METHODS:
+            raise ValueError(f"Unknown costing method: {method}")
+        self.method = method
+        try:
+            # Committed by the rebuild, together with the layers it replays
+            self.conn.execute("UPDATE costing_settings SET value = ? WHERE name = 'method'", (method,))
+            return self.backfill_sales_costs(recost=True)
+        except Exception:
+            self.conn.rollback()
+            self.method = self.stored_method()
+            raise
+
+    # ===== Lookups =====
+
+    def get_valuation(self, cursor, product_key):
+        """Get (quantity, total_cost, unit_cost) of a product"""
+        cursor.execute(
+            "SELECT quantity, total_cost, unit_cost FROM inventory_valuation WHERE product_key = ?",
+            (product_key,))
+        return cursor.fetchone() or (0, 0.0, None)
+
+    def fallback_cost(self, cursor, product_key):
+        """Get the product's catalog purchase price"""
+        cursor.execute(f"SELECT purchase_price FROM products WHERE {self.product_key} = ?", (product_key,))
+        row = cursor.fetchone()
+        return float(row[0] or 0) if row else 0.0
+
+    def current_unit_cost(self, cursor, product_key):
+        """Get the cost an outgoing unit would be valued at right now"""
+        quantity, total_cost, unit_cost = self.get_valuation(cursor, product_key)
+        if self.method == FIFO_COST:
+            cursor.execute('''
+                SELECT unit_cost FROM cost_layers
+                WHERE product_key = ? AND remaining > 0
+                ORDER BY id LIMIT 1
+            ''', (product_key,))
+            row = cursor.fetchone()
+            if row:
+                return row[0]
+        elif quantity > 0:
+            return total_cost / quantity
+        return unit_cost if unit_cost is not None else self.fallback_cost(cursor, product_key)
+
+    def save_valuation(self, cursor, product_key, quantity, total_cost, unit_cost, cogs=0.0):
+        """Store a product's new valuation"""
+        cursor.execute('''
+            INSERT INTO inventory_valuation (product_key, quantity, total_cost, unit_cost, cogs_total)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (product_key) DO UPDATE SET
+                quantity = excluded.quantity,
+                total_cost = excluded.total_cost,
+                unit_cost = excluded.unit_cost,
+                cogs_total = cogs_total + excluded.cogs_total,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (product_key, quantity, round(total_cost, 4), unit_cost, round(cogs, 4)))
+
+    # ===== Movements =====
+
+    def receive(self, cursor, product_key, quantity, unit_cost=None, reference=None):
+        """Add incoming stock at a unit cost, inside the caller's transaction"""
+        product_key = str(product_key)
+        quantity = int(quantity)
+        if unit_cost is None:
+            unit_cost = self.current_unit_cost(cursor, product_key)
+        unit_cost = float(unit_cost)
+        on_hand, total_cost, _ = self.get_valuation(cursor, product_key)
+
+        if self.method == FIFO_COST:
+            # Units already issued below zero are settled by this receipt first
+            remaining = quantity + min(on_hand, 0)
+            cursor.execute('''
+                INSERT INTO cost_layers (product_key, reference, quantity, remaining, unit_cost)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (product_key, reference, quantity, max(remaining, 0), unit_cost))
+            total_cost = total_cost + max(remaining, 0) * unit_cost
+        elif on_hand <= 0:
+            # A shortfall is revalued at the new cost
+            total_cost = (on_hand + quantity) * unit_cost
+        else:
+            total_cost = total_cost + quantity * unit_cost
+
+        if self.method == AVERAGE_COST and on_hand + quantity > 0:
+            unit_cost = total_cost / (on_hand + quantity)
+        self.save_valuation(cursor, product_key, on_hand + quantity, total_cost, unit_cost)
+
+    def issue(self, cursor, product_key, quantity, reference=None):
+        """Remove outgoing stock and return its cost, inside the caller's transaction"""
+        product_key = str(product_key)
+        quantity = int(quantity)
+        on_hand, total_cost, unit_cost = self.get_valuation(cursor, product_key)
+
+        if self.method == FIFO_COST:
+            cost = 0.0
+            needed = quantity
+            cursor.execute('''
+                SELECT id, remaining, unit_cost FROM cost_layers
+                WHERE product_key = ? AND remaining > 0
+                ORDER BY id
+            ''', (product_key,))
+            for layer_id, remaining, layer_cost in cursor.fetchall():
+                if needed <= 0:
+                    break
+                taken = min(remaining, needed)
+                cursor.execute("UPDATE cost_layers SET remaining = remaining - ? WHERE id = ?",
+                               (taken, layer_id))
+                cost += taken * layer_cost
+                needed -= taken
+                unit_cost = layer_cost
+            if needed > 0:
+                # Issued beyond the open layers, valued at the last known cost
+                if unit_cost is None:
+                    unit_cost = self.fallback_cost(cursor, product_key)
+                cost += needed * unit_cost
+                total_cost = 0.0
+            else:
+                total_cost = total_cost - cost
+        else:
+            if on_hand > 0:
+                unit_cost = total_cost / on_hand
+            elif unit_cost is None:
+                unit_cost = self.fallback_cost(cursor, product_key)
+            cost = quantity * unit_cost
+            total_cost = total_cost - cost
+
+        self.save_valuation(cursor, product_key, on_hand - quantity, total_cost, unit_cost, cost)
+        return round(cost, 4)
+
+    def apply_movement(self, cursor, product_key, movement, quantity, unit_cost=None, reference=None):
+        """Apply one inventory movement and return the cost of an outgoing one"""
+        if movement == 'in':
+            self.receive(cursor, product_key, quantity, unit_cost, reference)
+            return 0.0
+        if movement == 'out':
+            return self.issue(cursor, product_key, quantity, reference)
+        return 0.0
+
+    # ===== Reads =====
+
+    def inventory_value(self):
+        """Get the total cost of stock on hand"""
+        row = self.conn.execute("SELECT SUM(total_cost) FROM inventory_valuation").fetchone()
+        return row[0] or 0
+
+    def cogs_total(self):
+        """Get the cost of all stock issued so far"""
+        row = self.conn.execute("SELECT SUM(cogs_total) FROM inventory_valuation").fetchone()
+        return row[0] or 0
+
+    def unit_cost(self, product_key):
+        """Get the current unit cost of a product"""
+        cursor = self.conn.cursor()
+        try:
+            return self.current_unit_cost(cursor, str(product_key))
+        finally:
+            cursor.close()
+
+    # ===== Rebuild =====
+
+    def movement_history(self, cursor):
+        """Get all inventory movements with purchase costs, in the order they happened"""
+        if self.schema == ERP_SCHEMA:
+            # Purchase receipts carry the invoice number as their reference and are written one
+            # per line in line order, so the nth receipt of a product is priced like its nth line.
+            # Receipts without a line of their own fall back to the quantity-weighted price.
+            cursor.execute('''
+                WITH moves AS (
+                    SELECT id, product_code, movement, quantity, reference,
+                           ROW_NUMBER() OVER (PARTITION BY reference, product_code, movement ORDER BY id) AS n
+                    FROM inventory
+                    WHERE product_code IS NOT NULL
+                ), lines AS (
+                    SELECT invoice_number, product_code, price,
+                           ROW_NUMBER() OVER (PARTITION BY invoice_number, product_code ORDER BY id) AS n
+                    FROM purchase_details
+                )
+                SELECT m.product_code, m.movement, m.quantity, m.reference,
+                       COALESCE(l.price,
+                                (SELECT SUM(d.price * d.quantity) / NULLIF(SUM(d.quantity), 0)
+                                 FROM purchase_details d
+                                 WHERE d.invoice_number = m.reference AND d.product_code = m.product_code))
+                FROM moves m
+                LEFT JOIN lines l ON m.movement = 'in' AND l.invoice_number = m.reference
+                                 AND l.product_code = m.product_code AND l.n = m.n
+                ORDER BY m.id
+            ''')
+        else:
+            cursor.execute(f'''
+                SELECT {self.product_key}, movement, quantity, reference, NULL
+                FROM inventory
+                WHERE {self.product_key} IS NOT NULL
+                ORDER BY id
+            ''')
+        return cursor.fetchall()
+
+    def rebuild(self):
+        """Replay all inventory movements into fresh cost layers and valuations"""
+        # Cost and quantity issued per (reference, product), used to backfill sales lines
+        issued = {}
+        cursor = self.conn.cursor()
+        try:
+            history = self.movement_history(cursor)
+            cursor.execute("DELETE FROM cost_layers")
+            cursor.execute("DELETE FROM inventory_valuation")
+            for product_key, movement, quantity, reference, unit_cost in history:
+                cost = self.apply_movement(cursor, product_key, movement, quantity or 0, unit_cost, reference)
+                if movement == 'out':
+                    total = issued.setdefault((reference, str(product_key)), [0.0, 0])
+                    total[0] += cost
+                    total[1] += quantity or 0
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return issued
+
+    def backfill_sales_costs(self, recost=False):
+        """Fill in unit costs of sales lines saved before costs were captured, or of every line to recost"""
+        missing = '' if recost else 'WHERE d.unit_cost IS NULL'
+        if not recost and self.conn.execute(
+                "SELECT 1 FROM sales_details WHERE unit_cost IS NULL LIMIT 1").fetchone() is None:
+            return 0
+
+        issued = self.rebuild()
+        # Match each line to the outgoing movement its invoice wrote
+        if self.schema == ERP_SCHEMA:
+            lines = self.conn.execute(f'''
+                SELECT d.id, d.invoice_number, d.product_code, p.purchase_price
+                FROM sales_details d
+                LEFT JOIN products p ON p.product_code = d.product_code
+                {missing}
+            ''').fetchall()
+        else:
+            lines = self.conn.execute(f'''
+                SELECT d.id, 'Invoice ' || d.invoice_number, p.product_name, p.purchase_price
+                FROM sales_details d
+                LEFT JOIN products p ON p.product_code = d.product_code
+                {missing}
+            ''').fetchall()
+
+        updates = []
+        for line_id, reference, product_key, purchase_price in lines:
+            cost, quantity = issued.get((reference, str(product_key)), (0.0, 0))
+            if quantity > 0:
+                unit_cost = cost / quantity
+            else:
+                # No movement to replay, fall back to the catalog price
+                unit_cost = purchase_price or 0
+            updates.append((round(unit_cost, 4), line_id))
+
+        try:
+            self.conn.executemany("UPDATE sales_details SET unit_cost = ? WHERE id = ?", updates)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return len(updates)
+
+
+def main():
+    """Rebuild inventory costing from the command line"""
+    parser = argparse.ArgumentParser(description="Rebuild cost layers and inventory valuation")
+    parser.add_argument('database', help="SQLite database file")
+    parser.add_argument('--method', choices=COSTING_METHODS, help="Costing method (default: the stored one)")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Recost every layer and sales line, needed to change the method")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        engine = CostingEngine(conn)
+        is_new = engine.create_tables(backfill=False)
+        change = args.method is not None and args.method != engine.method
+        if change and not (is_new or args.rebuild):
+            raise SystemExit(f"Inventory is costed by {engine.method} cost; "
+                             f"pass --rebuild to recost everything by {args.method} cost")
+        if change:
+            lines = engine.change_method(args.method)
+        elif args.rebuild:
+            lines = engine.backfill_sales_costs(recost=True)
+        else:
+            engine.rebuild()
+            lines = engine.backfill_sales_costs()
+        if lines:
+            # Margin rollups read the backfilled costs
+            rollups = RollupStore(conn, engine.schema)
+            if not rollups.create_tables():
+                rollups.rebuild()
+            print(f"Backfilled unit costs of {lines} sales lines")
+        print(f"Inventory value by {engine.method} cost: {engine.inventory_value():.2f}, "
+              f"cost of goods issued: {engine.cogs_total():.2f}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import csv
+import os
+import sqlite3
+
+from costing import CostingEngine
+from erp_schema import ERP_SCHEMA, SIMPLE_SCHEMA, detect_schema, profile
+from expenses import ExpenseLedger
+from stock_levels import StockLevels
+
+
+IMPORT_TYPES = ('customers', 'products', 'inventory', 'expenses')
+
+# Accepted CSV headers for each imported field
+CUSTOMER_COLUMNS = {
+    'customer_code': ['customer_code', 'code', 'customer_id', 'id'],
+    'customer_name': ['customer_name', 'name', 'customer'],
+    'phone': ['phone', 'telephone', 'tel', 'mobile'],
+    'address': ['address', 'addr', 'location'],
+    'email': ['email', 'e-mail', 'mail'],
+}
+
+PRODUCT_COLUMNS = {
+    'product_code': ['product_code', 'code', 'product_id', 'id', 'item_code'],
+    'product_name': ['product_name', 'name', 'product', 'item_name', 'item'],
+    'category': ['category', 'cattegory', 'group'],
+    'unit': ['unit_of_measure', 'unit', 'uom', 'measure', 'quantitee'],
+    'purchase_price': ['purchase_price', 'cost', 'buy_price', 'purchase'],
+    'sale_price': ['selling_price', 'sale_price', 'price', 'sell_price'],
+    'minimum_limit': ['minimum_limit', 'min_limit', 'minimum', 'min', 'min_stock'],
+}
+
+INVENTORY_COLUMNS = {
+    'product_code': ['product_code', 'code', 'product_id', 'item_code'],
+    'movement': ['movement', 'type', 'movement_type', 'direction'],
+    'quantity': ['quantity', 'qty', 'amount'],
+    'reference': ['reference', 'ref', 'note', 'remarks'],
+}
+
+OUTGOING_NAMES = ('out', 'exit', 'issue', 'sale', 'outgoing', 'output')
+
+# Tables written by a full data export, keyed by sheet name
+EXPORT_TABLES = {
+    ERP_SCHEMA: {
+        'Customers': 'customers',
+        'Suppliers': 'suppliers',
+        'Products': 'products',
+        'Sales': 'sales',
+        'Sales_Details': 'sales_details',
+        'Purchases': 'purchases',
+        'Inventory': 'inventory',
+    },
+    SIMPLE_SCHEMA: {
+        'Customers': 'customers',
+        'Products': 'products',
+        'Sales': 'sales',
+        'Sales_Details': 'sales_details',
+        'Inventory': 'inventory',
+        'Expenses': 'expenses',
+    },
+}
+
+
+def read_csv(file_path):
+    """Read a CSV file into header-keyed dicts"""
+    try:
+        with open(file_path, newline='', encoding='utf-8-sig') as file:
+            return list(csv.DictReader(file))
+    except UnicodeDecodeError:
+        # Spreadsheet exports are often not UTF-8
+        with open(file_path, newline='', encoding='latin-1') as file:
+            return list(csv.DictReader(file))
+
+
+def map_columns(records, column_mapping, required):
+    """Rename CSV headers to field names, checking the required fields are present"""
+    if not records:
+        raise ValueError("The CSV file is empty")
+
+    headers = {}
+    for header in records[0]:
+        if header is None:
+            continue
+        name = header.lower().strip()
+        for field, names in column_mapping.items():
+            if name in names and field not in headers.values():
+                headers[header] = field
+                break
+
+    missing = [field for field in required if field not in headers.values()]
+    if missing:
+        accepted = "\n".join(f"- {', '.join(column_mapping[field])}" for field in missing)
+        raise ValueError(f"CSV must contain {' and '.join(repr(field) for field in missing)} "
+                         f"columns.\n\nAccepted column names:\n{accepted}")
+
+    return [{field: (record.get(header) or '').strip() for header, field in headers.items()}
+            for record in records]
+
+
+class CsvImporter:
+    def __init__(self, conn, schema=None, stock_levels=None, costing=None, expenses=None):
+        self.conn = conn
+        self.schema = schema or detect_schema(conn)
+        self.profile = profile(self.schema)
+        self.stock_levels = stock_levels or StockLevels(conn, self.schema)
+        self.costing = costing or CostingEngine(conn, self.schema)
+        self.expenses = expenses or ExpenseLedger(conn)
+
+    def import_file(self, data_type, file_path):
+        """Import a CSV file of one data type and return (imported, errors)"""
+        if data_type not in IMPORT_TYPES:
+            raise ValueError(f"Unknown import type: {data_type}")
+        records = read_csv(file_path)
+        if data_type == 'expenses':
+            return self.expenses.import_rows(records)
+        return getattr(self, f"import_{data_type}")(records)
+
+    def run_rows(self, rows, import_row, after=None):
+        """Import rows in one transaction, collecting per-row errors"""
+        imported = 0
+        errors = []
+        cursor = self.conn.cursor()
+        try:
+            for index, row in enumerate(rows):
+                try:
+                    import_row(cursor, row)
+                    imported += 1
+                except (ValueError, sqlite3.IntegrityError) as e:
+                    errors.append(f"Row {index + 2}: {str(e)}")
+            changes = after(cursor) if after else []
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        self.stock_levels.notify(changes)
+        return imported, errors
+
+    # ===== Customers =====
+
+    def import_customers(self, records):
+        """Insert or update customers"""
+        rows = map_columns(records, CUSTOMER_COLUMNS, ('customer_code', 'customer_name'))
+
+        def import_row(cursor, row):
+            if not row['customer_code'] or not row['customer_name']:
+                raise ValueError("Missing customer code or name")
+            cursor.execute('''
+                INSERT INTO customers (customer_code, customer_name, phone, address, email)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (customer_code) DO UPDATE SET
+                    customer_name = excluded.customer_name,
+                    phone = excluded.phone,
+                    address = excluded.address,
+                    email = excluded.email
+            ''', (row['customer_code'], row['customer_name'], row.get('phone', ''),
+                  row.get('address', ''), row.get('email', '')))
+
+        return self.run_rows(rows, import_row)
+
+    # ===== Products =====
+
+    def import_products(self, records):
+        """Insert or update products"""
+        # Simple schema product codes are assigned by the database
+        required = ('product_code', 'product_name') if self.schema == ERP_SCHEMA else ('product_name',)
+        rows = map_columns(records, PRODUCT_COLUMNS, required)
+        unit, sale_price = self.profile['unit'], self.profile['sale_price']
+        touched = []
+
+        def import_row(cursor, row):
+            product_code = row.get('product_code') or None
+            if not row['product_name'] or (product_code is None and self.schema == ERP_SCHEMA):
+                raise ValueError("Missing product code or name")
+            values = [row['product_name'], row.get('unit', ''),
+                      float(row.get('purchase_price') or 0), float(row.get('sale_price') or 0),
+                      int(float(row.get('minimum_limit') or 10))]
+            columns = ['product_name', unit, 'purchase_price', sale_price, 'minimum_limit']
+            if self.schema != ERP_SCHEMA:
+                columns.insert(0, 'Category')
+                values.insert(0, row.get('category', ''))
+
+            exists = False
+            if product_code is not None:
+                cursor.execute("SELECT 1 FROM products WHERE product_code = ?", (product_code,))
+                exists = cursor.fetchone() is not None
+            if exists:
+                cursor.execute(f'''
+                    UPDATE products SET {', '.join(f"{column} = ?" for column in columns)}
+                    WHERE product_code = ?
+                ''', values + [product_code])
+            else:
+                if product_code is not None:
+                    columns.insert(0, 'product_code')
+                    values.insert(0, product_code)
+                cursor.execute(f'''
+                    INSERT INTO products ({', '.join(columns)})
+                    VALUES ({', '.join('?' for _ in columns)})
+                ''', values)
+            touched.append(product_code if self.schema == ERP_SCHEMA else row['product_name'])
+
+        def after(cursor):
+            # Minimum limits may have changed
+            return self.stock_levels.evaluate(cursor, touched)
+
+        return self.run_rows(rows, import_row, after)
+
+    # ===== Inventory =====
+
+    def import_inventory(self, records):
+        """Insert inventory movements, updating balances and valuation"""
+        rows = map_columns(records, INVENTORY_COLUMNS, ('product_code', 'quantity'))
+        key = self.profile['inventory_key']
+        movements = []
+
+        def import_row(cursor, row):
+            product_code = row['product_code']
+            quantity = int(float(row['quantity'] or 0))
+            movement = row.get('movement', '').lower()
+            # Unknown movement types count as incoming
+            movement = 'out' if movement in OUTGOING_NAMES else 'in'
+            reference = row.get('reference') or 'CSV Import'
+
+            if not product_code or quantity <= 0:
+                raise ValueError("Invalid product code or quantity")
+
+            cursor.execute(f"SELECT {key} FROM products WHERE product_code = ?", (product_code,))
+            product = cursor.fetchone()
+            if not product:
+                raise ValueError(f"Product {product_code} not found")
+
+            cursor.execute(f'''
+                INSERT INTO inventory ({key}, movement, quantity, reference)
+                VALUES (?, ?, ?, ?)
+            ''', (product[0], movement, quantity, reference))
+            self.costing.apply_movement(cursor, product[0], movement, quantity, reference=reference)
+            movements.append((product[0], movement, quantity))
+
+        def after(cursor):
+            # Only products touched by this import are re-checked
+            return self.stock_levels.apply_movements(cursor, movements)
+
+        return self.run_rows(rows, import_row, after)
+
+
+# ===== Export =====
+
+def iter_rows(conn, query, batch_size=5000):
+    """Yield a query's rows in batches"""
+    cursor = conn.execute(query)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def export_tables(conn, tables, path):
+    """Write tables to an Excel workbook, or to one CSV file per table in a folder"""
+    counts = {}
+    if path.lower().endswith('.xlsx'):
+        from openpyxl import Workbook
+
+        # Write-only workbooks stream rows to disk instead of keeping them in memory
+        workbook = Workbook(write_only=True)
+        for sheet_name, table in tables.items():
+            sheet = workbook.create_sheet(sheet_name)
+            cursor = conn.execute(f"SELECT * FROM {table} LIMIT 0")
+            sheet.append([column[0] for column in cursor.description])
+            counts[sheet_name] = 0
+            for rows in iter_rows(conn, f"SELECT * FROM {table}"):
+                for row in rows:
+                    sheet.append(list(row))
+                counts[sheet_name] += len(rows)
+        workbook.save(path)
+        return counts
+
+    os.makedirs(path, exist_ok=True)
+    for sheet_name, table in tables.items():
+        with open(os.path.join(path, f"{sheet_name}.csv"), 'w', newline='', encoding='utf-8') as file:
+            counts[sheet_name] = export_table(conn, table, file)
+    return counts
+
+
+def export_table(conn, table, file):
+    """Write one table as CSV to an open file and return the row count"""
+    writer = csv.writer(file)
+    cursor = conn.execute(f"SELECT * FROM {table} LIMIT 0")
+    writer.writerow([column[0] for column in cursor.description])
+    count = 0
+    for rows in iter_rows(conn, f"SELECT * FROM {table}"):
+        writer.writerows(rows)
+        count += len(rows)
+    return count
+
+
+# ===== Backup =====
+
+def backup_database(conn, target_path, pages=-1, progress=None):
+    """Copy a consistent snapshot of an open database to a file, pages at a time if given"""
+    target = sqlite3.connect(target_path)
+    try:
+        conn.backup(target, pages=pages, progress=progress)
+    finally:
+        target.close()
+    return target_path
@@ -0,0 +1,72 @@
+import os
+import pathlib
+import sqlite3
+
+
+MEMORY = ':memory:'
+
+FILE = 'file'
+# A new empty database that lives as long as the connection
+IN_MEMORY = 'memory'
+# The file opened with mode=ro, other connections can still write to it
+READ_ONLY = 'readonly'
+# Read-only without any locking, only safe while nothing writes to the file
+IMMUTABLE = 'immutable'
+# The file copied into memory with the backup API, changes are not saved
+SNAPSHOT = 'snapshot'
+
+MODES = (FILE, IN_MEMORY, READ_ONLY, IMMUTABLE, SNAPSHOT)
+READ_ONLY_MODES = (READ_ONLY, IMMUTABLE)
+
+# Pages copied per backup step while loading a snapshot
+SNAPSHOT_PAGES = 4096
+
+
+def is_read_only(mode):
+    """Check whether a mode refuses writes"""
+    return mode in READ_ONLY_MODES
+
+
+def file_uri(path, **query):
+    """Get a file: URI for a database path with query parameters"""
+    uri = pathlib.Path(path).resolve().as_uri()
+    if query:
+        uri += '?' + '&'.join(f"{key}={value}" for key, value in query.items())
+    return uri
+
+
+def target_from_env(default_path):
+    """Get (path, mode) from $ERP_DATABASE and $ERP_DATABASE_MODE"""
+    mode = os.environ.get('ERP_DATABASE_MODE', FILE)
+    if mode not in MODES:
+        raise ValueError(f"Unknown database mode: {mode} (expected one of {', '.join(MODES)})")
+    return os.environ.get('ERP_DATABASE', default_path), mode
+
+
+def open_target(path, mode=FILE, **kwargs):
+    """Open a database file, a read-only view of it, a snapshot of it in memory or an empty in-memory database"""
+    if mode not in MODES:
+        raise ValueError(f"Unknown database mode: {mode}")
+    if mode == IN_MEMORY or path == MEMORY:
+        return sqlite3.connect(MEMORY, **kwargs)
+    if mode == FILE:
+        return sqlite3.connect(path, **kwargs)
+
+    # mode=ro would fail with a vague "unable to open database file"
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Database not found: {path}")
+    if mode == READ_ONLY:
+        return sqlite3.connect(file_uri(path, mode='ro'), uri=True, **kwargs)
+    if mode == IMMUTABLE:
+        return sqlite3.connect(file_uri(path, mode='ro', immutable=1), uri=True, **kwargs)
+
+    conn = sqlite3.connect(MEMORY, **kwargs)
+    source = sqlite3.connect(file_uri(path, mode='ro'), uri=True)
+    try:
+        source.backup(conn, pages=SNAPSHOT_PAGES)
+    except sqlite3.Error:
+        conn.close()
+        raise
+    finally:
+        source.close()
+    return conn
@@ -0,0 +1,535 @@
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tkinter as tk
+import traceback
+import tracemalloc
+from collections import deque
+from tkinter import ttk, messagebox, filedialog
+
+from erp_logging import json_file_logger
+from query_stats import BUCKETS_MS
+
+
+DEFAULT_INTERVAL_MS = 100
+DEFAULT_STALL_MS = 250
+STALL_LOG_SIZE = 200
+# Size of the stall log file before it rolls over, and rolled files kept
+STALL_LOG_BYTES = 1024 * 1024
+STALL_LOG_BACKUPS = 3
+# Heartbeat lags kept for the percentiles
+LAG_SAMPLES = 3000
+# Stack samples kept per stall and frames kept per sample
+MAX_STACK_SAMPLES = 50
+STACK_DEPTH = 25
+
+DEFAULT_CAPTURE_DIR = 'diagnostics'
+# Frames kept per allocation traceback and lines written per report
+MEMORY_FRAMES = 10
+REPORT_LINES = 50
+
+
+def callback_name(func, widget=None):
+    """Get a readable name for a Tk callback"""
+    code = getattr(func, '__code__', None)
+    if code is not None and code.co_name == 'callit' and 'func' in code.co_freevars:
+        # after() wraps the timer function in a closure
+        func = func.__closure__[code.co_freevars.index('func')].cell_contents
+    name = getattr(func, '__qualname__', None) or type(func).__name__
+    if '<lambda>' in name and widget is not None:
+        # Name lambdas after the button that holds them
+        try:
+            text = widget.cget('text')
+        except (tk.TclError, AttributeError):
+            text = ''
+        if text:
+            name = f"{name} [{text}]"
+    return name
+
+
+def own_frame(stat):
+    """Check an allocation statistic is not from tracemalloc or the import system"""
+    filename = stat.traceback[0].filename
+    return filename != tracemalloc.__file__ and not filename.startswith('<frozen importlib')
+
+
+def write_json(data, parent):
+    """Ask for a file name and save data as JSON"""
+    file_path = filedialog.asksaveasfilename(parent=parent, defaultextension=".json",
+                                             filetypes=[("JSON files", "*.json")])
+    if not file_path:
+        return
+    try:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        messagebox.showinfo("Success", f"Diagnostics exported to:\n{file_path}", parent=parent)
+    except OSError as e:
+        messagebox.showerror("Error", f"Export failed: {str(e)}", parent=parent)
+
+
+# ===== Main Loop Watchdog =====
+
+class MainLoopWatchdog:
+    def __init__(self, root, interval_ms=DEFAULT_INTERVAL_MS, threshold_ms=DEFAULT_STALL_MS,
+                 log_path=None, log_size=STALL_LOG_SIZE):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.threshold_ms = threshold_ms
+        self.log_path = log_path
+        self.stall_log = json_file_logger('erp.diagnostics.stalls', log_path, STALL_LOG_BYTES,
+                                          STALL_LOG_BACKUPS) if log_path else None
+        self.stalls = deque(maxlen=log_size)
+        self.lags = deque(maxlen=LAG_SAMPLES)
+        self.beats = 0
+        self.stall_count = 0
+        self.max_lag_ms = 0.0
+        # Callbacks running on the main thread, outermost first
+        self.actions = []
+        # Slowest callback since the last heartbeat, as ((func, widget), seconds)
+        self.longest = None
+        self.samples = []
+        self.expected = None
+        self.main_ident = threading.get_ident()
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.after_id = None
+        self.original_wrapper = None
+
+    def start(self):
+        """Time Tk callbacks and start the heartbeat and the sampling thread"""
+        if self.running:
+            return self
+        self.running = True
+        # Only callbacks registered from now on are timed, so start before building the UI
+        self.original_wrapper = tk.CallWrapper
+        tk.CallWrapper = self.wrapper_class()
+        self.after_id = self.root.after(self.interval_ms, self.beat)
+        self.thread = threading.Thread(target=self.sample_loop, name='tk-watchdog', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the heartbeat and the sampling thread"""
+        if not self.running:
+            return
+        self.running = False
+        tk.CallWrapper = self.original_wrapper
+        try:
+            self.root.after_cancel(self.after_id)
+        except tk.TclError:
+            pass
+        self.thread.join()
+
+    def wrapper_class(self):
+        watchdog = self
+
+        class TimedCallWrapper(self.original_wrapper):
+            def __call__(self, *args):
+                action = (self.func, self.widget)
+                watchdog.actions.append(action)
+                start = time.perf_counter()
+                try:
+                    return super().__call__(*args)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    watchdog.actions.pop()
+                    if watchdog.longest is None or elapsed > watchdog.longest[1]:
+                        watchdog.longest = (action, elapsed)
+
+        return TimedCallWrapper
+
+    def beat(self):
+        """Measure how late the heartbeat ran and record a stall when it is too late"""
+        # The first heartbeat only arms the watchdog, building the UI is not a stall
+        if self.expected is not None:
+            lag_ms = max(0.0, (time.perf_counter() - self.expected) * 1000)
+            with self.lock:
+                samples, self.samples = self.samples, []
+                self.beats += 1
+                self.lags.append(lag_ms)
+                self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            if lag_ms >= self.threshold_ms:
+                self.record_stall(lag_ms, samples)
+        self.longest = None
+        if self.running:
+            self.expected = time.perf_counter() + self.interval_ms / 1000
+            self.after_id = self.root.after(self.interval_ms, self.beat)
+
+    def sample_loop(self):
+        """Take stack samples of the main thread while it is stalled"""
+        period = self.interval_ms / 2000
+        while self.running:
+            time.sleep(period)
+            expected = self.expected
+            if expected is None or time.perf_counter() - expected < self.threshold_ms / 1000:
+                continue
+            frame = sys._current_frames().get(self.main_ident)
+            if frame is None:
+                continue
+            stack = tuple(f"{os.path.basename(entry.filename)}:{entry.lineno} in {entry.name}"
+                          for entry in traceback.extract_stack(frame)[-STACK_DEPTH:])
+            del frame
+            # Widgets are only named later on the main thread, Tk is not thread-safe
+            actions = list(self.actions)
+            with self.lock:
+                if len(self.samples) < MAX_STACK_SAMPLES:
+                    self.samples.append((stack, actions[0] if actions else None))
+
+    def record_stall(self, lag_ms, samples):
+        # The action running while the main thread was sampled caused the stall,
+        # otherwise the slowest callback that finished since the last heartbeat
+        action = next((sampled for _, sampled in samples if sampled is not None), None)
+        if action is None and self.longest is not None and self.longest[1] * 1000 >= self.threshold_ms:
+            action = self.longest[0]
+        stacks = {}
+        for stack, _ in samples:
+            stacks[stack] = stacks.get(stack, 0) + 1
+        entry = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'ms': round(lag_ms, 1),
+            'action': callback_name(*action) if action is not None else "(Tk event processing)",
+            'samples': [{'count': count, 'stack': list(stack)}
+                        for stack, count in sorted(stacks.items(), key=lambda item: -item[1])],
+        }
+        with self.lock:
+            self.stall_count += 1
+            self.stalls.append(entry)
+        if self.stall_log:
+            self.stall_log.info("Main loop stalled for %.0f ms in %s", lag_ms, entry['action'], extra=entry)
+
+    def reset(self):
+        """Forget lags and stalls"""
+        with self.lock:
+            self.stalls.clear()
+            self.lags.clear()
+            self.beats = 0
+            self.stall_count = 0
+            self.max_lag_ms = 0.0
+            self.started = time.time()
+
+    def to_dict(self):
+        """Get heartbeat lag statistics and the stall log"""
+        with self.lock:
+            lags = sorted(self.lags)
+            stalls = list(self.stalls)
+            beats, stall_count, max_lag = self.beats, self.stall_count, self.max_lag_ms
+        return {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'exported': datetime.datetime.now().isoformat(timespec='seconds'),
+            'interval_ms': self.interval_ms,
+            'threshold_ms': self.threshold_ms,
+            'beats': beats,
+            'lag_p50_ms': round(lags[int(len(lags) * 0.50)], 1) if lags else 0.0,
+            'lag_p95_ms': round(lags[min(len(lags) - 1, int(len(lags) * 0.95))], 1) if lags else 0.0,
+            'lag_max_ms': round(max_lag, 1),
+            'stall_count': stall_count,
+            'stalls': stalls,
+        }
+
+
+# ===== Profiling Captures =====
+
+class ProfileCapture:
+    def __init__(self, base_dir=DEFAULT_CAPTURE_DIR):
+        self.base_dir = base_dir
+        self.profiler = None
+        self.profile_started = None
+        self.memory_start = None
+        self.memory_started = None
+        self.memory_owned = False
+
+    def capture_dir(self, kind, started):
+        """Create the timestamped folder a capture is written to"""
+        folder = os.path.join(self.base_dir, f"{started.strftime('%Y%m%d_%H%M%S')}_{kind}")
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def start_profile(self):
+        """Start profiling the main thread with cProfile"""
+        if self.profiler is not None:
+            return
+        profiler = cProfile.Profile()
+        # Raises ValueError when another profiler is already active
+        profiler.enable()
+        self.profiler = profiler
+        self.profile_started = datetime.datetime.now()
+
+    def stop_profile(self):
+        """Stop profiling and write the .pstats file with text summaries, return the folder"""
+        if self.profiler is None:
+            return None
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+        folder = self.capture_dir('profile', self.profile_started)
+        profiler.dump_stats(os.path.join(folder, 'profile.pstats'))
+        with open(os.path.join(folder, 'summary.txt'), 'w', encoding='utf-8') as f:
+            f.write(f"Profiled from {self.profile_started:%Y-%m-%d %H:%M:%S} "
+                    f"to {datetime.datetime.now():%Y-%m-%d %H:%M:%S}\n\n")
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+            stats.sort_stats('tottime').print_stats(REPORT_LINES)
+        return folder
+
+    def start_memory(self):
+        """Start tracing allocations and take the baseline snapshot"""
+        if self.memory_start is not None:
+            return
+        # Tracing may already be on from PYTHONTRACEMALLOC, leave it running then
+        self.memory_owned = not tracemalloc.is_tracing()
+        if self.memory_owned:
+            tracemalloc.start(MEMORY_FRAMES)
+        tracemalloc.reset_peak()
+        self.memory_start = tracemalloc.take_snapshot()
+        self.memory_started = datetime.datetime.now()
+
+    def stop_memory(self):
+        """Write the top allocations and the growth since start, return the folder"""
+        if self.memory_start is None:
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        start, self.memory_start = self.memory_start, None
+        if self.memory_owned:
+            tracemalloc.stop()
+        folder = self.capture_dir('memory', self.memory_started)
+        snapshot.dump(os.path.join(folder, 'memory.snapshot'))
+        with open(os.path.join(folder, 'allocations.txt'), 'w', encoding='utf-8') as f:
+            f.write(f"Traced from {self.memory_started:%Y-%m-%d %H:%M:%S} "
+                    f"to {datetime.datetime.now():%Y-%m-%d %H:%M:%S}\n")
+            f.write(f"Traced memory: {current / 1024:.1f} KiB now, {peak / 1024:.1f} KiB peak\n\n")
+            f.write(f"Growth since start, top {REPORT_LINES}:\n")
+            for diff in [diff for diff in snapshot.compare_to(start, 'lineno') if own_frame(diff)][:REPORT_LINES]:
+                f.write(f"  {diff}\n")
+            f.write(f"\nLargest allocations, top {REPORT_LINES}:\n")
+            for stat in [stat for stat in snapshot.statistics('lineno') if own_frame(stat)][:REPORT_LINES]:
+                f.write(f"  {stat}\n")
+            f.write("\nLargest allocation tracebacks, top 10:\n")
+            for stat in [stat for stat in snapshot.statistics('traceback') if own_frame(stat)][:10]:
+                f.write(f"\n  {stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+                for line in stat.traceback.format():
+                    f.write(f"    {line}\n")
+        return folder
+
+
+# ===== Query Statistics Window =====
+
+class QueryStatsWindow:
+    SHAPE_COLUMNS = (('Count', 70), ('Total ms', 90), ('Mean ms', 80), ('p95 ms', 80),
+                     ('Max ms', 80), ('Rows', 80), ('Statement', 520))
+    SLOW_COLUMNS = (('Time', 150), ('ms', 80), ('Rows', 70), ('Call Site', 220), ('Statement', 480))
+
+    def __init__(self, parent, stats):
+        self.stats = stats
+        self.data = None
+        self.window = tk.Toplevel(parent)
+        self.window.title("Query Statistics")
+        self.window.geometry("1050x650")
+        self.window.transient(parent)
+
+        toolbar = tk.Frame(self.window)
+        toolbar.pack(fill='x', padx=10, pady=5)
+        tk.Button(toolbar, text="Refresh", command=self.refresh).pack(side='left', padx=2)
+        tk.Button(toolbar, text="Reset", command=self.reset).pack(side='left', padx=2)
+        tk.Button(toolbar, text="Export JSON", command=self.export).pack(side='left', padx=2)
+        self.enabled_var = tk.BooleanVar(value=stats.enabled)
+        tk.Checkbutton(toolbar, text="Record", variable=self.enabled_var,
+                       command=self.toggle).pack(side='left', padx=10)
+        tk.Label(toolbar, text="Slow from (ms):").pack(side='left')
+        self.threshold_var = tk.StringVar(value=str(stats.threshold_ms))
+        threshold_entry = tk.Entry(toolbar, textvariable=self.threshold_var, width=8)
+        threshold_entry.pack(side='left', padx=2)
+        threshold_entry.bind('<Return>', lambda e: self.set_threshold())
+        tk.Button(toolbar, text="Apply", command=self.set_threshold).pack(side='left', padx=2)
+        self.summary_label = tk.Label(toolbar, text="", fg='gray')
+        self.summary_label.pack(side='right')
+
+        notebook = ttk.Notebook(self.window)
+        notebook.pack(fill='both', expand=True, padx=10, pady=5)
+
+        # Statement shapes, costliest first
+        shapes_frame = tk.Frame(notebook)
+        notebook.add(shapes_frame, text="Statements")
+        self.shapes_tree = self.make_tree(shapes_frame, self.SHAPE_COLUMNS, height=14)
+        self.shapes_tree.bind('<<TreeviewSelect>>', lambda e: self.show_shape())
+        self.shape_text = self.make_text(shapes_frame)
+
+        # Slow statements, latest first
+        slow_frame = tk.Frame(notebook)
+        notebook.add(slow_frame, text="Slow Log")
+        self.slow_tree = self.make_tree(slow_frame, self.SLOW_COLUMNS, height=12)
+        self.slow_tree.bind('<<TreeviewSelect>>', lambda e: self.show_slow())
+        self.slow_text = self.make_text(slow_frame)
+
+        self.refresh()
+
+    def make_tree(self, parent, columns, height):
+        frame = tk.Frame(parent)
+        frame.pack(fill='both', expand=True)
+        tree = ttk.Treeview(frame, columns=[title for title, _ in columns], show='headings', height=height)
+        for title, width in columns:
+            tree.heading(title, text=title)
+            tree.column(title, width=width, anchor='w' if title in ('Statement', 'Call Site', 'Time') else 'e')
+        scrollbar = ttk.Scrollbar(frame, orient='vertical', command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side='left', fill='both', expand=True)
+        scrollbar.pack(side='right', fill='y')
+        return tree
+
+    def make_text(self, parent):
+        text = tk.Text(parent, height=10, font=('Courier', 9), wrap='word')
+        text.pack(fill='x', pady=(5, 0))
+        return text
+
+    def set_text(self, text, content):
+        text.delete('1.0', tk.END)
+        text.insert('1.0', content)
+
+    def refresh(self):
+        """Reload statistics from the collector"""
+        self.data = self.stats.to_dict()
+        self.shapes_tree.delete(*self.shapes_tree.get_children())
+        for i, item in enumerate(self.data['shapes']):
+            self.shapes_tree.insert('', 'end', iid=str(i), values=(
+                item['count'], f"{item['total_ms']:.1f}", f"{item['mean_ms']:.2f}", item['p95_ms'],
+                f"{item['max_ms']:.1f}", item['rows'], item['shape']))
+        self.slow_tree.delete(*self.slow_tree.get_children())
+        for i, entry in reversed(list(enumerate(self.data['slow']))):
+            self.slow_tree.insert('', 'end', iid=str(i), values=(
+                entry['time'], f"{entry['ms']:.1f}", entry['rows'], entry['site'], ' '.join(entry['sql'].split())))
+        self.set_text(self.shape_text, "")
+        self.set_text(self.slow_text, "")
+        self.summary_label.config(text=f"{self.data['statements']} statements, {len(self.data['shapes'])} shapes, "
+                                       f"{len(self.data['slow'])} slow since {self.data['started']}")
+
+    def show_shape(self):
+        selection = self.shapes_tree.selection()
+        if not selection:
+            return
+        item = self.data['shapes'][int(selection[0])]
+        bounds = [f"<{bound}" for bound in BUCKETS_MS] + [f">={BUCKETS_MS[-1]}"]
+        histogram = "  ".join(f"{bound}: {count}" for bound, count in zip(bounds, item['histogram']) if count)
+        sites = "\n".join(f"  {count:>6} x {site}" for site, count in item['sites'].items())
+        self.set_text(self.shape_text,
+                      f"{item['shape']}\n\nLatency (ms): {histogram}\n"
+                      f"p50 {item['p50_ms']}  p95 {item['p95_ms']}  p99 {item['p99_ms']}\n\n"
+                      f"Called from:\n{sites}\n")
+
+    def show_slow(self):
+        selection = self.slow_tree.selection()
+        if not selection:
+            return
+        entry = self.data['slow'][int(selection[0])]
+        plan = "\n".join(f"  {line}" for line in entry['plan']) or "  (no plan for this statement)"
+        self.set_text(self.slow_text,
+                      f"{entry['ms']:.1f} ms, {entry['rows']} rows at {entry['site']}\n\n"
+                      f"{entry['sql']}\n\nQuery plan:\n{plan}\n")
+
+    def reset(self):
+        self.stats.reset()
+        self.refresh()
+
+    def toggle(self):
+        self.stats.enabled = self.enabled_var.get()
+
+    def set_threshold(self):
+        try:
+            threshold = float(self.threshold_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "Threshold must be a number of milliseconds", parent=self.window)
+            return
+        self.stats.threshold_ms = threshold
+
+    def export(self):
+        """Save the statistics and slow log as JSON"""
+        write_json(self.stats.to_dict(), self.window)
+
+
+# ===== Responsiveness Window =====
+
+class WatchdogWindow:
+    STALL_COLUMNS = (('Time', 150), ('Stalled ms', 90), ('Samples', 70), ('Action', 400))
+    REFRESH_MS = 1000
+
+    def __init__(self, parent, watchdog):
+        self.watchdog = watchdog
+        self.data = None
+        self.window = tk.Toplevel(parent)
+        self.window.title("Responsiveness")
+        self.window.geometry("900x600")
+        self.window.transient(parent)
+
+        toolbar = tk.Frame(self.window)
+        toolbar.pack(fill='x', padx=10, pady=5)
+        tk.Button(toolbar, text="Reset", command=self.reset).pack(side='left', padx=2)
+        tk.Button(toolbar, text="Export JSON", command=self.export).pack(side='left', padx=2)
+        self.summary_label = tk.Label(toolbar, text="", font=('Arial', 10))
+        self.summary_label.pack(side='right')
+
+        frame = tk.Frame(self.window)
+        frame.pack(fill='both', expand=True, padx=10)
+        self.stall_tree = ttk.Treeview(frame, columns=[title for title, _ in self.STALL_COLUMNS],
+                                       show='headings', height=12)
+        for title, width in self.STALL_COLUMNS:
+            self.stall_tree.heading(title, text=title)
+            self.stall_tree.column(title, width=width, anchor='w' if title in ('Time', 'Action') else 'e')
+        scrollbar = ttk.Scrollbar(frame, orient='vertical', command=self.stall_tree.yview)
+        self.stall_tree.configure(yscrollcommand=scrollbar.set)
+        self.stall_tree.pack(side='left', fill='both', expand=True)
+        scrollbar.pack(side='right', fill='y')
+        self.stall_tree.bind('<<TreeviewSelect>>', lambda e: self.show_stall())
+
+        self.stack_text = tk.Text(self.window, height=14, font=('Courier', 9), wrap='none')
+        self.stack_text.pack(fill='x', padx=10, pady=5)
+
+        self.refresh()
+
+    def refresh(self):
+        """Reload the stall log, then again every second while the window is open"""
+        if not self.window.winfo_exists():
+            return
+        data = self.watchdog.to_dict()
+        self.summary_label.config(text=f"Heartbeat lag p50 {data['lag_p50_ms']} ms, p95 {data['lag_p95_ms']} ms, "
+                                       f"max {data['lag_max_ms']} ms, {data['stall_count']} stalls "
+                                       f"over {data['threshold_ms']} ms")
+        if self.data is None or data['stalls'] != self.data['stalls']:
+            selection = self.stall_tree.selection()
+            self.stall_tree.delete(*self.stall_tree.get_children())
+            for i, entry in reversed(list(enumerate(data['stalls']))):
+                self.stall_tree.insert('', 'end', iid=str(i), values=(
+                    entry['time'], entry['ms'], sum(sample['count'] for sample in entry['samples']),
+                    entry['action']))
+            if selection and self.stall_tree.exists(selection[0]):
+                self.stall_tree.selection_set(selection[0])
+        self.data = data
+        self.window.after(self.REFRESH_MS, self.refresh)
+
+    def show_stall(self):
+        selection = self.stall_tree.selection()
+        if not selection:
+            return
+        entry = self.data['stalls'][int(selection[0])]
+        lines = [f"{entry['action']} stalled the main loop for {entry['ms']} ms", ""]
+        if not entry['samples']:
+            lines.append("(the stall ended before a stack sample was taken)")
+        for sample in entry['samples']:
+            lines.append(f"{sample['count']} sample(s):")
+            lines.extend(f"  {frame}" for frame in sample['stack'])
+            lines.append("")
+        self.stack_text.delete('1.0', tk.END)
+        self.stack_text.insert('1.0', "\n".join(lines))
+
+    def reset(self):
+        self.watchdog.reset()
+        self.data = None
+        self.stack_text.delete('1.0', tk.END)
+
+    def export(self):
+        """Save the lag statistics and stall log as JSON"""
+        write_json(self.watchdog.to_dict(), self.window)
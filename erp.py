@@ -0,0 +1,274 @@
+import argparse
+import os
+import sqlite3
+import sys
+
+from backups import (COMPRESSIONS, DEFAULT_COMPRESSION, DEFAULT_KEEP_DAILY, DEFAULT_KEEP_WEEKLY, backup_path,
+                     create_backup, prune_backups)
+from costing import CostingEngine
+from data_io import EXPORT_TABLES, IMPORT_TYPES, CsvImporter, export_table, export_tables
+from db_targets import FILE, MEMORY, MODES, is_read_only, open_target
+from erp_schema import ERP_SCHEMA, SIMPLE_SCHEMA, check_migrated, detect_schema, profile, table_exists
+from expenses import ExpenseLedger
+from forecasting import DemandForecaster
+from profit_loss import ProfitAndLoss
+from replenishment import ReplenishmentEngine
+from report_engine import PARAMETER_NAMES, ReportEngine, ReportOutput, output_for_path, reports_for
+from rollups import RollupStore
+from stock_levels import StockLevels
+
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+# Some imported rows were rejected, the rest were committed
+EXIT_PARTIAL = 3
+
+DEFAULT_DATABASE = profile(SIMPLE_SCHEMA)['db_file']
+
+
+class ErpServices:
+    def __init__(self, conn, schema=None):
+        self.conn = conn
+        self.schema = schema or detect_schema(conn)
+        self.rollups = RollupStore(conn, self.schema)
+        self.stock_levels = StockLevels(conn, self.schema)
+        self.costing = CostingEngine(conn, self.schema)
+        self.expenses = ExpenseLedger(conn)
+        self.profit_loss = ProfitAndLoss(conn)
+        self.forecaster = None
+        self.replenishment = None
+
+    def create_tables(self):
+        """Create the derived tables the desktop apps maintain, in the same order"""
+        self.rollups.create_tables()
+        self.stock_levels.create_tables()
+        self.costing.create_tables()
+        if self.costing.backfill_sales_costs():
+            self.rollups.rebuild()
+
+        if self.schema == ERP_SCHEMA:
+            self.forecaster = DemandForecaster(self.conn)
+            self.forecaster.create_tables()
+            self.replenishment = ReplenishmentEngine(self.conn)
+            self.replenishment.create_tables()
+        else:
+            self.expenses.create_tables()
+        self.profit_loss.create_indexes()
+
+    def importer(self):
+        """Get a CSV importer sharing these services"""
+        return CsvImporter(self.conn, self.schema, self.stock_levels, self.costing, self.expenses)
+
+    def report_engine(self):
+        """Get a report engine for the schema"""
+        # One-shot runs gain nothing from the result cache
+        return ReportEngine(self.conn, self.schema)
+
+
+def open_database(path, mode=FILE):
+    """Open an existing application database with its services"""
+    if path != MEMORY and not os.path.exists(path):
+        raise FileNotFoundError(f"Database not found: {path}")
+    conn = open_target(path, mode)
+    if not table_exists(conn, 'products'):
+        conn.close()
+        raise ValueError(f"{path} is not an ERP database; open it once in the desktop app first")
+    services = ErpServices(conn)
+    # A read-only database must already have the derived tables, their upkeep writes
+    if is_read_only(mode):
+        try:
+            check_migrated(conn, services.schema)
+        except ValueError:
+            conn.close()
+            raise
+    else:
+        services.create_tables()
+    return services
+
+
+class CountOutput(ReportOutput):
+    def write(self, rows):
+        """Discard rows, only the count is kept"""
+
+
+def error(message):
+    """Print a message to standard error"""
+    print(message, file=sys.stderr, flush=True)
+
+
+# ===== Commands =====
+
+def cmd_import(services, args):
+    """Import a CSV file"""
+    imported, errors = services.importer().import_file(args.type, args.file)
+    for message in errors:
+        error(message)
+    print(f"Imported {imported} {args.type} rows, {len(errors)} rejected")
+    return EXIT_PARTIAL if errors else EXIT_OK
+
+
+def cmd_export(services, args):
+    """Export tables to a workbook, a folder of CSV files or standard output"""
+    tables = EXPORT_TABLES[services.schema]
+    if args.table:
+        tables = {name: table for name, table in tables.items() if table in args.table}
+        missing = set(args.table) - set(tables.values())
+        if missing:
+            error(f"Unknown table: {', '.join(sorted(missing))}")
+            return EXIT_ERROR
+
+    if args.path == '-':
+        if len(tables) != 1:
+            error("Exporting to standard output needs exactly one --table")
+            return EXIT_ERROR
+        export_table(services.conn, next(iter(tables.values())), sys.stdout)
+        return EXIT_OK
+
+    counts = export_tables(services.conn, tables, args.path)
+    for name, count in counts.items():
+        print(f"{name}: {count} rows")
+    print(f"Exported to {args.path}")
+    return EXIT_OK
+
+
+def cmd_report(services, args):
+    """Run a report to standard output or a file"""
+    engine = services.report_engine()
+    if args.list or not args.report_id:
+        for report in reports_for(services.schema):
+            print(f"{report.report_id:<28}{report.title}")
+        return EXIT_OK
+
+    params = {name: getattr(args, name) for name in PARAMETER_NAMES}
+    if args.output == '-':
+        engine.run(args.report_id, output_for_path('-'), params, args.sort)
+    else:
+        count = engine.export(args.report_id, args.output, params, args.sort)
+        print(f"{count} rows written to {args.output}")
+    return EXIT_OK
+
+
+def cmd_backup(services, args):
+    """Write a verified snapshot of the database, pruning old ones when backing up to a folder"""
+    target = args.target or os.path.dirname(os.path.abspath(args.database))
+    if not os.path.isdir(target):
+        create_backup(services.conn, target, args.compress)
+        print(f"Backup created: {target}")
+        return EXIT_OK
+
+    path = create_backup(services.conn, backup_path(target, args.compress or DEFAULT_COMPRESSION))
+    print(f"Backup created: {path}")
+    if not args.no_prune:
+        removed = prune_backups(target, args.keep_daily, args.keep_weekly)
+        print(f"Removed {len(removed)} old backups")
+    return EXIT_OK
+
+
+def cmd_rebuild_balances(services, args):
+    """Rebuild stock balances, alerts and valuation from the inventory movements"""
+    if args.all:
+        services.rollups.rebuild()
+        print("Sales rollups rebuilt")
+    services.stock_levels.rebuild()
+    counts = services.stock_levels.alert_counts()
+    print(f"Stock balances rebuilt: {sum(counts.values())} alerts")
+    services.costing.rebuild()
+    print(f"Inventory valuation rebuilt: {services.costing.inventory_value():.2f}")
+    return EXIT_OK
+
+
+def cmd_bench(services, args):
+    """Time every report of the schema"""
+    # The benchmark module builds on this one
+    from benchmark import measure, summarize
+
+    engine = services.report_engine()
+    reports = [report for report in reports_for(services.schema)
+               if not args.report or report.report_id in args.report]
+    print(f"{'report':<28}{'rows':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for report in reports:
+        result = summarize(*measure(lambda: engine.run(report.report_id, CountOutput()), args.repeat))
+        print(f"{report.report_id:<28}{result['rows']:>10}{result['p50_ms']:>10.1f}"
+              f"{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}", flush=True)
+    return EXIT_OK
+
+
+def build_parser():
+    """Build the command-line parser"""
+    parser = argparse.ArgumentParser(prog='erp', description="Batch operations on an ERP database")
+    parser.add_argument('-d', '--database', default=os.environ.get('ERP_DATABASE', DEFAULT_DATABASE),
+                        help=f"SQLite database file (default: $ERP_DATABASE or {DEFAULT_DATABASE})")
+    parser.add_argument('--mode', choices=MODES, default=os.environ.get('ERP_DATABASE_MODE', FILE),
+                        help="Open the file read-write, read-only, immutable, or as a snapshot in memory "
+                             "(default: $ERP_DATABASE_MODE or file)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('import', help="Import a CSV file")
+    command.add_argument('type', choices=IMPORT_TYPES)
+    command.add_argument('file', help="CSV file")
+    command.set_defaults(handler=cmd_import)
+
+    command = commands.add_parser('export', help="Export tables")
+    command.add_argument('path', help="Workbook (.xlsx), folder for CSV files, or - for standard output")
+    command.add_argument('--table', action='append', help="Table to export, repeatable (default: all)")
+    command.set_defaults(handler=cmd_export)
+
+    command = commands.add_parser('report', help="Run a report")
+    command.add_argument('report_id', nargs='?', help="Report to run")
+    command.add_argument('--list', action='store_true', help="List the reports of the database")
+    command.add_argument('--from', dest='date_from', help="First day (YYYY-MM-DD)")
+    command.add_argument('--to', dest='date_to', help="Last day (YYYY-MM-DD)")
+    command.add_argument('--customer', help="Customer code")
+    command.add_argument('--product', help="Product code")
+    command.add_argument('--status', help="Status filter")
+    command.add_argument('--sort', help="Sort columns, each optionally followed by ASC or DESC, separated by commas")
+    command.add_argument('-o', '--output', default='-',
+                         help="Output file (.csv, .xlsx, .parquet), default - for CSV on standard output")
+    command.set_defaults(handler=cmd_report)
+
+    command = commands.add_parser('backup', help="Back up the database")
+    command.add_argument('target', nargs='?',
+                         help="Backup file, or folder for erp_backup_<timestamp> files (default: the database folder)")
+    command.add_argument('--compress', choices=COMPRESSIONS,
+                         help=f"Compression (default: from the file name, {DEFAULT_COMPRESSION} in a folder)")
+    command.add_argument('--keep-daily', type=int, default=DEFAULT_KEEP_DAILY,
+                         help="Days whose last backup is kept in the folder")
+    command.add_argument('--keep-weekly', type=int, default=DEFAULT_KEEP_WEEKLY,
+                         help="Weeks whose last backup is kept in the folder")
+    command.add_argument('--no-prune', action='store_true', help="Keep every backup in the folder")
+    command.set_defaults(handler=cmd_backup)
+
+    command = commands.add_parser('rebuild-balances', help="Rebuild stock balances and valuation")
+    command.add_argument('--all', action='store_true', help="Also rebuild the sales rollups")
+    command.set_defaults(handler=cmd_rebuild_balances)
+
+    command = commands.add_parser('bench', help="Time the reports")
+    command.add_argument('--report', action='append', help="Report to time, repeatable (default: all)")
+    command.add_argument('--repeat', type=int, default=5, help="Runs per report")
+    command.set_defaults(handler=cmd_bench)
+    return parser
+
+
+def main(argv=None):
+    """Run one command and return its exit code"""
+    args = build_parser().parse_args(argv)
+    try:
+        services = open_database(args.database, args.mode)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        error(str(e))
+        return EXIT_ERROR
+
+    try:
+        return args.handler(services, args)
+    except BrokenPipeError:
+        # Output piped into head and the like
+        return EXIT_OK
+    except (ImportError, OSError, ValueError, KeyError, sqlite3.Error) as e:
+        error(f"{args.command}: {e}")
+        return EXIT_ERROR
+    finally:
+        services.conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+import copy
+import datetime
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+DEFAULT_LEVEL = logging.INFO
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+
+# Attributes every LogRecord has, anything else was passed in extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def parse_levels(text):
+    """Parse 'erp.csv=DEBUG,erp.dashboard=WARNING' into {logger name: level}"""
+    levels = {}
+    for part in (text or '').split(','):
+        if not part.strip():
+            continue
+        name, _, level = part.partition('=')
+        level = level.strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Unknown log level for {name.strip()}: {level}")
+        levels[name.strip()] = level
+    return levels
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        """Format a record as one JSON object per line"""
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'thread': record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['error'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['error'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class ErrorCounter:
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, logger_name, error):
+        key = (('logger', logger_name), ('error', error))
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def snapshot(self):
+        """Get counts as {((label, value), ...): count}"""
+        with self.lock:
+            return dict(self.counts)
+
+
+# Counted whatever the log levels are, so silenced loggers still show in metrics
+swallowed_errors = ErrorCounter()
+
+
+def swallowed(logger, message, *args):
+    """Log and count an error handled by falling back, call from inside the except block"""
+    error = sys.exc_info()[0]
+    swallowed_errors.add(logger.name, error.__name__ if error else 'Error')
+    logger.warning(message, *args, exc_info=True, extra={'swallowed': True})
+
+
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Only merge the arguments on the calling thread, the listener formats tracebacks
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LogSession:
+    def __init__(self, listener, handler):
+        self.listener = listener
+        self.handler = handler
+
+    def stop(self):
+        """Write out queued records and detach the handler"""
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+
+def start_logging(path, levels=None, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS, console=True):
+    """Send log records through a queue to a rotating JSON log written on a listener thread"""
+    log_queue = queue.SimpleQueue()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler(sys.stderr)
+        console_handler.setLevel(logging.WARNING)
+        console_handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+        handlers.append(console_handler)
+
+    handler = DeferredQueueHandler(log_queue)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    # Other libraries only log warnings, the application logs from info up
+    root.setLevel(logging.WARNING)
+    logging.getLogger('erp').setLevel(DEFAULT_LEVEL)
+    for name, level in (levels or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return LogSession(listener, handler)
+
+
+def json_file_logger(name, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+    """Get a logger that writes its records to a rotating JSON log of its own"""
+    logger = logging.getLogger(name)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8', delay=True)
+    handler.setFormatter(JsonFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    # The entries are too large for the application log, which would repeat each one
+    logger.propagate = False
+    return logger
@@ -0,0 +1,98 @@
+import sqlite3
+
+
+# Schema used by ERPSystem.py (erp_system_english.db)
+ERP_SCHEMA = 'erp'
+# Schema used by erp_simple_english.py (erp_system.db)
+SIMPLE_SCHEMA = 'simple'
+
+SCHEMA_PROFILES = {
+    ERP_SCHEMA: {
+        'db_file': 'erp_system_english.db',
+        'sales_total': 'total_invoice',
+        'sale_price': 'sale_price',
+        'unit': 'unit_of_measure',
+        'inventory_key': 'product_code',
+    },
+    SIMPLE_SCHEMA: {
+        'db_file': 'erp_system.db',
+        'sales_total': 'invoice_total',
+        'sale_price': 'selling_price',
+        'unit': 'Quantitee',
+        'inventory_key': 'product_name',
+    },
+}
+
+# Tables and columns the application adds on top of the base schema, {table: new columns}
+DERIVED_TABLES = {
+    'sales_daily': ('cost',),
+    'sales_product_daily': ('cost',),
+    'purchases_daily': (),
+    'purchases_product_daily': (),
+    'stock_balances': (),
+    'stock_alerts': (),
+    'stock_reservations': (),
+    'inventory_valuation': (),
+    'cost_layers': (),
+    'sales_details': ('unit_cost',),
+}
+MIGRATIONS = {
+    ERP_SCHEMA: dict(DERIVED_TABLES, demand_forecasts=(), forecast_runs=('sales_rowid',), replenishment_plan=()),
+    SIMPLE_SCHEMA: dict(DERIVED_TABLES, expenses=('category', 'cost_center', 'attachment')),
+}
+
+
+def table_exists(conn, table):
+    """Check whether a table exists"""
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)
+    ).fetchone()
+    return row is not None
+
+
+def table_columns(conn, table):
+    """Get column names of a table"""
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def add_column(conn, table, column, definition):
+    """Add a column to an existing table if it is missing"""
+    if column in table_columns(conn, table):
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+def detect_schema(conn):
+    """Detect which application schema a database uses"""
+    try:
+        if 'Quantitee' in table_columns(conn, 'products'):
+            return SIMPLE_SCHEMA
+    except sqlite3.Error:
+        pass
+    return ERP_SCHEMA
+
+
+def profile(schema):
+    """Get column profile for a schema"""
+    return SCHEMA_PROFILES[schema]
+
+
+def missing_migrations(conn, schema):
+    """List the derived tables and columns a database does not have yet"""
+    missing = []
+    for table, columns in MIGRATIONS[schema].items():
+        if not table_exists(conn, table):
+            missing.append(table)
+            continue
+        present = table_columns(conn, table)
+        missing.extend(f"{table}.{column}" for column in columns if column not in present)
+    return missing
+
+
+def check_migrated(conn, schema):
+    """Refuse a database a read-only connection cannot use until it has been migrated"""
+    missing = missing_migrations(conn, schema)
+    if missing:
+        raise ValueError("The database must be opened read-write once to migrate it "
+                         f"(missing {', '.join(missing[:5])}{', ...' if len(missing) > 5 else ''})")
@@ -3,14 +3,37 @@ from tkinter import ttk, messagebox, filedialog
 import sqlite3
 import pandas as pd
 import datetime
+import logging
 import os
 from datetime import datetime as dt
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import seaborn as sns
 import warnings
+from backups import BackupJob
+from costing import CostingEngine
+from data_io import EXPORT_TABLES, CsvImporter, export_tables
+from db_targets import IN_MEMORY, SNAPSHOT, is_read_only, target_from_env
+from diagnostics import MainLoopWatchdog, ProfileCapture, QueryStatsWindow, WatchdogWindow
+from erp_logging import parse_levels, start_logging, swallowed, swallowed_errors
+from erp_schema import SIMPLE_SCHEMA, check_migrated
+from expenses import DEFAULT_CATEGORY, ExpenseLedger
+from profit_loss import MONTH, ProfitAndLoss
+from query_stats import QueryStats, connect
+from report_cache import ReportCache
+from report_engine import ReportEngine, TreeviewOutput, reports_for
+from rollups import RollupStore
+from sales import SalesLedger
+from stock_levels import LOW_STOCK, OUT_OF_STOCK, StockLevels
+from tracing import Tracer
 warnings.filterwarnings('ignore')
 
+db_log = logging.getLogger('erp.db')
+sales_log = logging.getLogger('erp.sales')
+inventory_log = logging.getLogger('erp.inventory')
+csv_log = logging.getLogger('erp.csv')
+dashboard_log = logging.getLogger('erp.dashboard')
+
 class ERPSystem:
     def __init__(self, root):
         self.root = root
@@ -20,9 +43,24 @@ class ERPSystem:
         # Setup colors
         self.setup_colors()
         
+        # JSON logs are written on a listener thread, ERP_LOG_LEVELS sets levels per subsystem
+        self.log_session = start_logging(os.environ.get('ERP_LOG_FILE', os.path.join('logs', 'erp_system.log')),
+                                         parse_levels(os.environ.get('ERP_LOG_LEVELS')))
+        
+        # Action timings for the node-exporter textfile collector, JSON lines for a .jsonl path
+        self.tracer = Tracer(os.environ.get('ERP_METRICS_FILE', 'erp_system_metrics.prom'))
+        self.tracer.add_counters('erp_swallowed_errors_total', "Errors handled by falling back to a default",
+                                 swallowed_errors.snapshot)
+        self.tracer.start()
+        
         # Create database
         self.create_database()
         
+        # Watch the main loop for stalls, started before any callback is registered
+        self.watchdog = MainLoopWatchdog(self.root, log_path='erp_system_stalls.jsonl').start()
+        self.capture = ProfileCapture()
+        self.backup_job = None
+        
         # Create user interface
         self.setup_ui()
         
@@ -39,10 +77,51 @@ class ERPSystem:
         }
         
     def create_database(self):
-        """Create database and tables"""
-        self.conn = sqlite3.connect('erp_system.db', check_same_thread=False)
+        """Open the database and set up its services"""
+        # Statements are timed for the diagnostics window, slow ones are logged with their plan
+        self.query_stats = QueryStats(log_path='erp_system_slow_queries.jsonl')
+        # $ERP_DATABASE_MODE opens the file read-only for reporting, or works in memory
+        self.db_path, self.db_mode = target_from_env('erp_system.db')
+        self.conn = connect(self.db_path, self.query_stats, self.db_mode, check_same_thread=False)
+        self.read_only = is_read_only(self.db_mode)
+        if self.read_only:
+            self.root.title(self.root.title() + " (read-only)")
         self.cursor = self.conn.cursor()
         
+        # Daily sales rollups used by period reports
+        self.rollups = RollupStore(self.conn, SIMPLE_SCHEMA)
+        
+        # Maintained stock balances and low stock alerts
+        self.stock_levels = StockLevels(self.conn, SIMPLE_SCHEMA)
+        
+        # Cost layers and maintained inventory valuation
+        self.costing = CostingEngine(self.conn, SIMPLE_SCHEMA)
+        
+        # Expenses ledger with categories and date indexes
+        self.expenses = ExpenseLedger(self.conn)
+        
+        # Invoice saving shared with the command-line tool and the API
+        self.sales = SalesLedger(self.conn, SIMPLE_SCHEMA, self.stock_levels, self.costing, self.rollups)
+        
+        # CSV imports shared with the command-line tool
+        self.importer = CsvImporter(self.conn, SIMPLE_SCHEMA, self.stock_levels, self.costing, self.expenses)
+        
+        # Profit and loss read from the sales rollups and expenses
+        self.profit_loss = ProfitAndLoss(self.conn)
+        
+        if not self.read_only:
+            self.create_tables()
+            return
+        
+        # Every upkeep step writes, so a read-only database must have been migrated already
+        try:
+            check_migrated(self.conn, SIMPLE_SCHEMA)
+        except ValueError as e:
+            messagebox.showerror("Read-only Database", f"Cannot open {self.db_path}:\n{e}")
+            raise SystemExit(1)
+    
+    def create_tables(self):
+        """Create tables, bring the derived tables up to date and add sample data"""
         # Customers table
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS customers (
@@ -117,6 +196,7 @@ class ERPSystem:
                 quantity INTEGER,
                 price REAL,
                 total REAL,
+                unit_cost REAL,
                 FOREIGN KEY (invoice_number) REFERENCES sales(invoice_number),
                 FOREIGN KEY (product_code) REFERENCES products(product_code)
             )
@@ -135,8 +215,17 @@ class ERPSystem:
         
         self.conn.commit()
         
+        self.rollups.create_tables()
+        
         # Add sample data if tables are empty
         self.add_sample_data()
+        
+        self.stock_levels.create_tables()
+        self.costing.create_tables()
+        if self.costing.backfill_sales_costs():
+            self.rollups.rebuild()
+        self.expenses.create_tables()
+        self.profit_loss.create_indexes()
     
     def add_sample_data(self):
         """Add sample data for testing"""
@@ -169,9 +258,9 @@ class ERPSystem:
                 ''', products)
                 
                 self.conn.commit()
-                print("Sample data added successfully")
-        except Exception as e:
-            print(f"Error adding sample data: {e}")
+                db_log.info("Sample data added")
+        except Exception:
+            swallowed(db_log, "Could not add sample data")
     
     def setup_ui(self):
         """Create main user interface"""
@@ -194,6 +283,19 @@ class ERPSystem:
         tools_menu.add_command(label="Calculate Balance", command=self.calculate_balance)
         tools_menu.add_command(label="Inventory Count", command=self.inventory_count)
         
+        # Diagnostics menu
+        diagnostics_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Diagnostics", menu=diagnostics_menu)
+        diagnostics_menu.add_command(label="Query Statistics", command=self.show_query_stats)
+        diagnostics_menu.add_command(label="Responsiveness", command=self.show_responsiveness)
+        diagnostics_menu.add_separator()
+        self.profiling_var = tk.BooleanVar(value=False)
+        diagnostics_menu.add_checkbutton(label="Profile CPU (cProfile)", variable=self.profiling_var,
+                                         command=self.toggle_profiling)
+        self.memory_tracking_var = tk.BooleanVar(value=False)
+        diagnostics_menu.add_checkbutton(label="Track Memory (tracemalloc)", variable=self.memory_tracking_var,
+                                         command=self.toggle_memory_tracking)
+        
         # Help menu
         help_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Help", menu=help_menu)
@@ -697,13 +799,9 @@ class ERPSystem:
         selection_frame.pack(fill='x', padx=10, pady=10)
         
         self.report_type = tk.StringVar(value='sales')
+        self.report_engine = ReportEngine(self.conn, SIMPLE_SCHEMA, cache=ReportCache(), read_only=self.read_only)
         
-        reports = [
-            ('sales', 'Sales Report'),
-            ('inventory', 'Inventory Report'),
-            ('customers', 'Customers Report'),
-            ('products', 'Products Report')
-        ]
+        reports = [(report.report_id, report.title) for report in reports_for(SIMPLE_SCHEMA)]
         
         for i, (value, text) in enumerate(reports):
             tk.Radiobutton(selection_frame, text=text, variable=self.report_type,
@@ -728,6 +826,8 @@ class ERPSystem:
                  bg=self.colors['success'], fg='white', width=15).pack(side='left', padx=10)
         tk.Button(date_frame, text="Export to Excel", command=self.export_report,
                  bg=self.colors['secondary'], fg='white', width=15).pack(side='left', padx=5)
+        tk.Button(date_frame, text="Profit & Loss", command=self.show_profit_report,
+                 bg=self.colors['primary'], fg='white', width=15).pack(side='left', padx=5)
         
         # Report display
         display_frame = tk.LabelFrame(self.reports_tab, text="Report Results",
@@ -781,7 +881,12 @@ class ERPSystem:
 
                 self.expense_vars = {
                     'title': tk.StringVar(),
-                    'amount': tk.StringVar()
+                    'amount': tk.StringVar(),
+                    'expense_date': tk.StringVar(value=dt.now().strftime('%Y-%m-%d')),
+                    'category': tk.StringVar(value=DEFAULT_CATEGORY),
+                    'cost_center': tk.StringVar(),
+                    'attachment': tk.StringVar(),
+                    'notes': tk.StringVar()
                 }
 
                 # اسم المصروف
@@ -802,15 +907,136 @@ class ERPSystem:
                     row=1, column=1, padx=5, pady=5
                 )
 
+                # Date and category
+                tk.Label(form_frame, text="Date:", font=('Arial', 10)).grid(
+                    row=0, column=2, sticky='e', padx=5, pady=5
+                )
+                tk.Entry(form_frame, textvariable=self.expense_vars['expense_date'],
+                        width=30, font=('Arial', 10)).grid(
+                    row=0, column=3, padx=5, pady=5
+                )
+                
+                tk.Label(form_frame, text="Category:", font=('Arial', 10)).grid(
+                    row=1, column=2, sticky='e', padx=5, pady=5
+                )
+                self.expense_category_combo = ttk.Combobox(
+                    form_frame, textvariable=self.expense_vars['category'],
+                    width=28, font=('Arial', 10)
+                )
+                self.expense_category_combo.grid(row=1, column=3, padx=5, pady=5)
+                
+                # Cost center, attachment and notes
+                tk.Label(form_frame, text="Cost Center:", font=('Arial', 10)).grid(
+                    row=2, column=0, sticky='e', padx=5, pady=5
+                )
+                tk.Entry(form_frame, textvariable=self.expense_vars['cost_center'],
+                        width=30, font=('Arial', 10)).grid(
+                    row=2, column=1, padx=5, pady=5
+                )
+                
+                tk.Label(form_frame, text="Attachment:", font=('Arial', 10)).grid(
+                    row=2, column=2, sticky='e', padx=5, pady=5
+                )
+                tk.Entry(form_frame, textvariable=self.expense_vars['attachment'],
+                        width=30, font=('Arial', 10)).grid(
+                    row=2, column=3, padx=5, pady=5
+                )
+                tk.Button(form_frame, text="Browse", command=self.browse_expense_attachment,
+                         bg=self.colors['secondary'], fg='white').grid(
+                    row=2, column=4, padx=5, pady=5
+                )
+                
+                tk.Label(form_frame, text="Notes:", font=('Arial', 10)).grid(
+                    row=3, column=0, sticky='e', padx=5, pady=5
+                )
+                tk.Entry(form_frame, textvariable=self.expense_vars['notes'],
+                        width=75, font=('Arial', 10)).grid(
+                    row=3, column=1, columnspan=3, sticky='w', padx=5, pady=5
+                )
+                
                 # زر الحفظ
+                buttons_frame = tk.Frame(form_frame)
+                buttons_frame.grid(row=4, column=0, columnspan=4, pady=10)
+                
                 tk.Button(
-                    form_frame,
+                    buttons_frame,
                     text="Save Expense",
                     command=self.save_expense,
                     bg=self.colors['success'],
                     fg='white',
                     width=15
-                ).grid(row=2, column=0, columnspan=2, pady=10)
+                ).pack(side='left', padx=5)
+                tk.Button(buttons_frame, text="Import CSV", command=self.import_expenses_csv,
+                         bg=self.colors['secondary'], fg='white', width=15).pack(side='left', padx=5)
+                
+                # Filters
+                filter_frame = tk.Frame(self.expenses_tab)
+                filter_frame.pack(fill='x', padx=10)
+                
+                self.expense_filters = {
+                    'date_from': tk.StringVar(value=dt.now().strftime('%Y-%m-01')),
+                    'date_to': tk.StringVar(value=dt.now().strftime('%Y-%m-%d')),
+                    'category': tk.StringVar()
+                }
+                
+                for label, key in (("From:", 'date_from'), ("To:", 'date_to')):
+                    tk.Label(filter_frame, text=label, font=('Arial', 10)).pack(side='left', padx=5)
+                    tk.Entry(filter_frame, textvariable=self.expense_filters[key], width=12,
+                            font=('Arial', 10)).pack(side='left', padx=5)
+                
+                tk.Label(filter_frame, text="Category:", font=('Arial', 10)).pack(side='left', padx=5)
+                self.expense_filter_combo = ttk.Combobox(
+                    filter_frame, textvariable=self.expense_filters['category'], width=18
+                )
+                self.expense_filter_combo.pack(side='left', padx=5)
+                
+                tk.Button(filter_frame, text="Apply", command=self.load_expenses,
+                         bg=self.colors['success'], fg='white', width=10).pack(side='left', padx=5)
+                tk.Button(filter_frame, text="Next ▶", command=self.next_expenses_page,
+                         bg=self.colors['secondary'], fg='white', width=10).pack(side='right', padx=5)
+                tk.Button(filter_frame, text="◀ Previous", command=self.previous_expenses_page,
+                         bg=self.colors['secondary'], fg='white', width=10).pack(side='right', padx=5)
+                self.expense_page_label = tk.Label(filter_frame, font=('Arial', 10))
+                self.expense_page_label.pack(side='right', padx=5)
+                
+                # Expenses list and category totals
+                lists_frame = tk.Frame(self.expenses_tab)
+                lists_frame.pack(fill='both', expand=True, padx=10, pady=10)
+                
+                table_frame = tk.LabelFrame(lists_frame, text="Expenses",
+                                           font=('Arial', 11, 'bold'))
+                table_frame.pack(side='left', fill='both', expand=True)
+                
+                columns = ('ID', 'Date', 'Expense', 'Category', 'Cost Center', 'Amount', 'Attachment', 'Notes')
+                self.expenses_tree = ttk.Treeview(table_frame, columns=columns,
+                                                 show='headings', height=12)
+                
+                for col in columns:
+                    self.expenses_tree.heading(col, text=col)
+                    self.expenses_tree.column(col, width=100)
+                
+                scrollbar = ttk.Scrollbar(table_frame, orient='vertical',
+                                         command=self.expenses_tree.yview)
+                self.expenses_tree.configure(yscrollcommand=scrollbar.set)
+                
+                self.expenses_tree.pack(side='left', fill='both', expand=True)
+                scrollbar.pack(side='right', fill='y')
+                
+                summary_frame = tk.LabelFrame(lists_frame, text="By Category",
+                                             font=('Arial', 11, 'bold'))
+                summary_frame.pack(side='right', fill='y', padx=(10, 0))
+                
+                self.expense_summary_tree = ttk.Treeview(summary_frame, columns=('Category', 'Count', 'Total'),
+                                                        show='headings', height=12)
+                for col in ('Category', 'Count', 'Total'):
+                    self.expense_summary_tree.heading(col, text=col)
+                    self.expense_summary_tree.column(col, width=90)
+                self.expense_summary_tree.pack(fill='both', expand=True)
+                
+                # Keys of the pages shown so far, used to page back
+                self.expense_page_keys = [None]
+                self.expense_next_key = None
+                self.load_expenses()
                 
     
     # ===== Customer Functions =====
@@ -960,8 +1186,10 @@ class ERPSystem:
                 float(self.product_vars['selling_price'].get() or 0),
                 int(self.product_vars['minimum_limit'].get() or 10)
             ))
+            stock_changes = self.stock_levels.evaluate(self.cursor, [name])
             
             self.conn.commit()
+            self.stock_levels.notify(stock_changes)
             self.load_products()
             self.clear_product_form()
             messagebox.showinfo("Success", "Product added successfully")
@@ -994,8 +1222,11 @@ class ERPSystem:
                 int(self.product_vars['minimum_limit'].get() or 10),
                 code
             ))
+            # Minimum limit may have changed
+            stock_changes = self.stock_levels.evaluate(self.cursor, [code])
             
             self.conn.commit()
+            self.stock_levels.notify(stock_changes)
             self.load_products()
             self.clear_product_form()
             messagebox.showinfo("Success", "Product updated successfully")
@@ -1013,8 +1244,12 @@ class ERPSystem:
                 return
             
             if messagebox.askyesno("Confirm", "Are you sure you want to delete this product?"):
+                self.cursor.execute("SELECT product_name FROM products WHERE product_code=?", (code,))
+                names = [row[0] for row in self.cursor.fetchall()]
                 self.cursor.execute("DELETE FROM products WHERE product_code=?", (code,))
+                stock_changes = self.stock_levels.evaluate(self.cursor, names)
                 self.conn.commit()
+                self.stock_levels.notify(stock_changes)
                 self.load_products()
                 self.clear_product_form()
                 messagebox.showinfo("Success", "Product deleted successfully")
@@ -1070,8 +1305,8 @@ class ERPSystem:
                     self.inventory_product_combo['values'] = product_list
                     self.inventory_vars['Category'].set(current_value)
                     
-            except Exception as e:
-                print(f"Error refreshing product combos: {e}")
+            except Exception:
+                swallowed(sales_log, "Could not refresh product lists")
     
     def refresh_customer_combos(self):
         """Refresh customer combo boxes in sales tab"""
@@ -1087,27 +1322,19 @@ class ERPSystem:
                 self.customer_combo['values'] = customer_list
                 self.sale_vars['customer_code'].set(current_value)
                 
-        except Exception as e:
-            print(f"Error refreshing customer combos: {e}")
+        except Exception:
+            swallowed(sales_log, "Could not refresh customer lists")
     
     # ===== Sales Functions =====
     
     def generate_invoice_number(self):
         """Generate next invoice number"""
         try:
-            self.cursor.execute("SELECT MAX(invoice_number) FROM sales")
-            last_invoice = self.cursor.fetchone()[0]
-            
-            if last_invoice:
-                num = int(last_invoice.split('-')[1]) + 1
-            else:
-                num = 1
-            
-            invoice_number = f"INV-{num:05d}"
+            invoice_number = self.sales.next_invoice_number(self.cursor)
             self.sale_vars['invoice_number'].set(invoice_number)
             
-        except Exception as e:
-            print(f"Error generating invoice number: {e}")
+        except Exception:
+            swallowed(sales_log, "Could not generate the next invoice number, using INV-00001")
             self.sale_vars['invoice_number'].set("INV-00001")
     
     def on_product_selected(self, event):
@@ -1126,8 +1353,8 @@ class ERPSystem:
                     if result:
                         self.item_vars['price'].set(str(result[0]))
 
-            except Exception as e:
-                print(f"Error loading product price: {e}")
+            except Exception:
+                swallowed(sales_log, "Could not load the price of %s", self.item_vars['Category'].get())
     
     def add_sale_item(self):
                 """Add item to invoice"""
@@ -1141,10 +1368,14 @@ class ERPSystem:
                     price = float(self.item_vars['price'].get())
                     total = quantity * price
                     
-                    # Insert item (no product_code for now)
+                    # Keep the product code in the item tags for save_invoice
+                    self.cursor.execute("SELECT product_code FROM products WHERE product_name=?",
+                                        (product_name,))
+                    product = self.cursor.fetchone()
                     self.sale_items_tree.insert(
                         '', 'end',
-                        values=(product_name, quantity, price, total)
+                        values=(product_name, quantity, price, total),
+                        tags=(str(product[0]),) if product else ()
                     )
                     
                     self.calculate_invoice_totals()
@@ -1181,8 +1412,8 @@ class ERPSystem:
             self.sale_totals['discount_amount'].set(f"{discount_amount:.2f}")
             self.sale_totals['net_total'].set(f"{net_total:.2f}")
             
-        except Exception as e:
-            print(f"Error calculating totals: {e}")
+        except Exception:
+            swallowed(sales_log, "Could not calculate invoice totals")
     
     def save_invoice(self):
         """Save invoice to database"""
@@ -1201,23 +1432,10 @@ class ERPSystem:
             customer_code = customer_info.split(' - ')[0]
             customer_name = customer_info.split(' - ')[1] if ' - ' in customer_info else ''
             
-            # Save invoice header
-            self.cursor.execute('''
-                INSERT INTO sales (invoice_number, customer_code, invoice_total, 
-                                 discount, net_invoice, invoice_status)
-                VALUES (?, ?, ?, ?, ?, 'closed')
-            ''', (
-                invoice_number,
-                customer_code,
-                float(self.sale_totals['subtotal'].get()),
-                float(self.sale_vars['discount'].get() or 0),
-                float(self.sale_totals['net_total'].get())
-            ))
-            
             # Prepare data for CSV export
             csv_data = []
+            lines = []
             
-            # Save invoice items and update inventory
             for item in self.sale_items_tree.get_children():
                 values = self.sale_items_tree.item(item)['values']
                 tags = self.sale_items_tree.item(item)['tags']
@@ -1231,19 +1449,7 @@ class ERPSystem:
                 quantity = int(values[1])  # Quantity at index 1
                 price = float(values[2])   # Price at index 2
                 total = float(values[3])   # Total at index 3
-                
-                # Save item
-                self.cursor.execute('''
-                    INSERT INTO sales_details (invoice_number, product_code, 
-                                              quantity, price, total)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (invoice_number, product_code, quantity, price, total))
-                
-                # Update inventory (outgoing movement)
-                self.cursor.execute('''
-                    INSERT INTO inventory (product_code, movement, quantity, reference)
-                    VALUES (?, 'out', ?, ?)
-                ''', (product_code, quantity, f"Invoice {invoice_number}"))
+                lines.append((product_code, quantity, price))
                 
                 # Add to CSV data
                 csv_data.append({
@@ -1260,58 +1466,71 @@ class ERPSystem:
                     'Net Total': float(self.sale_totals['net_total'].get())
                 })
             
-            self.conn.commit()
+            # Confirmation and form reset are timed apart so dialog time is left out
+            with self.tracer.span('sale'):
+                # Header, lines, stock movements, costs and rollups in one transaction
+                with self.tracer.span('database'):
+                    _, stock_changes = self.sales.save_invoice(
+                        self.cursor, invoice_number, customer_code, lines,
+                        discount=float(self.sale_vars['discount'].get() or 0))
+                    
+                    self.conn.commit()
+                self.stock_levels.notify(stock_changes)
             
-            # === Save invoice to CSV automatically ===
-            try:
-                csv_file = "invoices.csv"
+                # === Save invoice to CSV automatically ===
+                with self.tracer.span('csv_export'):
+                    try:
+                        csv_file = "invoices.csv"
 
-                # Prepare invoice data
-                data = []
-                for item in self.sale_items_tree.get_children():
-                    values = self.sale_items_tree.item(item)['values']
-                    product_name = values[0]
-                    quantity = values[1]
-                    price = values[2]
-                    total = values[3]
+                        # Prepare invoice data
+                        data = []
+                        for item in self.sale_items_tree.get_children():
+                            values = self.sale_items_tree.item(item)['values']
+                            product_name = values[0]
+                            quantity = values[1]
+                            price = values[2]
+                            total = values[3]
 
-                    data.append([
-                        invoice_number,
-                        customer_code,
-                        product_name,
-                        quantity,
-                        price,
-                        total,
-                        self.sale_totals['net_total'].get()
-                    ])
+                            data.append([
+                                invoice_number,
+                                customer_code,
+                                product_name,
+                                quantity,
+                                price,
+                                total,
+                                self.sale_totals['net_total'].get()
+                            ])
 
-                df = pd.DataFrame(data, columns=[
-                    "Invoice Number",
-                    "Customer Code",
-                    "Product Name",
-                    "Quantity",
-                    "Price",
-                    "Total",
-                    "Net Invoice"
-                ])
+                        df = pd.DataFrame(data, columns=[
+                            "Invoice Number",
+                            "Customer Code",
+                            "Product Name",
+                            "Quantity",
+                            "Price",
+                            "Total",
+                            "Net Invoice"
+                        ])
 
-                # Append to CSV if exists
-                if os.path.exists(csv_file):
-                    df.to_csv(csv_file, mode="a", index=False, header=False)
-                else:
-                    df.to_csv(csv_file, index=False)
+                        # Append to CSV if exists
+                        if os.path.exists(csv_file):
+                            df.to_csv(csv_file, mode="a", index=False, header=False)
+                        else:
+                            df.to_csv(csv_file, index=False)
 
-            except Exception as e:
-                print("CSV save error:", e)
+                    except Exception:
+                        swallowed(csv_log, "Could not append invoice %s to invoices.csv", invoice_number)
 
             
-            # Save to CSV file
-            self.save_invoice_to_csv(csv_data)
+                # Save to CSV file
+                with self.tracer.span('csv_log'):
+                    self.save_invoice_to_csv(csv_data)
             
             messagebox.showinfo("Success", f"Invoice {invoice_number} saved successfully\nand exported to CSV file")
             
-            self.new_invoice()
-            self.update_dashboard()
+            with self.tracer.span('sale/new_invoice'):
+                self.new_invoice()
+            with self.tracer.span('sale/update_dashboard'):
+                self.update_dashboard()
             
         except Exception as e:
             self.conn.rollback()
@@ -1336,10 +1555,10 @@ class ERPSystem:
             # Append to CSV file
             df.to_csv(csv_file, mode='a', header=not file_exists, index=False, encoding='utf-8')
             
-            print(f"Invoice saved to {csv_file}")
+            csv_log.info("Invoice saved to %s", csv_file)
             
-        except Exception as e:
-            print(f"Error saving invoice to CSV: {e}")
+        except Exception:
+            swallowed(csv_log, "Could not save invoice to the CSV log")
     
     def new_invoice(self):
         """Start new invoice"""
@@ -1355,7 +1574,8 @@ class ERPSystem:
         self.sale_totals['net_total'].set('0.00')
         
         # Generate new invoice number
-        self.generate_invoice_number()
+        with self.tracer.span('generate_invoice_number'):
+            self.generate_invoice_number()
     
     # ===== Inventory Functions =====
     
@@ -1394,7 +1614,7 @@ class ERPSystem:
                 # Get current quantity from products
                 self.cursor.execute("SELECT Quantitee FROM products WHERE product_name=?", (product_name,))
                 current_qty = self.cursor.fetchone()
-                print(current_qty)
+                inventory_log.debug("Quantity of %s before the movement: %s", product_name, current_qty)
 
                 if current_qty:
                     new_qty = int(current_qty[0]) + quantity
@@ -1408,7 +1628,12 @@ class ERPSystem:
                     WHERE product_name=?
                 ''', (new_qty, product_name))
 
+                stock_changes = self.stock_levels.apply_movements(
+                    self.cursor, [(product_name, movement, quantity)])
+                self.costing.apply_movement(self.cursor, product_name, movement, quantity, reference=reference)
+                
                 self.conn.commit()
+                self.stock_levels.notify(stock_changes)
                 self.load_inventory()
                 self.load_products()
                 self.clear_inventory_form()
@@ -1416,6 +1641,7 @@ class ERPSystem:
                 messagebox.showinfo("Success", "Inventory movement added successfully")
                 
             except Exception as e:
+                self.conn.rollback()
                 messagebox.showerror("Error", f"Error adding inventory movement: {str(e)}")
 
     
@@ -1431,152 +1657,39 @@ class ERPSystem:
     def generate_report(self):
         """Generate selected report"""
         try:
-            report_type = self.report_type.get()
-            
-            # Clear previous report
-            self.report_tree.delete(*self.report_tree.get_children())
-            
-            if report_type == 'sales':
-                self.generate_sales_report()
-            elif report_type == 'inventory':
-                self.generate_inventory_report()
-            elif report_type == 'customers':
-                self.generate_customers_report()
-            elif report_type == 'products':
-                self.generate_products_report()
+            params = {
+                'date_from': self.from_date.get().strip(),
+                'date_to': self.to_date.get().strip(),
+            }
+            with self.tracer.span(f"report/{self.report_type.get()}"):
+                self.report_engine.run(self.report_type.get(), TreeviewOutput(self.report_tree), params)
                 
         except Exception as e:
             messagebox.showerror("Error", f"Error generating report: {str(e)}")
     
-    def generate_sales_report(self):
-        """Generate sales report"""
-        columns = ('Invoice #', 'Date', 'Customer', 'Total', 'Discount', 'Net', 'Status')
-        self.report_tree['columns'] = columns
-        
-        for col in columns:
-            self.report_tree.heading(col, text=col)
-            self.report_tree.column(col, width=100)
-        
-        self.cursor.execute('''
-            SELECT s.invoice_number, s.invoice_date, c.customer_name,
-                   s.invoice_total, s.discount, s.net_invoice, s.invoice_status
-            FROM sales s
-            LEFT JOIN customers c ON s.customer_code = c.customer_code
-            WHERE DATE(s.invoice_date) BETWEEN ? AND ?
-            ORDER BY s.invoice_date DESC
-        ''', (self.from_date.get(), self.to_date.get()))
-        
-        for row in self.cursor.fetchall():
-            self.report_tree.insert('', 'end', values=row)
-    
-    def generate_inventory_report(self):
-        """Generate inventory report"""
-        columns = ('Product Name', 'In', 'Out', 'Balance')
-        self.report_tree['columns'] = columns
-        
-        for col in columns:
-            self.report_tree.heading(col, text=col)
-            self.report_tree.column(col, width=120)
-        
-        self.cursor.execute('''
-            SELECT 
-                p.product_name,
-                COALESCE((SELECT SUM(quantity) FROM inventory 
-                         WHERE product_code = p.product_code AND movement = 'in'), 0) as total_in,
-                COALESCE((SELECT SUM(quantity) FROM inventory 
-                         WHERE product_code = p.product_code AND movement = 'out'), 0) as total_out,
-                COALESCE((SELECT SUM(quantity) FROM inventory 
-                         WHERE product_code = p.product_code AND movement = 'in'), 0) -
-                COALESCE((SELECT SUM(quantity) FROM inventory 
-                         WHERE product_code = p.product_code AND movement = 'out'), 0) as balance
-            FROM products p
-            ORDER BY p.product_name
-        ''')
-        
-        for row in self.cursor.fetchall():
-            self.report_tree.insert('', 'end', values=row)
-    
-    def generate_customers_report(self):
-        """Generate customers report"""
-        columns = ('Code', 'Name', 'Phone', 'Email', 'Total Purchases')
-        self.report_tree['columns'] = columns
-        
-        for col in columns:
-            self.report_tree.heading(col, text=col)
-            self.report_tree.column(col, width=120)
-        
-        self.cursor.execute('''
-            SELECT 
-                c.customer_code,
-                c.customer_name,
-                c.phone,
-                c.email,
-                COALESCE(SUM(s.net_invoice), 0) as total_purchases
-            FROM customers c
-            LEFT JOIN sales s ON c.customer_code = s.customer_code
-            GROUP BY c.customer_code
-            ORDER BY total_purchases DESC
-        ''')
-        
-        for row in self.cursor.fetchall():
-            self.report_tree.insert('', 'end', values=row)
-    
-    def generate_products_report(self):
-        """Generate products report"""
-        columns = ('Product Name', 'Unit', 'Purchase Price', 'Selling Price', 'Stock')
-        self.report_tree['columns'] = columns
-        
-        for col in columns:
-            self.report_tree.heading(col, text=col)
-            self.report_tree.column(col, width=100)
-        
-        self.cursor.execute('''
-            SELECT 
-                p.product_name,
-                p.unit_of_measure,
-                p.purchase_price,
-                p.selling_price,
-                COALESCE((SELECT SUM(quantity) FROM inventory 
-                         WHERE product_code = p.product_code AND movement = 'in'), 0) -
-                COALESCE((SELECT SUM(quantity) FROM inventory 
-                         WHERE product_code = p.product_code AND movement = 'out'), 0) as stock
-            FROM products p
-            ORDER BY p.product_name
-        ''')
-        
-        for row in self.cursor.fetchall():
-            self.report_tree.insert('', 'end', values=row)
-    
     def export_report(self):
-        """Export report to Excel"""
+        """Export report to Excel, CSV or Parquet"""
         try:
-            if not self.report_tree.get_children():
-                messagebox.showwarning("Warning", "Please generate a report first")
-                return
+            report_id = self.report_type.get()
             
             file_path = filedialog.asksaveasfilename(
                 defaultextension=".xlsx",
-                filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")]
+                initialfile=f"{report_id}_report.xlsx",
+                filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv"),
+                           ("Parquet files", "*.parquet"), ("All files", "*.*")]
             )
             
             if not file_path:
                 return
             
-            # Get column headers
-            columns = self.report_tree['columns']
-            
-            # Get data
-            data = []
-            for item in self.report_tree.get_children():
-                data.append(self.report_tree.item(item)['values'])
-            
-            # Create DataFrame
-            df = pd.DataFrame(data, columns=columns)
-            
-            # Export to Excel
-            df.to_excel(file_path, index=False, sheet_name='Report')
+            # Re-run the report query instead of reading rows back from the table
+            params = {
+                'date_from': self.from_date.get().strip(),
+                'date_to': self.to_date.get().strip(),
+            }
+            count = self.report_engine.export(report_id, file_path, params)
             
-            messagebox.showinfo("Success", f"Report exported to {file_path}")
+            messagebox.showinfo("Success", f"{count} rows exported to {file_path}")
             
         except Exception as e:
             messagebox.showerror("Error", f"Error exporting report: {str(e)}")
@@ -1602,37 +1715,37 @@ class ERPSystem:
             self.metrics_vars['total_products'].set(total_products)
             
             # Inventory value
-            self.cursor.execute('''
-                SELECT SUM(
-                    (COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-                    ), 0) -
-                    COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-                    ), 0)) * p.purchase_price
-                )
-                FROM products p
-            ''')
-            inventory_value = self.cursor.fetchone()[0] or 0
+            inventory_value = self.costing.inventory_value()
             self.metrics_vars['inventory_value'].set(f"{inventory_value:.2f}")
             
             # Update quick analysis
             for item in self.analysis_tree.get_children():
                 self.analysis_tree.delete(item)
             
+            # Alert counts come from the maintained alert table
+            alert_counts = self.stock_levels.alert_counts()
+            low_stock = alert_counts[LOW_STOCK] + alert_counts[OUT_OF_STOCK]
+            
+            self.cursor.execute("SELECT SUM(invoice_count) FROM sales_daily WHERE day = DATE('now')")
+            today_invoices = self.cursor.fetchone()[0] or 0
+            
+            month_expenses = self.expenses.total(dt.now().strftime('%Y-%m-01'), dt.now().strftime('%Y-%m-%d'))
+            
             # Add analyses
             analyses = [
                 ("Today's Sales", f"{total_sales:.2f} $", "Higher than yesterday" if total_sales > 0 else "No sales"),
                 ("New Customers", "0", "No new customers registered today"),
-                ("Low Stock Items", "2", "Need reorder"),
-                ("Today's Invoices", "3", "All invoices processed")
+                ("Low Stock Items", str(low_stock),
+                 f"{alert_counts[OUT_OF_STOCK]} out of stock" if low_stock else "Stock levels normal"),
+                ("Today's Invoices", str(today_invoices), "All invoices processed"),
+                ("Month Expenses", f"{month_expenses:.2f} $", "Expenses since the first of the month")
             ]
             
             for analysis in analyses:
                 self.analysis_tree.insert('', 'end', values=analysis)
                 
-        except Exception as e:
-            print(f"Error updating dashboard: {e}")
+        except Exception:
+            swallowed(dashboard_log, "Could not update the dashboard")
     
     def quick_report(self):
         """Create quick report"""
@@ -1684,6 +1797,9 @@ class ERPSystem:
             tk.Radiobutton(options_frame, text="Inventory Movements", 
                           variable=data_type_var, value='inventory',
                           font=('Arial', 11)).pack(anchor='w', pady=5)
+            tk.Radiobutton(options_frame, text="Expenses", 
+                          variable=data_type_var, value='expenses',
+                          font=('Arial', 11)).pack(anchor='w', pady=5)
             
             # Information label
             info_text = """
@@ -1721,361 +1837,50 @@ class ERPSystem:
     
     def process_csv_import(self, data_type):
         """Process CSV file import based on data type"""
+        # Open file dialog
+        file_path = filedialog.askopenfilename(
+            title=f"Select CSV file for {data_type}",
+            filetypes=[("CSV files", "*.csv"), ("All files", "*.*")]
+        )
+        
+        if not file_path:
+            return
+        
         try:
-            # Open file dialog
-            file_path = filedialog.askopenfilename(
-                title=f"Select CSV file for {data_type}",
-                filetypes=[("CSV files", "*.csv"), ("All files", "*.*")]
-            )
-            
-            if not file_path:
-                return
-            
-            # Read CSV file
-            df = pd.read_csv(file_path, encoding='utf-8')
-            
-            if df.empty:
-                messagebox.showwarning("Warning", "The CSV file is empty")
-                return
-            
-            # Import based on type
-            if data_type == 'customers':
-                self.import_customers_csv(df)
-            elif data_type == 'products':
-                self.import_products_csv(df)
-            elif data_type == 'inventory':
-                self.import_inventory_csv(df)
-                
-        except UnicodeDecodeError:
-            try:
-                # Try with different encoding
-                df = pd.read_csv(file_path, encoding='latin-1')
-                if data_type == 'customers':
-                    self.import_customers_csv(df)
-                elif data_type == 'products':
-                    self.import_products_csv(df)
-                elif data_type == 'inventory':
-                    self.import_inventory_csv(df)
-            except Exception as e:
-                messagebox.showerror("Error", f"Error reading CSV file: {str(e)}\nPlease check the file encoding.")
+            with self.tracer.span(f"import/{data_type}"):
+                success_count, errors = self.importer.import_file(data_type, file_path)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
         except Exception as e:
-            messagebox.showerror("Error", f"Error importing CSV: {str(e)}")
-    
-    def import_customers_csv(self, df):
-        """Import customers from CSV"""
-        try:
-            # Expected columns (flexible matching)
-            column_mapping = {
-                'customer_code': ['customer_code', 'code', 'customer_id', 'id'],
-                'customer_name': ['customer_name', 'name', 'customer'],
-                'phone': ['phone', 'telephone', 'tel', 'mobile'],
-                'address': ['address', 'addr', 'location'],
-                'email': ['email', 'e-mail', 'mail']
-            }
-            
-            # Normalize column names
-            df.columns = df.columns.str.lower().str.strip()
-            
-            # Map columns
-            mapped_columns = {}
-            for target_col, possible_names in column_mapping.items():
-                for col in df.columns:
-                    if col in possible_names:
-                        mapped_columns[col] = target_col
-                        break
-            
-            if 'customer_code' not in mapped_columns.values() or 'customer_name' not in mapped_columns.values():
-                messagebox.showerror("Error", 
-                    "CSV must contain at least 'customer_code' and 'customer_name' columns.\n\n" +
-                    "Accepted column names:\n" +
-                    "- customer_code, code, customer_id, id\n" +
-                    "- customer_name, name, customer")
-                return
-            
-            df = df.rename(columns=mapped_columns)
-            
-            # Import records
-            success_count = 0
-            error_count = 0
-            errors = []
-            
-            for index, row in df.iterrows():
-                try:
-                    customer_code = str(row.get('customer_code', '')).strip()
-                    customer_name = str(row.get('customer_name', '')).strip()
-                    
-                    if not customer_code or not customer_name:
-                        error_count += 1
-                        errors.append(f"Row {index + 2}: Missing customer code or name")
-                        continue
-                    
-                    # Check if customer exists
-                    self.cursor.execute("SELECT customer_code FROM customers WHERE customer_code = ?", 
-                                       (customer_code,))
-                    exists = self.cursor.fetchone()
-                    
-                    if exists:
-                        # Update existing customer
-                        self.cursor.execute('''
-                            UPDATE customers 
-                            SET customer_name=?, phone=?, address=?, email=?
-                            WHERE customer_code=?
-                        ''', (
-                            customer_name,
-                            str(row.get('phone', '')),
-                            str(row.get('address', '')),
-                            str(row.get('email', '')),
-                            customer_code
-                        ))
-                    else:
-                        # Insert new customer
-                        self.cursor.execute('''
-                            INSERT INTO customers (customer_code, customer_name, phone, address, email)
-                            VALUES (?, ?, ?, ?, ?)
-                        ''', (
-                            customer_code,
-                            customer_name,
-                            str(row.get('phone', '')),
-                            str(row.get('address', '')),
-                            str(row.get('email', ''))
-                        ))
-                    
-                    success_count += 1
-                    
-                except Exception as e:
-                    error_count += 1
-                    errors.append(f"Row {index + 2}: {str(e)}")
-            
-            self.conn.commit()
+            messagebox.showerror("Error", f"Error importing {data_type}: {str(e)}")
+            return
+        
+        # Refresh the view of the imported data
+        if data_type == 'customers':
             self.load_customers()
-            
-            # Show results
-            result_message = f"Import completed!\n\n"
-            result_message += f"✓ Successfully imported: {success_count}\n"
-            if error_count > 0:
-                result_message += f"✗ Errors: {error_count}\n\n"
-                if len(errors) <= 5:
-                    result_message += "Errors:\n" + "\n".join(errors)
-                else:
-                    result_message += "First 5 errors:\n" + "\n".join(errors[:5])
-                    result_message += f"\n... and {len(errors) - 5} more errors"
-            
-            messagebox.showinfo("Import Results", result_message)
-            
-        except Exception as e:
-            self.conn.rollback()
-            messagebox.showerror("Error", f"Error importing customers: {str(e)}")
-    
-    def import_products_csv(self, df):
-        """Import products from CSV"""
-        try:
-            # Expected columns
-            column_mapping = {
-                #'product_code': ['product_code', 'code', 'product_id', 'id', 'item_code'],
-
-                'product_name': ['product_name', 'name', 'product', 'item_name', 'item'],
-                'Quantitee': ['unit_of_measure', 'unit', 'uom', 'measure'],
-                'purchase_price': ['purchase_price', 'cost', 'buy_price', 'purchase'],
-                'selling_price': ['selling_price', 'price', 'sell_price', 'sale_price'],
-                'minimum_limit': ['minimum_limit', 'min_limit', 'minimum', 'min', 'min_stock']
-            }
-            
-            # Normalize column names
-            df.columns = df.columns.str.lower().str.strip()
-            
-            # Map columns
-            mapped_columns = {}
-            for target_col, possible_names in column_mapping.items():
-                for col in df.columns:
-                    if col in possible_names:
-                        mapped_columns[col] = target_col
-                        break
-            
-            if 'product_code' not in mapped_columns.values() or 'product_name' not in mapped_columns.values():
-                messagebox.showerror("Error", 
-                    "CSV must contain at least 'product_code' and 'product_name' columns.")
-                return
-            
-            df = df.rename(columns=mapped_columns)
-            
-            # Import records
-            success_count = 0
-            error_count = 0
-            errors = []
-            
-            for index, row in df.iterrows():
-                try:
-                    product_code = str(row.get('product_code', '')).strip()
-                    product_name = str(row.get('product_name', '')).strip()
-                    
-                    if not product_code or not product_name:
-                        error_count += 1
-                        errors.append(f"Row {index + 2}: Missing product code or name")
-                        continue
-                    
-                    # Convert numeric values
-                    purchase_price = float(row.get('purchase_price', 0) or 0)
-                    selling_price = float(row.get('selling_price', 0) or 0)
-                    minimum_limit = int(row.get('minimum_limit', 10) or 10)
-                    
-                    # Check if product exists
-                    self.cursor.execute("SELECT product_code FROM products WHERE product_code = ?", 
-                                       (product_code,))
-                    exists = self.cursor.fetchone()
-                    
-                    if exists:
-                        # Update existing product
-                        self.cursor.execute('''
-                            UPDATE products 
-                            SET product_name=?, unit_of_measure=?, purchase_price=?, 
-                                selling_price=?, minimum_limit=?
-                            WHERE product_code=?
-                        ''', (
-                            product_name,
-                            str(row.get('Quantitee', '')),
-                            purchase_price,
-                            selling_price,
-                            minimum_limit,
-                            product_code
-                        ))
-                    else:
-                        # Insert new product
-                        self.cursor.execute('''
-                            INSERT INTO products (product_code, Cattegory, product_name, Quantitee, 
-                                                purchase_price, selling_price, minimum_limit)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                        ''', (
-                            product_code,
-                            product_name,
-                            str(row.get('unit_of_measure', '')),
-                            purchase_price,
-                            selling_price,
-                            minimum_limit
-                        ))
-                    
-                    success_count += 1
-                    
-                except Exception as e:
-                    error_count += 1
-                    errors.append(f"Row {index + 2}: {str(e)}")
-            
-            self.conn.commit()
+        elif data_type == 'products':
             self.load_products()
-            
-            # Show results
-            result_message = f"Import completed!\n\n"
-            result_message += f"✓ Successfully imported: {success_count}\n"
-            if error_count > 0:
-                result_message += f"✗ Errors: {error_count}\n\n"
-                if len(errors) <= 5:
-                    result_message += "Errors:\n" + "\n".join(errors)
-                else:
-                    result_message += "First 5 errors:\n" + "\n".join(errors[:5])
-                    result_message += f"\n... and {len(errors) - 5} more errors"
-            
-            messagebox.showinfo("Import Results", result_message)
-            
-        except Exception as e:
-            self.conn.rollback()
-            messagebox.showerror("Error", f"Error importing products: {str(e)}")
-    
-    def import_inventory_csv(self, df):
-        """Import inventory movements from CSV"""
-        try:
-            # Expected columns
-            column_mapping = {
-                'product_code': ['product_code', 'code', 'product_id', 'item_code'],
-                'movement': ['movement', 'type', 'movement_type', 'direction'],
-                'quantity': ['quantity', 'qty', 'amount'],
-                'reference': ['reference', 'ref', 'note', 'remarks']
-            }
-            
-            # Normalize column names
-            df.columns = df.columns.str.lower().str.strip()
-            
-            # Map columns
-            mapped_columns = {}
-            for target_col, possible_names in column_mapping.items():
-                for col in df.columns:
-                    if col in possible_names:
-                        mapped_columns[col] = target_col
-                        break
-            
-            if 'product_code' not in mapped_columns.values() or 'quantity' not in mapped_columns.values():
-                messagebox.showerror("Error", 
-                    "CSV must contain at least 'product_code' and 'quantity' columns.")
-                return
-            
-            df = df.rename(columns=mapped_columns)
-            
-            # Import records
-            success_count = 0
-            error_count = 0
-            errors = []
-            
-            for index, row in df.iterrows():
-                try:
-                    product_code = str(row.get('product_code', '')).strip()
-                    quantity = int(row.get('quantity', 0) or 0)
-                    movement = str(row.get('movement', 'in')).strip().lower()
-                    
-                    # Normalize movement type
-                    if movement in ['in', 'entry', 'receive', 'purchase', 'incoming', 'input']:
-                        movement = 'in'
-                    elif movement in ['out', 'exit', 'issue', 'sale', 'outgoing', 'output']:
-                        movement = 'out'
-                    else:
-                        movement = 'in'  # Default to 'in'
-                    
-                    if not product_code or quantity <= 0:
-                        error_count += 1
-                        errors.append(f"Row {index + 2}: Invalid product code or quantity")
-                        continue
-                    
-                    # Check if product exists
-                    self.cursor.execute("SELECT product_code FROM products WHERE product_code = ?", 
-                                       (product_code,))
-                    if not self.cursor.fetchone():
-                        error_count += 1
-                        errors.append(f"Row {index + 2}: Product {product_code} not found")
-                        continue
-                    
-                    # Insert inventory movement
-                    self.cursor.execute('''
-                        INSERT INTO inventory (product_code, movement, quantity, reference)
-                        VALUES (?, ?, ?, ?)
-                    ''', (
-                        product_code,
-                        movement,
-                        quantity,
-                        str(row.get('reference', 'CSV Import'))
-                    ))
-                    
-                    success_count += 1
-                    
-                except Exception as e:
-                    error_count += 1
-                    errors.append(f"Row {index + 2}: {str(e)}")
-            
-            self.conn.commit()
+        elif data_type == 'inventory':
             self.load_inventory()
-            
-            # Show results
-            result_message = f"Import completed!\n\n"
-            result_message += f"✓ Successfully imported: {success_count}\n"
-            if error_count > 0:
-                result_message += f"✗ Errors: {error_count}\n\n"
-                if len(errors) <= 5:
-                    result_message += "Errors:\n" + "\n".join(errors)
-                else:
-                    result_message += "First 5 errors:\n" + "\n".join(errors[:5])
-                    result_message += f"\n... and {len(errors) - 5} more errors"
-            
-            messagebox.showinfo("Import Results", result_message)
-            
-        except Exception as e:
-            self.conn.rollback()
-            messagebox.showerror("Error", f"Error importing inventory: {str(e)}")
+        else:
+            self.load_expenses()
+        
+        self.show_import_results(success_count, errors)
+    
+    def show_import_results(self, success_count, errors):
+        """Show the outcome of a CSV import"""
+        result_message = f"Import completed!\n\n"
+        result_message += f"✓ Successfully imported: {success_count}\n"
+        if errors:
+            result_message += f"✗ Errors: {len(errors)}\n\n"
+            if len(errors) <= 5:
+                result_message += "Errors:\n" + "\n".join(errors)
+            else:
+                result_message += "First 5 errors:\n" + "\n".join(errors[:5])
+                result_message += f"\n... and {len(errors) - 5} more errors"
+        
+        messagebox.showinfo("Import Results", result_message)
     
     def export_data(self):
         """Export all data to Excel"""
@@ -2088,22 +1893,7 @@ class ERPSystem:
             if not file_path:
                 return
             
-            # Create Excel file
-            with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-                tables = {
-                    'Customers': "SELECT * FROM customers",
-                    'Products': "SELECT * FROM products",
-                    'Sales': "SELECT * FROM sales",
-                    'Sales_Details': "SELECT * FROM sales_details",
-                    'Inventory': "SELECT * FROM inventory"
-                }
-                
-                for sheet_name, query in tables.items():
-                    try:
-                        df = pd.read_sql_query(query, self.conn)
-                        df.to_excel(writer, sheet_name=sheet_name, index=False)
-                    except Exception as e:
-                        print(f"Error exporting {sheet_name}: {e}")
+            export_tables(self.conn, EXPORT_TABLES[SIMPLE_SCHEMA], file_path)
             
             messagebox.showinfo("Success", f"Data exported to {file_path}")
             
@@ -2111,18 +1901,67 @@ class ERPSystem:
             messagebox.showerror("Error", f"Error during export: {str(e)}")
     
     def backup_database(self):
-        """Create database backup"""
+        """Start a compressed, verified database backup in the background"""
+        if self.backup_job is not None and not self.backup_job.done():
+            messagebox.showinfo("Backup", "A backup is already running")
+            return
+        
+        # The copy is made in steps on a connection of its own so sales can be saved meanwhile,
+        # a database in memory can only be read through the open connection
+        conn = self.conn if self.db_mode in (IN_MEMORY, SNAPSHOT) else None
+        self.backup_job = BackupJob(self.db_path, os.environ.get('ERP_BACKUP_DIR', 'backups'),
+                                    self.db_mode, conn).start()
+        self.root.after(200, self.check_backup)
+    
+    def check_backup(self):
+        """Report the background backup once it has finished"""
+        job = self.backup_job
+        if not job.done():
+            self.root.after(200, self.check_backup)
+            return
+        
+        if job.error is not None:
+            messagebox.showerror("Error", f"Error during backup: {job.error}")
+        else:
+            messagebox.showinfo("Success", f"Backup created: {job.path}\n{len(job.removed)} old backups removed")
+    
+    def show_query_stats(self):
+        """Show statement timings and the slow query log"""
+        QueryStatsWindow(self.root, self.query_stats)
+    
+    def show_responsiveness(self):
+        """Show main loop stalls and what caused them"""
+        WatchdogWindow(self.root, self.watchdog)
+    
+    def toggle_profiling(self):
+        """Start or stop a cProfile capture around what the user does next"""
         try:
-            backup_file = f"erp_backup_{dt.now().strftime('%Y%m%d_%H%M%S')}.db"
-            
-            # Copy database
-            import shutil
-            shutil.copy2('erp_system.db', backup_file)
-            
-            messagebox.showinfo("Success", f"Backup created: {backup_file}")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Error during backup: {str(e)}")
+            if self.profiling_var.get():
+                self.capture.start_profile()
+                messagebox.showinfo("Profiling", "CPU profiling started.\n"
+                                    "Do the slow action, then uncheck Diagnostics > Profile CPU.")
+            else:
+                folder = self.capture.stop_profile()
+                if folder:
+                    messagebox.showinfo("Profiling", f"CPU profile saved to:\n{os.path.abspath(folder)}")
+        except (OSError, ValueError) as e:
+            self.profiling_var.set(self.capture.profiler is not None)
+            messagebox.showerror("Error", f"Profiling failed: {str(e)}")
+    
+    def toggle_memory_tracking(self):
+        """Start or stop a tracemalloc capture around what the user does next"""
+        try:
+            if self.memory_tracking_var.get():
+                self.capture.start_memory()
+                messagebox.showinfo("Memory Tracking", "Memory tracking started.\n"
+                                    "Do the action to check, then uncheck Diagnostics > Track Memory.")
+            else:
+                folder = self.capture.stop_memory()
+                if folder:
+                    messagebox.showinfo("Memory Tracking", f"Memory snapshot saved to:\n{os.path.abspath(folder)}")
+        except OSError as e:
+            self.memory_tracking_var.set(self.capture.memory_start is not None)
+            messagebox.showerror("Error", f"Memory tracking failed: {str(e)}")
     
     def calculate_balance(self):
         """Calculate inventory balance"""
@@ -2130,13 +1969,9 @@ class ERPSystem:
             self.cursor.execute('''
                 SELECT 
                     p.product_name,
-                    COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'in'
-                    ), 0) -
-                    COALESCE((
-                        SELECT SUM(quantity) FROM inventory WHERE product_code = p.product_code AND movement = 'out'
-                    ), 0) as balance
+                    COALESCE(b.balance, 0) as balance
                 FROM products p
+                LEFT JOIN stock_balances b ON b.product_key = p.product_name
                 ORDER BY p.product_name
             ''')
             
@@ -2158,66 +1993,129 @@ class ERPSystem:
         messagebox.showinfo("Inventory Count", "This feature will be developed in future versions")
         
         
-    def calculate_profit_loss(self):
-            try:
-                # Total sales
-                self.cursor.execute("SELECT SUM(net_total) FROM sales")
-                total_sales = self.cursor.fetchone()[0] or 0
-
-                # Cost of goods (from purchases)
-                self.cursor.execute("SELECT SUM(total_cost) FROM purchases")
-                total_cost = self.cursor.fetchone()[0] or 0
-
-                # Expenses
-                self.cursor.execute("SELECT SUM(amount) FROM expenses")
-                total_expenses = self.cursor.fetchone()[0] or 0
-
-                profit = total_sales - total_cost - total_expenses
-
-                return total_sales, total_cost, total_expenses, profit
-
-            except:
-                return 0, 0, 0, 0    
+    def calculate_profit_loss(self, date_from=None, date_to=None):
+            """Calculate sales, cost of goods, expenses and net profit for a date range"""
+            date_from = date_from or self.from_date.get()
+            date_to = date_to or self.to_date.get()
+            statement = self.profit_loss.statement(date_from, date_to)
+            return (statement['revenue'], statement['cogs'], statement['expenses'],
+                    statement['net_profit'])
             
             
     def show_profit_report(self):
-            sales, cost, expenses, profit = self.calculate_profit_loss()
-
-            messagebox.showinfo(
-                "Profit & Loss",
-                f"Total Sales: {sales}\n"
-                f"Cost of Goods: {cost}\n"
-                f"Expenses: {expenses}\n\n"
-                f"Net Profit: {profit}"
-            )
+            """Show profit and loss for the selected range and month comparisons"""
+            try:
+                date_from = dt.strptime(self.from_date.get(), '%Y-%m-%d').date()
+                date_to = dt.strptime(self.to_date.get(), '%Y-%m-%d').date()
+            except ValueError:
+                messagebox.showwarning("Warning", "Please enter dates as YYYY-MM-DD")
+                return
+            
+            try:
+                sales, cost, expenses, profit = self.calculate_profit_loss(date_from, date_to)
+                comparison = self.profit_loss.compare(MONTH, date_to)
+            except Exception as e:
+                messagebox.showerror("Error", f"Error calculating profit and loss: {str(e)}")
+                return
+            
+            lines = [
+                f"Period: {date_from} to {date_to}",
+                f"Total Sales: {sales:,.2f}",
+                f"Cost of Goods: {cost:,.2f}",
+                f"Gross Profit: {sales - cost:,.2f}",
+                f"Expenses: {expenses:,.2f}",
+                f"Net Profit: {profit:,.2f}",
+                "",
+            ]
+            for key, label in (('current', 'This month'), ('previous', 'Previous month'),
+                               ('last_year', 'Same month last year')):
+                month = comparison[key]
+                lines.append(f"{label} ({month['period']}): sales {month['revenue']:,.2f}, "
+                             f"net profit {month['net_profit']:,.2f}")
+            
+            messagebox.showinfo("Profit & Loss", "\n".join(lines))
     
     def save_expense(self):
             """Save expense to database"""
-            title = self.expense_vars['title'].get().strip()
-            amount = self.expense_vars['amount'].get().strip()
+            values = {key: var.get().strip() for key, var in self.expense_vars.items()}
 
-            if not title or not amount:
+            if not values['title'] or not values['amount']:
                 messagebox.showwarning("Warning", "Please enter expense name and amount")
                 return
 
             try:
-                amount = float(amount)
-
-                self.cursor.execute(
-                    "INSERT INTO expenses (title, amount) VALUES (?, ?)",
-                    (title, amount)
-                )
-                self.conn.commit()
+                with self.tracer.span('expense'):
+                    self.expenses.add_expense(self.cursor, **values)
+                    self.conn.commit()
 
                 messagebox.showinfo("Success", "Expense saved successfully")
 
                 # تفريغ الحقول
-                self.expense_vars['title'].set("")
-                self.expense_vars['amount'].set("")
+                for key in ('title', 'amount', 'attachment', 'notes'):
+                    self.expense_vars[key].set("")
+                self.load_expenses()
 
-            except ValueError:
-                messagebox.showerror("Error", "Amount must be a number")
-            
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid expense: {str(e)}")
+    
+    def browse_expense_attachment(self):
+        """Choose a receipt file for the expense"""
+        file_path = filedialog.askopenfilename(
+            title="Select attachment",
+            filetypes=[("All files", "*.*")]
+        )
+        if file_path:
+            self.expense_vars['attachment'].set(file_path)
+    
+    def load_expenses(self, page=0):
+        """Load one page of expenses and the category totals for the filters"""
+        date_from = self.expense_filters['date_from'].get().strip() or None
+        date_to = self.expense_filters['date_to'].get().strip() or None
+        category = self.expense_filters['category'].get().strip() or None
+        
+        if page == 0:
+            self.expense_page_keys = [None]
+        
+        try:
+            rows, self.expense_next_key = self.expenses.list_page(
+                date_from, date_to, category, after=self.expense_page_keys[page])
+            totals = self.expenses.totals_by_category(date_from, date_to)
+        except sqlite3.Error as e:
+            messagebox.showerror("Error", f"Error loading expenses: {str(e)}")
+            return
+        
+        self.expense_page = page
+        for item in self.expenses_tree.get_children():
+            self.expenses_tree.delete(item)
+        for row in rows:
+            self.expenses_tree.insert('', 'end', values=['' if value is None else value for value in row])
+        
+        for item in self.expense_summary_tree.get_children():
+            self.expense_summary_tree.delete(item)
+        for name, count, amount in totals:
+            self.expense_summary_tree.insert('', 'end', values=(name, count, f"{amount:.2f}"))
+        
+        categories = self.expenses.categories()
+        self.expense_category_combo['values'] = categories
+        self.expense_filter_combo['values'] = [''] + categories
+        self.expense_page_label.config(text=f"Page {page + 1}")
+    
+    def next_expenses_page(self):
+        """Show the next page of expenses"""
+        if self.expense_next_key is None:
+            return
+        del self.expense_page_keys[self.expense_page + 1:]
+        self.expense_page_keys.append(self.expense_next_key)
+        self.load_expenses(self.expense_page + 1)
+    
+    def previous_expenses_page(self):
+        """Show the previous page of expenses"""
+        if self.expense_page > 0:
+            self.load_expenses(self.expense_page - 1)
+    
+    def import_expenses_csv(self):
+        """Import expenses from a CSV file"""
+        self.process_csv_import('expenses')
     
     def show_help(self):
         """Show user guide"""
@@ -2278,6 +2176,13 @@ class ERPSystem:
     
     def __del__(self):
         """Close database connection"""
+        if hasattr(self, 'tracer'):
+            self.tracer.close()
+        if hasattr(self, 'log_session'):
+            self.log_session.stop()
+        if getattr(self, 'backup_job', None) is not None:
+            # Let a running backup finish before its connection goes
+            self.backup_job.thread.join()
         if hasattr(self, 'conn'):
             self.conn.close()
 
@@ -0,0 +1,233 @@
+import argparse
+import csv
+import datetime
+import math
+import sqlite3
+
+from erp_schema import add_column
+
+
+DEFAULT_CATEGORY = 'General'
+PAGE_SIZE = 50
+
+# Group labels per period, matching profit_loss.period_label
+PERIOD_LABELS = {
+    'month': "strftime('%Y-%m', expense_date)",
+    'quarter': "strftime('%Y', expense_date) || '-Q' || ((CAST(strftime('%m', expense_date) AS INTEGER) + 2) / 3)",
+    'year': "strftime('%Y', expense_date)",
+}
+
+# Accepted CSV headers for each expense field
+CSV_COLUMNS = {
+    'title': ['title', 'expense', 'name', 'description'],
+    'amount': ['amount', 'value', 'total'],
+    'expense_date': ['expense_date', 'date'],
+    'category': ['category', 'type'],
+    'cost_center': ['cost_center', 'cost centre', 'cost_centre', 'department'],
+    'attachment': ['attachment', 'receipt', 'file'],
+    'notes': ['notes', 'note', 'remarks'],
+}
+
+LIST_COLUMNS = ('id', 'expense_date', 'title', 'category', 'cost_center', 'amount', 'attachment', 'notes')
+
+
+class ExpenseLedger:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def create_tables(self):
+        """Create the expenses table with its ledger columns and indexes"""
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS expenses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT,
+                amount REAL,
+                expense_date DATE DEFAULT CURRENT_DATE,
+                notes TEXT
+            )
+        ''')
+        add_column(self.conn, 'expenses', 'category', f"TEXT DEFAULT '{DEFAULT_CATEGORY}'")
+        add_column(self.conn, 'expenses', 'cost_center', 'TEXT')
+        add_column(self.conn, 'expenses', 'attachment', 'TEXT')
+        self.create_indexes()
+        self.conn.commit()
+
+    def create_indexes(self):
+        """Create the indexes period and category totals are read through"""
+        # Covering index for date range totals, category breakdowns and the newest-first list;
+        # it supersedes the narrower date index
+        self.conn.execute("DROP INDEX IF EXISTS idx_expenses_date")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_expenses_period ON expenses (expense_date, category, amount)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses (category, expense_date, amount)")
+
+    # ===== Writes =====
+
+    def clean_row(self, title, amount, expense_date=None, category=None, cost_center=None,
+                  attachment=None, notes=None):
+        """Validate one expense and return it as an insert tuple"""
+        title = (title or '').strip()
+        if not title:
+            raise ValueError("Expense name is required")
+        amount = float(amount)
+        # float() reads 'nan' and 'inf', which would be stored as NULL or break the totals
+        if not math.isfinite(amount):
+            raise ValueError("Amount must be a number")
+        if amount < 0:
+            raise ValueError("Amount cannot be negative")
+        if expense_date:
+            expense_date = datetime.date.fromisoformat(str(expense_date).strip()[:10]).isoformat()
+        else:
+            expense_date = datetime.date.today().isoformat()
+        return (title, amount, expense_date, (category or '').strip() or DEFAULT_CATEGORY,
+                (cost_center or '').strip() or None, (attachment or '').strip() or None,
+                (notes or '').strip() or None)
+
+    def add_expense(self, cursor, title, amount, expense_date=None, category=None, cost_center=None,
+                    attachment=None, notes=None):
+        """Insert one expense inside the caller's transaction and return its id"""
+        row = self.clean_row(title, amount, expense_date, category, cost_center, attachment, notes)
+        cursor.execute('''
+            INSERT INTO expenses (title, amount, expense_date, category, cost_center, attachment, notes)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', row)
+        return cursor.lastrowid
+
+    def import_csv(self, path):
+        """Import expenses from a CSV file in one transaction and return (imported, errors)"""
+        try:
+            with open(path, newline='', encoding='utf-8-sig') as file:
+                records = list(csv.DictReader(file))
+        except UnicodeDecodeError:
+            with open(path, newline='', encoding='latin-1') as file:
+                records = list(csv.DictReader(file))
+        return self.import_rows(records)
+
+    def import_rows(self, records):
+        """Import expenses from header-keyed dicts and return (imported, errors)"""
+        rows = []
+        errors = []
+        for number, record in enumerate(records, start=2):
+            values = {}
+            normalized = {str(key).lower().strip(): value for key, value in record.items() if key}
+            for field, names in CSV_COLUMNS.items():
+                for name in names:
+                    if name in normalized:
+                        values[field] = normalized[name]
+                        break
+            try:
+                rows.append(self.clean_row(**values))
+            except (TypeError, ValueError) as e:
+                errors.append(f"Row {number}: {e}")
+
+        try:
+            self.conn.executemany('''
+                INSERT INTO expenses (title, amount, expense_date, category, cost_center, attachment, notes)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return len(rows), errors
+
+    # ===== Reads =====
+
+    def filters(self, date_from=None, date_to=None, category=None):
+        """Build the WHERE clause and parameters of a date range and category"""
+        clauses = []
+        params = []
+        if date_from:
+            clauses.append("expense_date >= ?")
+            params.append(str(date_from))
+        if date_to:
+            # expense_date may hold a date or a timestamp, so compare up to the end of the last day
+            clauses.append("expense_date < DATE(?, '+1 day')")
+            params.append(str(date_to))
+        if category:
+            clauses.append("category = ?")
+            params.append(category)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def list_page(self, date_from=None, date_to=None, category=None, after=None, limit=PAGE_SIZE):
+        """Get one page of expenses, newest first, and the key of the next page"""
+        where, params = self.filters(date_from, date_to, category)
+        if after is not None:
+            # Keyset paging on (expense_date, id) so deep pages cost the same as the first
+            where += (" AND " if where else " WHERE ") + "(expense_date, id) < (?, ?)"
+            params.extend(after)
+        rows = self.conn.execute(f'''
+            SELECT {', '.join(LIST_COLUMNS)} FROM expenses{where}
+            ORDER BY expense_date DESC, id DESC
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+        next_key = (rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+        return rows[:limit], next_key
+
+    def total(self, date_from=None, date_to=None, category=None):
+        """Get total expenses for a date range"""
+        where, params = self.filters(date_from, date_to, category)
+        row = self.conn.execute(f"SELECT COALESCE(SUM(amount), 0) FROM expenses{where}", params).fetchone()
+        return row[0]
+
+    def totals_by_category(self, date_from=None, date_to=None):
+        """Get (category, count, total) for a date range, largest first"""
+        where, params = self.filters(date_from, date_to)
+        return self.conn.execute(f'''
+            SELECT COALESCE(category, '{DEFAULT_CATEGORY}'), COUNT(*), SUM(amount)
+            FROM expenses{where}
+            GROUP BY 1
+            ORDER BY 3 DESC
+        ''', params).fetchall()
+
+    def totals_by_period(self, period, date_from=None, date_to=None, category=None):
+        """Get (period, total) for each month, quarter or year in a date range"""
+        if period not in PERIOD_LABELS:
+            raise ValueError(f"Unknown period: {period}")
+        where, params = self.filters(date_from, date_to, category)
+        return self.conn.execute(f'''
+            SELECT {PERIOD_LABELS[period]}, SUM(amount)
+            FROM expenses{where}
+            GROUP BY 1
+            ORDER BY 1
+        ''', params).fetchall()
+
+    def categories(self):
+        """Get the categories in use"""
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT category FROM expenses WHERE category IS NOT NULL ORDER BY category")]
+
+
+def main():
+    """Import or summarize expenses from the command line"""
+    parser = argparse.ArgumentParser(description="Expenses ledger")
+    parser.add_argument('database', help="SQLite database file")
+    parser.add_argument('--import', dest='import_path', help="CSV file of expenses to import")
+    parser.add_argument('--from', dest='date_from', help="First day (YYYY-MM-DD)")
+    parser.add_argument('--to', dest='date_to', help="Last day (YYYY-MM-DD)")
+    parser.add_argument('--period', choices=tuple(PERIOD_LABELS), help="Group totals by period")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        ledger = ExpenseLedger(conn)
+        ledger.create_tables()
+        if args.import_path:
+            imported, errors = ledger.import_csv(args.import_path)
+            print(f"Imported {imported} expenses")
+            for error in errors:
+                print(error)
+
+        if args.period:
+            for label, amount in ledger.totals_by_period(args.period, args.date_from, args.date_to):
+                print(f"{label:<12}{amount:>14.2f}")
+        else:
+            for category, count, amount in ledger.totals_by_category(args.date_from, args.date_to):
+                print(f"{category:<24}{count:>8}{amount:>14.2f}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
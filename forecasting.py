@@ -0,0 +1,257 @@
+import argparse
+import datetime
+import sqlite3
+
+import numpy as np
+
+from erp_schema import add_column, detect_schema, profile
+from rollups import RollupStore
+
+
+SIMPLE_SMOOTHING = 'simple'
+HOLT_SMOOTHING = 'holt'
+
+
+class DemandForecaster:
+    def __init__(self, conn, method=HOLT_SMOOTHING, alpha=0.3, beta=0.1, horizon_days=30,
+                 chunk_days=90):
+        if method not in (SIMPLE_SMOOTHING, HOLT_SMOOTHING):
+            raise ValueError(f"Unknown smoothing method: {method}")
+        self.conn = conn
+        self.method = method
+        self.alpha = alpha
+        # Simple smoothing is Holt's method with the trend held at zero
+        self.beta = beta if method == HOLT_SMOOTHING else 0.0
+        self.horizon_days = horizon_days
+        self.chunk_days = chunk_days
+        self.sale_price = profile(detect_schema(conn))['sale_price']
+
+    def create_tables(self):
+        """Create forecast and run history tables"""
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS demand_forecasts (
+                product_code TEXT PRIMARY KEY,
+                level REAL NOT NULL DEFAULT 0,
+                trend REAL NOT NULL DEFAULT 0,
+                daily_forecast REAL NOT NULL DEFAULT 0,
+                horizon_total REAL NOT NULL DEFAULT 0,
+                fitted_through DATE NOT NULL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS forecast_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                method TEXT NOT NULL,
+                alpha REAL NOT NULL,
+                beta REAL NOT NULL,
+                horizon_days INTEGER NOT NULL,
+                first_day DATE NOT NULL,
+                fitted_through DATE NOT NULL,
+                products INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Sales saved after a run have a higher rowid, which finds backdated invoices it missed
+        add_column(self.conn, 'forecast_runs', 'sales_rowid', 'INTEGER')
+        # Covering index so day-range reads of the rollup never touch table rows
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sales_product_daily_demand ON sales_product_daily (day, product_code, quantity)")
+        self.conn.commit()
+
+    def last_run(self):
+        """Get the latest forecast run as a dict, or None"""
+        row = self.conn.execute('''
+            SELECT method, alpha, beta, horizon_days, fitted_through, sales_rowid
+            FROM forecast_runs ORDER BY id DESC LIMIT 1
+        ''').fetchone()
+        if row is None:
+            return None
+        return dict(zip(('method', 'alpha', 'beta', 'horizon_days', 'fitted_through', 'sales_rowid'), row))
+
+    def same_settings(self, run):
+        """Check whether a run used the current model settings"""
+        return (run['method'] == self.method and run['alpha'] == self.alpha
+                and run['beta'] == self.beta and run['horizon_days'] == self.horizon_days)
+
+    def backdated(self, run):
+        """Check whether sales saved since a run are dated on days it already fitted"""
+        if run['sales_rowid'] is None:
+            return True
+        day = self.conn.execute("SELECT MIN(DATE(invoice_date)) FROM sales WHERE rowid > ?",
+                                (run['sales_rowid'],)).fetchone()[0]
+        return day is not None and day <= run['fitted_through']
+
+    # ===== Loading =====
+
+    def load_products(self):
+        """Load product codes as the matrix row order"""
+        # Rollup product codes are TEXT, the simple schema's product codes are INTEGER
+        return [str(row[0]) for row in self.conn.execute(
+            "SELECT product_code FROM products ORDER BY product_code")]
+
+    def load_state(self, index):
+        """Load the stored level and trend of each product"""
+        level = np.zeros(len(index))
+        trend = np.zeros(len(index))
+        for product_code, product_level, product_trend in self.conn.execute(
+                "SELECT product_code, level, trend FROM demand_forecasts"):
+            i = index.get(product_code)
+            if i is not None:
+                level[i] = product_level
+                trend[i] = product_trend
+        return level, trend
+
+    def load_matrix(self, start_day, days, product_count):
+        """Load a product x day demand matrix for a range of days"""
+        end_day = start_day + datetime.timedelta(days=days - 1)
+        # One row per day with its cells packed into strings keeps Python object creation
+        # per day instead of per product and day
+        rows = self.conn.execute('''
+            SELECT CAST(julianday(r.day) - julianday(?) AS INTEGER),
+                   group_concat(i.idx), group_concat(r.quantity)
+            FROM sales_product_daily r
+            JOIN temp.forecast_index i ON i.product_code = r.product_code
+            WHERE r.day BETWEEN ? AND ?
+            GROUP BY r.day
+        ''', (start_day.isoformat(), start_day.isoformat(), end_day.isoformat())).fetchall()
+
+        matrix = np.zeros((product_count, days))
+        for offset, indexes, quantities in rows:
+            matrix[np.fromstring(indexes, dtype=np.int64, sep=','), offset] = \
+                np.fromstring(quantities, dtype=np.float64, sep=',')
+        return matrix
+
+    def first_sales_day(self):
+        """Get the first day with sales in the rollup, or None"""
+        day = self.conn.execute("SELECT MIN(day) FROM sales_product_daily WHERE day != ''").fetchone()[0]
+        return datetime.date.fromisoformat(day) if day else None
+
+    # ===== Fitting =====
+
+    def smooth(self, level, trend, matrix):
+        """Run the smoothing recursion over each day column for all products at once"""
+        alpha, beta = self.alpha, self.beta
+        for t in range(matrix.shape[1]):
+            previous = level
+            level = alpha * matrix[:, t] + (1 - alpha) * (level + trend)
+            if beta:
+                trend = beta * (level - previous) + (1 - beta) * trend
+        return level, trend
+
+    def fit(self, through=None, full=False):
+        """Fit forecasts up to a day, processing only days after the last run"""
+        # Today is still in progress, so fit through yesterday by default
+        through = through or datetime.date.today() - datetime.timedelta(days=1)
+        run = self.last_run()
+        sales_rowid = self.conn.execute("SELECT MAX(rowid) FROM sales").fetchone()[0] or 0
+
+        codes = self.load_products()
+        index = {code: i for i, code in enumerate(codes)}
+
+        # The smoothing runs forward from the stored state, so demand added to days it
+        # already passed means starting over
+        if full or run is None or not self.same_settings(run) or self.backdated(run):
+            start = self.first_sales_day()
+            if start is None or start > through:
+                return 0
+            level, trend = np.zeros(len(codes)), np.zeros(len(codes))
+            initialize = True
+        else:
+            start = datetime.date.fromisoformat(run['fitted_through']) + datetime.timedelta(days=1)
+            if start > through:
+                return 0
+            # Products added since the last run start from zero
+            level, trend = self.load_state(index)
+            initialize = False
+
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS forecast_index (product_code TEXT PRIMARY KEY, idx INTEGER)")
+            cursor.execute("DELETE FROM temp.forecast_index")
+            cursor.executemany("INSERT INTO temp.forecast_index VALUES (?, ?)", index.items())
+
+            total_days = (through - start).days + 1
+            day = start
+            while day <= through:
+                days = min(self.chunk_days, (through - day).days + 1)
+                matrix = self.load_matrix(day, days, len(codes))
+                if initialize:
+                    # Start each level at the product's average over its first week
+                    level = matrix[:, :7].mean(axis=1)
+                    initialize = False
+                level, trend = self.smooth(level, trend, matrix)
+                day += datetime.timedelta(days=days)
+
+            steps = np.arange(1, self.horizon_days + 1)
+            path = np.maximum(level[:, None] + trend[:, None] * steps, 0)
+            daily = path[:, 0]
+            horizon_total = path.sum(axis=1)
+
+            cursor.execute("DELETE FROM demand_forecasts")
+            cursor.executemany('''
+                INSERT INTO demand_forecasts (product_code, level, trend, daily_forecast,
+                                            horizon_total, fitted_through)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', zip(codes, level.tolist(), trend.tolist(), daily.tolist(), horizon_total.tolist(),
+                     [through.isoformat()] * len(codes)))
+            cursor.execute('''
+                INSERT INTO forecast_runs (method, alpha, beta, horizon_days, first_day,
+                                         fitted_through, products, sales_rowid)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (self.method, self.alpha, self.beta, self.horizon_days, start.isoformat(),
+                  through.isoformat(), len(codes), sales_rowid))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return total_days
+
+    # ===== Reads =====
+
+    def forecast(self, product_code, days=None):
+        """Get a product's forecast quantities for the next days"""
+        days = days or self.horizon_days
+        row = self.conn.execute(
+            "SELECT level, trend FROM demand_forecasts WHERE product_code = ?",
+            (str(product_code),)).fetchone()
+        if row is None:
+            return [0.0] * days
+        level, trend = row
+        return [max(level + trend * step, 0.0) for step in range(1, days + 1)]
+
+    def forecast_revenue(self):
+        """Get forecast revenue over the horizon at current prices"""
+        row = self.conn.execute(f'''
+            SELECT SUM(f.horizon_total * COALESCE(p.{self.sale_price}, 0))
+            FROM demand_forecasts f
+            JOIN products p ON CAST(p.product_code AS TEXT) = f.product_code
+        ''').fetchone()
+        return row[0] or 0
+
+
+def main():
+    """Fit demand forecasts from the command line"""
+    parser = argparse.ArgumentParser(description="Fit per-product demand forecasts")
+    parser.add_argument('database', help="SQLite database file")
+    parser.add_argument('--method', choices=(SIMPLE_SMOOTHING, HOLT_SMOOTHING), default=HOLT_SMOOTHING)
+    parser.add_argument('--alpha', type=float, default=0.3, help="Level smoothing factor")
+    parser.add_argument('--beta', type=float, default=0.1, help="Trend smoothing factor")
+    parser.add_argument('--horizon', type=int, default=30, help="Days to forecast")
+    parser.add_argument('--full', action='store_true', help="Refit from the first day of history")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        RollupStore(conn).create_tables()
+        forecaster = DemandForecaster(conn, args.method, args.alpha, args.beta, args.horizon)
+        forecaster.create_tables()
+        days = forecaster.fit(full=args.full)
+        print(f"Forecasts fitted over {days} new days")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
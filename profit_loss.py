@@ -0,0 +1,153 @@
+import argparse
+import datetime
+import sqlite3
+
+from erp_schema import table_exists
+from expenses import ExpenseLedger
+from rollups import RollupStore
+
+
+MONTH = 'month'
+QUARTER = 'quarter'
+YEAR = 'year'
+PERIODS = (MONTH, QUARTER, YEAR)
+
+
+def period_start(period, day):
+    """Get the first day of the period containing a day"""
+    if period == MONTH:
+        return day.replace(day=1)
+    if period == QUARTER:
+        return day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+    if period == YEAR:
+        return day.replace(month=1, day=1)
+    raise ValueError(f"Unknown period: {period}")
+
+
+def shift_period(period, start, count):
+    """Move a period start by a number of periods"""
+    months = {MONTH: 1, QUARTER: 3, YEAR: 12}[period] * count
+    month_index = start.year * 12 + start.month - 1 + months
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def period_bounds(period, day):
+    """Get the first and last day of the period containing a day"""
+    start = period_start(period, day)
+    end = shift_period(period, start, 1) - datetime.timedelta(days=1)
+    return start, end
+
+
+def period_label(period, start):
+    """Get a display label for a period"""
+    if period == MONTH:
+        return start.strftime("%Y-%m")
+    if period == QUARTER:
+        return f"{start.year}-Q{(start.month - 1) // 3 + 1}"
+    return str(start.year)
+
+
+class ProfitAndLoss:
+    def __init__(self, conn):
+        self.conn = conn
+        self.expenses = ExpenseLedger(conn)
+
+    def create_indexes(self):
+        """Create the indexes period totals are read through"""
+        if self.has_expenses():
+            # Brings an existing expenses table up to the ledger layout and its indexes
+            self.expenses.create_tables()
+
+    def has_expenses(self):
+        """Check whether the database has an expenses table"""
+        return table_exists(self.conn, 'expenses')
+
+    # ===== Totals =====
+
+    def sales_totals(self, date_from, date_to):
+        """Get gross sales, discounts, net sales and cost of goods sold for a date range"""
+        row = self.conn.execute('''
+            SELECT COALESCE(SUM(gross), 0), COALESCE(SUM(discount), 0),
+                   COALESCE(SUM(net), 0), COALESCE(SUM(cost), 0)
+            FROM sales_daily
+            WHERE day BETWEEN ? AND ?
+        ''', (str(date_from), str(date_to))).fetchone()
+        return row
+
+    def expense_total(self, date_from, date_to):
+        """Get total expenses for a date range"""
+        if not self.has_expenses():
+            return 0
+        return self.expenses.total(date_from, date_to)
+
+    def statement(self, date_from, date_to):
+        """Get the profit and loss statement for a date range"""
+        gross, discount, revenue, cogs = self.sales_totals(date_from, date_to)
+        expenses = self.expense_total(date_from, date_to)
+        gross_profit = revenue - cogs
+        net_profit = gross_profit - expenses
+        return {
+            'date_from': str(date_from),
+            'date_to': str(date_to),
+            'gross_sales': gross,
+            'discount': discount,
+            'revenue': revenue,
+            'cogs': cogs,
+            'gross_profit': gross_profit,
+            'expenses': expenses,
+            'net_profit': net_profit,
+            'margin_pct': round(100.0 * net_profit / revenue, 2) if revenue else None,
+        }
+
+    # ===== Periods =====
+
+    def period_statement(self, period, day=None):
+        """Get the statement of the month, quarter or year containing a day"""
+        start, end = period_bounds(period, day or datetime.date.today())
+        result = self.statement(start, end)
+        result['period'] = period_label(period, start)
+        return result
+
+    def compare(self, period, day=None):
+        """Compare a period with the previous one and the same period a year earlier"""
+        start = period_start(period, day or datetime.date.today())
+        return {
+            'current': self.period_statement(period, start),
+            'previous': self.period_statement(period, shift_period(period, start, -1)),
+            'last_year': self.period_statement(period, shift_period(period, start, -12 if period == MONTH
+                                                                   else -4 if period == QUARTER else -1)),
+        }
+
+    def series(self, period, count, day=None):
+        """Get statements for the last periods up to the one containing a day, oldest first"""
+        start = period_start(period, day or datetime.date.today())
+        return [self.period_statement(period, shift_period(period, start, offset))
+                for offset in range(1 - count, 1)]
+
+
+def main():
+    """Print a profit and loss comparison from the command line"""
+    parser = argparse.ArgumentParser(description="Profit and loss by period")
+    parser.add_argument('database', help="SQLite database file")
+    parser.add_argument('--period', choices=PERIODS, default=MONTH)
+    parser.add_argument('--date', help="Day inside the period (YYYY-MM-DD), default today")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        RollupStore(conn).create_tables()
+        pnl = ProfitAndLoss(conn)
+        pnl.create_indexes()
+        day = datetime.date.fromisoformat(args.date) if args.date else None
+        comparison = pnl.compare(args.period, day)
+
+        print(f"{'':<14}" + "".join(f"{comparison[key]['period']:>14}" for key in ('current', 'previous', 'last_year')))
+        for field in ('revenue', 'cogs', 'gross_profit', 'expenses', 'net_profit'):
+            print(f"{field:<14}" + "".join(f"{comparison[key][field]:>14.2f}"
+                                           for key in ('current', 'previous', 'last_year')))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
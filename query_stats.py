@@ -0,0 +1,376 @@
+import argparse
+import bisect
+import datetime
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+from db_targets import FILE, open_target
+from erp_logging import json_file_logger
+
+
+# Upper bounds of the latency histogram buckets in ms, the last bucket takes the rest
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+DEFAULT_THRESHOLD_MS = 100
+SLOW_LOG_SIZE = 500
+# Size of the slow query log file before it rolls over, and rolled files kept
+SLOW_LOG_BYTES = 2 * 1024 * 1024
+SLOW_LOG_BACKUPS = 3
+
+# Statements EXPLAIN QUERY PLAN understands
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+VALUES_LIST = re.compile(r"\(\?\+?\)(?:\s*,\s*\(\?\+?\))+")
+NAMED_PARAMETER = re.compile(r"[:@$]\w+")
+WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def normalize(sql):
+    """Get the shape of a statement, with literals and parameter lists folded"""
+    shape = STRING_LITERAL.sub('?', sql)
+    shape = NAMED_PARAMETER.sub('?', shape)
+    shape = NUMBER_LITERAL.sub('?', shape)
+    shape = WHITESPACE.sub(' ', shape).strip()
+    # IN lists and multi-row VALUES of any length share one shape
+    shape = PLACEHOLDER_LIST.sub('?+', shape)
+    shape = VALUES_LIST.sub('(?+)+', shape)
+    return shape
+
+
+def statement_kind(sql):
+    """Get the leading keyword of a statement"""
+    match = re.match(r"\s*(\w+)", sql)
+    return match.group(1).upper() if match else ''
+
+
+def bucket_percentile(histogram, fraction):
+    """Estimate a percentile in ms from histogram counts"""
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    rank = total * fraction
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= rank:
+            return float(BUCKETS_MS[i]) if i < len(BUCKETS_MS) else float('inf')
+    return float('inf')
+
+
+def call_site():
+    """Get 'file:line in function' of the first caller outside this module"""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return ''
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{frame.f_lineno} in {code.co_name}"
+
+
+# ===== Statistics =====
+
+class ShapeStats:
+    def __init__(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+        self.sites = {}
+        self.sample = ''
+
+    def add(self, sql, elapsed_ms, rows, site):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows += rows
+        self.histogram[bisect.bisect_left(BUCKETS_MS, elapsed_ms)] += 1
+        self.sites[site] = self.sites.get(site, 0) + 1
+        self.sample = sql
+
+    def percentile(self, fraction):
+        # A bucket bound can overshoot the slowest statement seen
+        return min(bucket_percentile(self.histogram, fraction), round(self.max_ms, 3))
+
+    def to_dict(self):
+        return {
+            'shape': self.shape,
+            'count': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+            'max_ms': round(self.max_ms, 3),
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'rows': self.rows,
+            'histogram': self.histogram,
+            'sites': dict(sorted(self.sites.items(), key=lambda item: -item[1])),
+            'sample': self.sample,
+        }
+
+
+class QueryStats:
+    def __init__(self, threshold_ms=DEFAULT_THRESHOLD_MS, log_path=None, log_size=SLOW_LOG_SIZE):
+        self.threshold_ms = threshold_ms
+        self.log_path = log_path
+        self.slow_log = json_file_logger('erp.db.slow_queries', log_path, SLOW_LOG_BYTES,
+                                         SLOW_LOG_BACKUPS) if log_path else None
+        self.enabled = True
+        self.shapes = {}
+        self.slow = deque(maxlen=log_size)
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, conn, sql, parameters, elapsed_ms, rows, site):
+        """Add a finished statement and log it with its plan when it is slow"""
+        shape = normalize(sql)
+        with self.lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                stats = self.shapes[shape] = ShapeStats(shape)
+            stats.add(sql, elapsed_ms, rows, site)
+        if self.threshold_ms is not None and elapsed_ms >= self.threshold_ms:
+            self.log_slow(conn, sql, parameters, shape, elapsed_ms, rows, site)
+
+    def log_slow(self, conn, sql, parameters, shape, elapsed_ms, rows, site):
+        entry = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'ms': round(elapsed_ms, 3),
+            'rows': rows,
+            'site': site,
+            'shape': shape,
+            'sql': sql.strip(),
+            'plan': explain(conn, sql, parameters),
+        }
+        with self.lock:
+            self.slow.append(entry)
+        if self.slow_log:
+            self.slow_log.info("Query took %.1f ms at %s", elapsed_ms, site, extra=entry)
+
+    def reset(self):
+        """Forget collected statistics and the in-memory slow log"""
+        with self.lock:
+            self.shapes.clear()
+            self.slow.clear()
+            self.started = time.time()
+
+    def to_dict(self):
+        """Get statistics per shape, slowest total first, and the slow log"""
+        with self.lock:
+            shapes = [stats.to_dict() for stats in self.shapes.values()]
+            slow = list(self.slow)
+        shapes.sort(key=lambda item: -item['total_ms'])
+        return {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'exported': datetime.datetime.now().isoformat(timespec='seconds'),
+            'threshold_ms': self.threshold_ms,
+            'buckets_ms': list(BUCKETS_MS),
+            'statements': sum(item['count'] for item in shapes),
+            'shapes': shapes,
+            'slow': slow,
+        }
+
+    def export(self, path):
+        """Write the statistics as JSON"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def explain(conn, sql, parameters):
+    """Get EXPLAIN QUERY PLAN lines for a statement, or why there are none"""
+    if statement_kind(sql) not in EXPLAINABLE:
+        return []
+    # A plain cursor, so the plan lookup is not timed itself
+    cursor = sqlite3.Cursor(conn)
+    try:
+        rows = cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f"(no plan: {e})"]
+    finally:
+        cursor.close()
+    # Indent each step under its parent
+    depth = {0: 0}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, 0) + 1
+        lines.append('  ' * (depth[node] - 1) + detail)
+    return lines
+
+
+# ===== Instrumented Connection =====
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = None
+
+    def execute(self, sql, parameters=()):
+        return self.timed(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # The plan of a slow batch is looked up with its first parameter set
+        seq_of_parameters = list(seq_of_parameters)
+        first = seq_of_parameters[0] if seq_of_parameters else ()
+        return self.timed(super().executemany, sql, seq_of_parameters, first)
+
+    def executescript(self, sql_script):
+        self.finish()
+        stats = getattr(self.connection, 'stats', None)
+        if stats is None or not stats.enabled:
+            return super().executescript(sql_script)
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            stats.record(self.connection, sql_script, (), (time.perf_counter() - start) * 1000, 0, call_site())
+
+    def timed(self, run, sql, parameters, plan_parameters):
+        self.finish()
+        stats = getattr(self.connection, 'stats', None)
+        if stats is None or not stats.enabled:
+            return run(sql, parameters)
+        site = call_site()
+        start = time.perf_counter()
+        try:
+            run(sql, parameters)
+        except Exception:
+            stats.record(self.connection, sql, plan_parameters, (time.perf_counter() - start) * 1000, 0, site)
+            raise
+        elapsed = time.perf_counter() - start
+        if self.description is None:
+            # Writes and DDL are done once execute returns
+            stats.record(self.connection, sql, plan_parameters, elapsed * 1000, max(self.rowcount, 0), site)
+        else:
+            # Rows are stepped while fetching, so the statement ends when the rows run out
+            self.pending = [stats, sql, plan_parameters, elapsed, 0, site]
+        return self
+
+    def finish(self):
+        """Record the current statement with what was fetched so far"""
+        pending = self.pending
+        if pending is not None:
+            self.pending = None
+            stats, sql, parameters, elapsed, rows, site = pending
+            stats.record(self.connection, sql, parameters, elapsed * 1000, rows, site)
+
+    def fetched(self, start, rows, done):
+        pending = self.pending
+        if pending is not None:
+            pending[3] += time.perf_counter() - start
+            pending[4] += rows
+            if done:
+                self.finish()
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.fetched(start, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        pending = self.pending
+        if pending is None:
+            return super().__next__()
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            pending[3] += time.perf_counter() - start
+            self.finish()
+            raise
+        pending[3] += time.perf_counter() - start
+        pending[4] += 1
+        return row
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        # Cursors dropped before their rows ran out still count
+        try:
+            self.finish()
+        except Exception:
+            pass
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    stats = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # The C shortcuts would skip the cursor's timing
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def connect(database, stats, mode=FILE, **kwargs):
+    """Open a connection whose statements are timed into stats"""
+    conn = open_target(database, mode, factory=InstrumentedConnection, **kwargs)
+    conn.stats = stats
+    return conn
+
+
+def print_summary(data, limit=20, out=None):
+    """Print the costliest statement shapes and the slow log"""
+    out = out or sys.stdout
+    print(f"{data['statements']} statements in {len(data['shapes'])} shapes "
+          f"(since {data['started']}, slow from {data['threshold_ms']} ms)", file=out)
+    print(f"{'count':>8}{'total ms':>11}{'mean ms':>9}{'p95 ms':>8}{'max ms':>9}{'rows':>9}  shape", file=out)
+    for item in data['shapes'][:limit]:
+        print(f"{item['count']:>8}{item['total_ms']:>11.1f}{item['mean_ms']:>9.2f}{item['p95_ms']:>8}"
+              f"{item['max_ms']:>9.1f}{item['rows']:>9}  {item['shape'][:100]}", file=out)
+    if data['slow']:
+        print(f"\n{len(data['slow'])} slow statements, latest:", file=out)
+        entry = data['slow'][-1]
+        print(f"  {entry['time']} {entry['ms']:.1f} ms at {entry['site']}", file=out)
+        print(f"  {entry['sql'][:200]}", file=out)
+        for line in entry['plan']:
+            print(f"    {line}", file=out)
+
+
+def main():
+    """Summarize exported query statistics from the command line"""
+    parser = argparse.ArgumentParser(description="Summarize a JSON export of query statistics")
+    parser.add_argument('export', help="JSON file written from the diagnostics window")
+    parser.add_argument('--limit', type=int, default=20, help="Shapes to show")
+    args = parser.parse_args()
+    with open(args.export, encoding='utf-8') as f:
+        print_summary(json.load(f), args.limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import argparse
+import datetime
+import sqlite3
+from statistics import NormalDist
+
+import numpy as np
+
+from erp_schema import ERP_SCHEMA, detect_schema, table_exists
+from rollups import DRAFT_STATUS, RollupStore
+from stock_levels import StockLevels
+
+
+# Purchase invoices created by the engine wait for review as DRAFT_STATUS drafts with this prefix
+DRAFT_PREFIX = 'DRAFT-'
+
+
+class ReplenishmentEngine:
+    def __init__(self, conn, history_days=730, lead_time_days=7, review_days=30,
+                 service_level=0.95):
+        self.conn = conn
+        self.history_days = history_days
+        self.lead_time_days = lead_time_days
+        self.review_days = review_days
+        self.service_level = service_level
+
+        if detect_schema(conn) != ERP_SCHEMA:
+            raise ValueError("Replenishment needs the purchases tables of the ERP schema")
+
+    def create_tables(self):
+        """Create the replenishment plan table"""
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS replenishment_plan (
+                product_code TEXT PRIMARY KEY,
+                avg_daily_demand REAL NOT NULL DEFAULT 0,
+                demand_std REAL NOT NULL DEFAULT 0,
+                safety_stock INTEGER NOT NULL DEFAULT 0,
+                reorder_point INTEGER NOT NULL DEFAULT 0,
+                order_up_to INTEGER NOT NULL DEFAULT 0,
+                balance INTEGER NOT NULL DEFAULT 0,
+                on_order INTEGER NOT NULL DEFAULT 0,
+                suggested_qty INTEGER NOT NULL DEFAULT 0,
+                supplier_code TEXT,
+                unit_cost REAL NOT NULL DEFAULT 0,
+                calculated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_status ON purchases (invoice_status)")
+        self.conn.commit()
+
+    # ===== Loading =====
+
+    def load_products(self):
+        """Load product codes, balances and fallback costs"""
+        rows = self.conn.execute('''
+            SELECT p.product_code, COALESCE(b.balance, 0), COALESCE(p.purchase_price, 0)
+            FROM products p
+            LEFT JOIN stock_balances b ON b.product_key = p.product_code
+            ORDER BY p.product_code
+        ''').fetchall()
+        codes = [row[0] for row in rows]
+        balance = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+        cost = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+        return codes, balance, cost
+
+    def load_demand(self, index, start_day):
+        """Load per-product sums of daily demand and squared daily demand"""
+        # Days without sales are zero demand, so the sums are enough for mean and variance
+        total = np.zeros(len(index))
+        total_sq = np.zeros(len(index))
+        rows = self.conn.execute('''
+            SELECT product_code, SUM(quantity), SUM(quantity * quantity)
+            FROM sales_product_daily
+            WHERE day >= ?
+            GROUP BY product_code
+        ''', (start_day,)).fetchall()
+        for product_code, quantity, quantity_sq in rows:
+            i = index.get(product_code)
+            if i is not None:
+                total[i] = quantity
+                total_sq[i] = quantity_sq
+        return total, total_sq
+
+    def load_forecast(self, index):
+        """Load forecast daily demand, with NaN for products without a forecast"""
+        rate = np.full(len(index), np.nan)
+        if not table_exists(self.conn, 'demand_forecasts'):
+            return rate
+        rows = self.conn.execute('''
+            SELECT f.product_code, f.horizon_total / r.horizon_days
+            FROM demand_forecasts f
+            JOIN (SELECT horizon_days FROM forecast_runs ORDER BY id DESC LIMIT 1) r
+        ''').fetchall()
+        for product_code, daily in rows:
+            i = index.get(product_code)
+            if i is not None:
+                rate[i] = daily
+        return rate
+
+    def load_on_order(self, index):
+        """Load quantities on hand-entered draft purchase invoices"""
+        on_order = np.zeros(len(index))
+        rows = self.conn.execute('''
+            SELECT d.product_code, SUM(d.quantity)
+            FROM purchase_details d
+            JOIN purchases p ON p.invoice_number = d.invoice_number
+            WHERE p.invoice_status = ? AND p.invoice_number NOT LIKE ?
+            GROUP BY d.product_code
+        ''', (DRAFT_STATUS, DRAFT_PREFIX + '%')).fetchall()
+        for product_code, quantity in rows:
+            i = index.get(product_code)
+            if i is not None:
+                on_order[i] = quantity or 0
+        return on_order
+
+    def load_suppliers(self, index):
+        """Get each product's supplier and price from its latest purchase"""
+        suppliers = [None] * len(index)
+        prices = np.zeros(len(index))
+        rows = self.conn.execute('''
+            SELECT product_code, supplier_code, price
+            FROM (
+                SELECT d.product_code, p.supplier_code, d.price,
+                       ROW_NUMBER() OVER (PARTITION BY d.product_code
+                                          ORDER BY p.invoice_date DESC, d.id DESC) AS rank
+                FROM purchase_details d
+                JOIN purchases p ON p.invoice_number = d.invoice_number
+                WHERE COALESCE(p.invoice_status, '') != ?
+            )
+            WHERE rank = 1
+        ''', (DRAFT_STATUS,)).fetchall()
+        for product_code, supplier_code, price in rows:
+            i = index.get(product_code)
+            if i is not None:
+                suppliers[i] = supplier_code
+                prices[i] = price or 0
+        return suppliers, prices
+
+    # ===== Calculation =====
+
+    def calculate(self, as_of=None):
+        """Compute reorder points and order quantities for all products"""
+        as_of = as_of or datetime.date.today()
+        start_day = (as_of - datetime.timedelta(days=self.history_days - 1)).isoformat()
+
+        codes, balance, cost = self.load_products()
+        index = {code: i for i, code in enumerate(codes)}
+        total, total_sq = self.load_demand(index, start_day)
+        on_order = self.load_on_order(index)
+        suppliers, last_price = self.load_suppliers(index)
+
+        days = float(self.history_days)
+        history_mean = total / days
+        std = np.sqrt(np.maximum(total_sq / days - history_mean * history_mean, 0))
+
+        # Prefer the smoothed forecast over the flat history average where one exists
+        forecast = self.load_forecast(index)
+        mean = np.where(np.isnan(forecast), history_mean, forecast)
+
+        z = NormalDist().inv_cdf(self.service_level)
+        lead_time = float(self.lead_time_days)
+        safety_stock = np.ceil(z * std * np.sqrt(lead_time))
+        reorder_point = np.ceil(mean * lead_time) + safety_stock
+        order_up_to = np.ceil(mean * (lead_time + self.review_days)) + safety_stock
+
+        position = balance + on_order
+        needs_order = (mean > 0) & (position <= reorder_point)
+        suggested = np.where(needs_order, np.maximum(order_up_to - position, 0), 0)
+
+        return {
+            'product_code': codes,
+            'avg_daily_demand': mean,
+            'demand_std': std,
+            'safety_stock': safety_stock.astype(np.int64),
+            'reorder_point': reorder_point.astype(np.int64),
+            'order_up_to': order_up_to.astype(np.int64),
+            'balance': balance.astype(np.int64),
+            'on_order': on_order.astype(np.int64),
+            'suggested_qty': suggested.astype(np.int64),
+            'supplier_code': suppliers,
+            'unit_cost': np.where(last_price > 0, last_price, cost),
+        }
+
+    def save_plan(self, plan):
+        """Replace the stored plan with a new one"""
+        rows = zip(
+            plan['product_code'],
+            plan['avg_daily_demand'].tolist(),
+            plan['demand_std'].tolist(),
+            plan['safety_stock'].tolist(),
+            plan['reorder_point'].tolist(),
+            plan['order_up_to'].tolist(),
+            plan['balance'].tolist(),
+            plan['on_order'].tolist(),
+            plan['suggested_qty'].tolist(),
+            plan['supplier_code'],
+            plan['unit_cost'].tolist(),
+        )
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("DELETE FROM replenishment_plan")
+            cursor.executemany('''
+                INSERT INTO replenishment_plan (product_code, avg_daily_demand, demand_std,
+                    safety_stock, reorder_point, order_up_to, balance, on_order,
+                    suggested_qty, supplier_code, unit_cost)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def apply_reorder_points(self, plan):
+        """Use calculated reorder points as product minimum limits"""
+        # Products without sales history keep their hand-entered limit
+        has_demand = plan['avg_daily_demand'] > 0
+        codes = [code for code, keep in zip(plan['product_code'], has_demand) if keep]
+        limits = plan['reorder_point'][has_demand].tolist()
+
+        stock_levels = StockLevels(self.conn, ERP_SCHEMA)
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany("UPDATE products SET minimum_limit = ? WHERE product_code = ?",
+                               zip(limits, codes))
+            changes = stock_levels.evaluate(cursor, codes)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return changes
+
+    # ===== Draft Purchase Invoices =====
+
+    def write_drafts(self, plan, invoice_date=None):
+        """Replace engine drafts with one draft purchase invoice per supplier"""
+        invoice_date = invoice_date or datetime.date.today()
+        orders = {}
+        unassigned = 0
+        for i in np.flatnonzero(plan['suggested_qty'] > 0).tolist():
+            supplier_code = plan['supplier_code'][i]
+            if supplier_code is None:
+                # Never purchased before, so there is no supplier to order from
+                unassigned += 1
+                continue
+            quantity = int(plan['suggested_qty'][i])
+            price = float(plan['unit_cost'][i])
+            orders.setdefault(supplier_code, []).append(
+                (plan['product_code'][i], quantity, price, round(quantity * price, 2)))
+
+        cursor = self.conn.cursor()
+        invoices = []
+        try:
+            cursor.execute('''
+                DELETE FROM purchase_details WHERE invoice_number IN (
+                    SELECT invoice_number FROM purchases
+                    WHERE invoice_status = ? AND invoice_number LIKE ?
+                )
+            ''', (DRAFT_STATUS, DRAFT_PREFIX + '%'))
+            cursor.execute("DELETE FROM purchases WHERE invoice_status = ? AND invoice_number LIKE ?",
+                           (DRAFT_STATUS, DRAFT_PREFIX + '%'))
+
+            for number, supplier_code in enumerate(sorted(orders), 1):
+                lines = orders[supplier_code]
+                invoice_number = f"{DRAFT_PREFIX}{invoice_date:%Y%m%d}-{number:04d}"
+                total = round(sum(line[3] for line in lines), 2)
+                cursor.execute('''
+                    INSERT INTO purchases (invoice_number, invoice_date, supplier_code,
+                                         total_invoice, discount, net_invoice, invoice_status)
+                    VALUES (?, ?, ?, ?, 0, ?, ?)
+                ''', (invoice_number, invoice_date.isoformat(), supplier_code, total, total, DRAFT_STATUS))
+                cursor.executemany('''
+                    INSERT INTO purchase_details (invoice_number, product_code, quantity, price, total)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(invoice_number,) + line for line in lines])
+                invoices.append((invoice_number, supplier_code, len(lines), total))
+
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return invoices, unassigned
+
+    def run(self, write_drafts=True, apply_limits=False):
+        """Recalculate the plan and optionally write drafts and minimum limits"""
+        plan = self.calculate()
+        self.save_plan(plan)
+        result = {'products': len(plan['product_code']),
+                  'to_order': int((plan['suggested_qty'] > 0).sum()),
+                  'invoices': [], 'unassigned': 0, 'changes': []}
+        if apply_limits:
+            result['changes'] = self.apply_reorder_points(plan)
+        if write_drafts:
+            result['invoices'], result['unassigned'] = self.write_drafts(plan)
+        return result
+
+
+def main():
+    """Recalculate replenishment suggestions from the command line"""
+    parser = argparse.ArgumentParser(description="Calculate reorder points and draft purchase invoices")
+    parser.add_argument('database', help="SQLite database file")
+    parser.add_argument('--lead-time', type=int, default=7, help="Supplier lead time in days")
+    parser.add_argument('--review-days', type=int, default=30, help="Days of demand covered by an order")
+    parser.add_argument('--service-level', type=float, default=0.95, help="Target service level")
+    parser.add_argument('--no-drafts', action='store_true', help="Only store the plan")
+    parser.add_argument('--apply-limits', action='store_true', help="Use reorder points as minimum limits")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        RollupStore(conn, ERP_SCHEMA).create_tables()
+        StockLevels(conn, ERP_SCHEMA).create_tables()
+        engine = ReplenishmentEngine(conn, lead_time_days=args.lead_time, review_days=args.review_days,
+                                     service_level=args.service_level)
+        engine.create_tables()
+        result = engine.run(write_drafts=not args.no_drafts, apply_limits=args.apply_limits)
+        print(f"{result['to_order']} of {result['products']} products need ordering, "
+              f"{len(result['invoices'])} draft invoices written, "
+              f"{result['unassigned']} products without a known supplier")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from erp_logging import swallowed
+
+
+log = logging.getLogger('erp.cache')
+
+
+# ===== Table Change Counters =====
+
+class TableVersions:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def install(self, tables):
+        """Create change counters and triggers for tables"""
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS table_versions (
+                table_name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        for table in tables:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO table_versions (table_name, version) VALUES (?, 0)", (table,))
+            # Triggers keep the counters right for writes from any connection or process
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                self.conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS bump_version_{table}_{event.lower()}
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE table_versions SET version = version + 1 WHERE table_name = '{table}';
+                    END
+                ''')
+        self.conn.commit()
+
+    def get(self, tables):
+        """Get current change counters for tables"""
+        tables = sorted(set(tables))
+        if not tables:
+            return ()
+        placeholders = ', '.join('?' for _ in tables)
+        versions = dict(self.conn.execute(
+            f"SELECT table_name, version FROM table_versions WHERE table_name IN ({placeholders})",
+            tables).fetchall())
+        return tuple((table, versions.get(table, 0)) for table in tables)
+
+
+# ===== Report Result Cache =====
+
+class ReportCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_rows=100000, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def make_key(report_id, params, sort, versions):
+        """Build a cache key from a report run"""
+        return (report_id, tuple(sorted(params.items())), sort, versions)
+
+    def get(self, key):
+        """Get cached rows for a key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        rows = self.load_from_disk(key)
+        with self.lock:
+            if rows is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.put(key, rows, persist=False)
+        return rows
+
+    def put(self, key, rows, persist=True):
+        """Store rows for a key, evicting least recently used entries"""
+        data = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+        size = len(data)
+        if size > self.max_bytes:
+            return False
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (rows, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+        if persist:
+            self.save_to_disk(key, data)
+        return True
+
+    def clear(self):
+        """Drop all cached results"""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        if self.cache_dir:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.pickle'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def stats(self):
+        """Get cache statistics"""
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    # ===== Disk Persistence =====
+
+    def entry_path(self, key):
+        """Get the file path for a cache key"""
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.pickle")
+
+    def save_to_disk(self, key, data):
+        """Write a cache entry to disk"""
+        if not self.cache_dir:
+            return
+        path = self.entry_path(key)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump((key, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self.prune_disk()
+
+    def load_from_disk(self, key):
+        """Read a cache entry from disk, or None"""
+        if not self.cache_dir:
+            return None
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                stored_key, data = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            # A damaged entry is recomputed, but should not go unnoticed
+            swallowed(log, "Could not read cache entry %s", path)
+            return None
+        if stored_key != key:
+            return None
+        return pickle.loads(data)
+
+    def prune_disk(self):
+        """Remove the oldest cache files above the memory cap"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pickle'):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
@@ -0,0 +1,769 @@
+import csv
+import datetime
+import sys
+
+from erp_schema import ERP_SCHEMA, SIMPLE_SCHEMA, detect_schema
+from report_cache import ReportCache, TableVersions
+
+
+# Column types understood by the outputs
+COLUMN_TYPES = ('text', 'date', 'int', 'money', 'float')
+
+# Filters a report can declare, with the SQL placeholder name they bind to
+PARAMETER_NAMES = ('date_from', 'date_to', 'customer', 'product', 'status')
+
+SORT_DIRECTIONS = ('ASC', 'DESC')
+
+
+def today():
+    """Get today's date as text"""
+    return datetime.date.today().strftime("%Y-%m-%d")
+
+
+def first_day_of_year():
+    """Get the first day of the current year as text"""
+    return datetime.date.today().replace(month=1, day=1).strftime("%Y-%m-%d")
+
+
+DEFAULT_PARAMETERS = {
+    'date_from': first_day_of_year,
+    'date_to': today,
+}
+
+
+class ReportColumn:
+    def __init__(self, key, title, type='text', width=120):
+        if type not in COLUMN_TYPES:
+            raise ValueError(f"Unknown column type: {type}")
+        self.key = key
+        self.title = title
+        self.type = type
+        self.width = width
+
+
+class ReportDefinition:
+    def __init__(self, report_id, title, schema, sql, columns,
+                 parameters=(), defaults=None, default_sort=None, limit=None, tables=()):
+        for name in parameters:
+            if name not in PARAMETER_NAMES:
+                raise ValueError(f"Unknown report parameter: {name}")
+        self.report_id = report_id
+        self.title = title
+        self.schema = schema
+        self.sql = sql
+        self.columns = columns
+        self.parameters = tuple(parameters)
+        self.defaults = dict(DEFAULT_PARAMETERS, **(defaults or {}))
+        self.default_sort = default_sort
+        self.limit = limit
+        # Tables the report reads, used to know when its results change
+        self.tables = tuple(tables)
+
+    def column_keys(self):
+        """Get report column keys"""
+        return [col.key for col in self.columns]
+
+    def column_titles(self):
+        """Get report column titles"""
+        return [col.title for col in self.columns]
+
+
+REPORTS = {}
+
+
+def register_report(report):
+    """Add a report definition to the registry"""
+    if report.report_id in REPORTS:
+        raise ValueError(f"Report already registered: {report.report_id}")
+    REPORTS[report.report_id] = report
+    return report
+
+
+def reports_for(schema):
+    """Get registered reports for a schema, in registration order"""
+    return [report for report in REPORTS.values() if report.schema == schema]
+
+
+# ===== Report Engine =====
+
+class ReportEngine:
+    def __init__(self, conn, schema=None, batch_size=1000, cache=None, read_only=False):
+        self.conn = conn
+        self.schema = schema or detect_schema(conn)
+        self.batch_size = batch_size
+        # Cached results are checked against counters kept by triggers this engine installs,
+        # which a read-only connection cannot do
+        self.cache = None if read_only else cache
+        self.read_only = read_only
+        self.table_versions = TableVersions(conn)
+
+        if self.cache is not None:
+            tables = set()
+            for report in reports_for(self.schema):
+                tables.update(report.tables)
+            self.table_versions.install(sorted(tables))
+
+    def get_report(self, report_id):
+        """Get report definition by ID"""
+        report = REPORTS.get(report_id)
+        if report is None or report.schema != self.schema:
+            raise KeyError(f"Unknown report for {self.schema}: {report_id}")
+        return report
+
+    def find_by_title(self, title):
+        """Get report definition by title for this schema"""
+        for report in reports_for(self.schema):
+            if report.title == title:
+                return report
+        raise KeyError(f"Unknown report: {title}")
+
+    def resolve_params(self, report, params=None):
+        """Fill report parameters with defaults"""
+        params = params or {}
+        resolved = {name: None for name in PARAMETER_NAMES}
+
+        for name in report.parameters:
+            value = params.get(name)
+            if value in (None, ''):
+                value = report.defaults.get(name)
+                value = value() if callable(value) else value
+            resolved[name] = value
+        return resolved
+
+    def order_by(self, report, sort=None):
+        """Check a 'column [ASC|DESC], ...' sort spec against the report columns and rebuild it"""
+        spec = sort or report.default_sort
+        if not spec:
+            return None
+        keys = report.column_keys()
+        terms = []
+        for part in spec.split(','):
+            words = part.split()
+            if not words or len(words) > 2:
+                raise ValueError(f"Cannot sort {report.report_id} by {part.strip()!r}")
+            if words[0] not in keys:
+                raise ValueError(f"Cannot sort {report.report_id} by {words[0]}")
+            direction = words[1].upper() if len(words) == 2 else 'ASC'
+            if direction not in SORT_DIRECTIONS:
+                raise ValueError(f"Sort direction must be ASC or DESC, not {words[1]}")
+            terms.append(f"{words[0]} {direction}")
+        return ', '.join(terms)
+
+    def build_query(self, report, sort=None):
+        """Build the final SQL for a report"""
+        sql = report.sql
+        order_by = self.order_by(report, sort)
+        if order_by:
+            sql += f" ORDER BY {order_by}"
+        if report.limit:
+            sql += f" LIMIT {int(report.limit)}"
+        return sql
+
+    def iter_batches(self, report_id, params=None, sort=None, batch_size=None):
+        """Run a report and yield its rows in batches"""
+        report = self.get_report(report_id)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(self.build_query(report, sort), self.resolve_params(report, params))
+            while True:
+                rows = cursor.fetchmany(batch_size or self.batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def run(self, report_id, output, params=None, sort=None):
+        """Run a report into an output and return the row count"""
+        report = self.get_report(report_id)
+        # A bad sort spec fails before the output has started
+        sort = self.order_by(report, sort)
+        if self.cache is None:
+            return self.stream(report, output, self.iter_batches(report_id, params, sort))
+
+        resolved = self.resolve_params(report, params)
+        key = ReportCache.make_key(report_id, resolved, sort,
+                                   self.table_versions.get(report.tables))
+        rows = self.cache.get(key)
+        if rows is not None:
+            batches = (rows[i:i + self.batch_size] for i in range(0, len(rows), self.batch_size))
+            return self.stream(report, output, batches)
+
+        collected = []
+        count = 0
+        output.begin(report)
+        try:
+            for rows in self.iter_batches(report_id, resolved, sort):
+                output.write(rows)
+                count += len(rows)
+                if collected is not None:
+                    collected.extend(rows)
+                    # Results too large to cache are still streamed, just not kept
+                    if count > self.cache.max_rows:
+                        collected = None
+        finally:
+            output.end()
+
+        if collected is not None:
+            self.cache.put(key, collected)
+        return count
+
+    def export(self, report_id, file_path, params=None, sort=None, batch_size=50000):
+        """Re-run a report straight into a file and return the row count"""
+        report = self.get_report(report_id)
+        sort = self.order_by(report, sort)
+        output = output_for_path(file_path)
+        # The query only starts once the output is ready for rows
+        return self.stream(report, output, self.iter_batches(report_id, params, sort, batch_size))
+
+    def stream(self, report, output, batches):
+        """Feed batches of rows into an output"""
+        count = 0
+        output.begin(report)
+        try:
+            for rows in batches:
+                output.write(rows)
+                count += len(rows)
+        finally:
+            output.end()
+            # A failed write must not leave the report's statement open
+            if hasattr(batches, 'close'):
+                batches.close()
+        return count
+
+
+# ===== Report Outputs =====
+
+class ReportOutput:
+    def begin(self, report):
+        """Prepare output for a report"""
+        self.report = report
+
+    def write(self, rows):
+        """Write a batch of rows"""
+        raise NotImplementedError
+
+    def end(self):
+        """Finish output"""
+
+
+class TreeviewOutput(ReportOutput):
+    def __init__(self, tree):
+        self.tree = tree
+
+    def begin(self, report):
+        super().begin(report)
+        self.tree.delete(*self.tree.get_children())
+        self.tree['columns'] = report.column_titles()
+        self.tree['show'] = 'headings'
+        for col in report.columns:
+            self.tree.heading(col.title, text=col.title)
+            self.tree.column(col.title, width=col.width)
+
+    def write(self, rows):
+        types = [col.type for col in self.report.columns]
+        for row in rows:
+            values = [f"{value:.2f}" if kind == 'money' and value is not None else value
+                      for kind, value in zip(types, row)]
+            self.tree.insert('', 'end', values=values)
+
+
+class CsvOutput(ReportOutput):
+    def __init__(self, file_path, encoding='utf-8'):
+        self.file_path = file_path
+        self.encoding = encoding
+
+    def begin(self, report):
+        super().begin(report)
+        # '-' streams the report to standard output
+        if self.file_path == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(self.file_path, 'w', newline='', encoding=self.encoding)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(report.column_titles())
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def end(self):
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+
+class ExcelOutput(ReportOutput):
+    # Excel sheets hold at most 1,048,576 rows including the header
+    MAX_SHEET_ROWS = 1048575
+
+    def __init__(self, file_path, sheet_name='Report'):
+        self.file_path = file_path
+        self.sheet_name = sheet_name
+
+    def begin(self, report):
+        from openpyxl import Workbook
+
+        super().begin(report)
+        # Write-only workbooks stream rows to disk instead of keeping them in memory
+        self.workbook = Workbook(write_only=True)
+        self.sheet_count = 0
+        self.add_sheet()
+
+    def add_sheet(self):
+        """Start a new sheet with the report header"""
+        self.sheet_count += 1
+        name = self.sheet_name if self.sheet_count == 1 else f"{self.sheet_name} {self.sheet_count}"
+        self.sheet = self.workbook.create_sheet(name)
+        self.sheet.append(self.report.column_titles())
+        self.sheet_rows = 0
+
+    def write(self, rows):
+        for row in rows:
+            if self.sheet_rows >= self.MAX_SHEET_ROWS:
+                self.add_sheet()
+            self.sheet.append(list(row))
+            self.sheet_rows += 1
+
+    def end(self):
+        self.workbook.save(self.file_path)
+
+
+class ParquetOutput(ReportOutput):
+    ARROW_TYPES = {
+        'text': 'string',
+        'date': 'string',
+        'int': 'int64',
+        'money': 'float64',
+        'float': 'float64',
+    }
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def begin(self, report):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        super().begin(report)
+        self.pa = pa
+        self.schema = pa.schema([
+            (col.title, getattr(pa, self.ARROW_TYPES[col.type])())
+            for col in report.columns
+        ])
+        # Each batch becomes its own row group
+        self.writer = pq.ParquetWriter(self.file_path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        arrays = [self.pa.array(values, type=field.type)
+                  for values, field in zip(columns, self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def end(self):
+        self.writer.close()
+
+
+OUTPUT_FORMATS = {
+    '.csv': CsvOutput,
+    '.xlsx': ExcelOutput,
+    '.parquet': ParquetOutput,
+}
+
+
+def output_for_path(file_path):
+    """Pick a file output from the file extension"""
+    if file_path == '-':
+        return CsvOutput(file_path)
+    for extension, output_class in OUTPUT_FORMATS.items():
+        if file_path.lower().endswith(extension):
+            return output_class(file_path)
+    raise ValueError(f"Unsupported export format: {file_path}")
+
+
+# ===== ERPSystem.py Reports =====
+
+# Balances and alerts are maintained by stock_levels.StockLevels, so these
+# reports read only the products currently in the alert table
+STOCK_ALERTS_SQL = '''
+    SELECT *
+    FROM (
+        SELECT
+            p.product_name AS product_name,
+            a.balance AS balance,
+            a.minimum_limit AS minimum_limit,
+            CASE a.status WHEN 'out' THEN 'Out of Stock' ELSE 'Low' END AS status
+        FROM stock_alerts a
+        JOIN products p ON p.product_code = a.product_key
+        WHERE (:product IS NULL OR a.product_key = :product)
+    )
+'''
+
+STOCK_COLUMNS = [
+    ReportColumn('product_name', 'Product Name', 'text', 150),
+    ReportColumn('balance', 'Current Balance', 'int', 150),
+    ReportColumn('minimum_limit', 'Minimum Limit', 'int', 150),
+    ReportColumn('status', 'Status', 'text', 150),
+]
+
+register_report(ReportDefinition(
+    'sales_daily', 'Daily Sales', ERP_SCHEMA,
+    '''
+    SELECT
+        s.invoice_number AS invoice_number,
+        s.invoice_date AS invoice_date,
+        c.customer_name AS customer_name,
+        s.total_invoice AS total_invoice,
+        s.discount AS discount,
+        s.net_invoice AS net_invoice,
+        s.invoice_status AS invoice_status
+    FROM sales s
+    JOIN customers c ON s.customer_code = c.customer_code
+    WHERE DATE(s.invoice_date) BETWEEN :date_from AND :date_to
+      AND (:customer IS NULL OR s.customer_code = :customer)
+      AND (:status IS NULL OR s.invoice_status = :status)
+    ''',
+    [
+        ReportColumn('invoice_number', 'Invoice Number'),
+        ReportColumn('invoice_date', 'Date', 'date'),
+        ReportColumn('customer_name', 'Customer'),
+        ReportColumn('total_invoice', 'Total', 'money'),
+        ReportColumn('discount', 'Discount', 'money'),
+        ReportColumn('net_invoice', 'Net Total', 'money'),
+        ReportColumn('invoice_status', 'Status'),
+    ],
+    parameters=('date_from', 'date_to', 'customer', 'status'),
+    defaults={'date_from': today},
+    default_sort='invoice_number DESC',
+    tables=('sales', 'customers'),
+))
+
+# Period and customer reports read the daily rollups maintained by rollups.py
+ROLLUP_PERIOD_COLUMNS = [
+    ReportColumn('invoice_count', 'Invoice Count', 'int', 150),
+    ReportColumn('total', 'Total', 'money', 150),
+    ReportColumn('discount', 'Discount', 'money', 150),
+    ReportColumn('net_total', 'Net Total', 'money', 150),
+]
+
+ROLLUP_PERIOD_SQL = '''
+    SELECT
+        {period} AS {key},
+        SUM(r.invoice_count) AS invoice_count,
+        SUM(r.gross) AS total,
+        SUM(r.discount) AS discount,
+        SUM(r.net) AS net_total
+    FROM sales_daily r
+    WHERE r.day BETWEEN :date_from AND :date_to
+      AND (:customer IS NULL OR r.customer_code = :customer)
+    GROUP BY {period}
+'''
+
+register_report(ReportDefinition(
+    'sales_monthly', 'Monthly Sales', ERP_SCHEMA,
+    ROLLUP_PERIOD_SQL.format(period="substr(r.day, 1, 7)", key='month'),
+    [ReportColumn('month', 'Month', 'text', 150)] + ROLLUP_PERIOD_COLUMNS,
+    parameters=('date_from', 'date_to', 'customer'),
+    default_sort='month DESC',
+    tables=('sales_daily',),
+))
+
+register_report(ReportDefinition(
+    'sales_yearly', 'Yearly Sales', ERP_SCHEMA,
+    ROLLUP_PERIOD_SQL.format(period="substr(r.day, 1, 4)", key='year'),
+    [ReportColumn('year', 'Year', 'text', 150)] + ROLLUP_PERIOD_COLUMNS,
+    parameters=('date_from', 'date_to', 'customer'),
+    defaults={'date_from': '0000-01-01'},
+    default_sort='year DESC',
+    tables=('sales_daily',),
+))
+
+register_report(ReportDefinition(
+    'top_customers', 'Top Customers', ERP_SCHEMA,
+    '''
+    SELECT
+        c.customer_name AS customer_name,
+        r.invoice_count AS invoice_count,
+        r.total_purchases AS total_purchases
+    FROM (
+        SELECT customer_code, SUM(invoice_count) AS invoice_count, SUM(net) AS total_purchases
+        FROM sales_daily
+        WHERE day BETWEEN :date_from AND :date_to
+          AND (:customer IS NULL OR customer_code = :customer)
+        GROUP BY customer_code
+        HAVING SUM(net) > 0
+    ) r
+    JOIN customers c ON c.customer_code = r.customer_code
+    ''',
+    [
+        ReportColumn('customer_name', 'Customer Name', 'text', 200),
+        ReportColumn('invoice_count', 'Invoice Count', 'int', 200),
+        ReportColumn('total_purchases', 'Total Purchases', 'money', 200),
+    ],
+    parameters=('date_from', 'date_to', 'customer'),
+    default_sort='total_purchases DESC',
+    limit=20,
+    tables=('sales_daily', 'customers'),
+))
+
+register_report(ReportDefinition(
+    'low_stock', 'Low Stock', ERP_SCHEMA,
+    STOCK_ALERTS_SQL,
+    STOCK_COLUMNS,
+    parameters=('product',),
+    default_sort='balance ASC',
+    tables=('products', 'stock_alerts'),
+))
+
+register_report(ReportDefinition(
+    'out_of_stock', 'Out of Stock', ERP_SCHEMA,
+    STOCK_ALERTS_SQL + " WHERE status = 'Out of Stock'",
+    STOCK_COLUMNS,
+    parameters=('product',),
+    default_sort='balance ASC',
+    tables=('products', 'stock_alerts'),
+))
+
+
+register_report(ReportDefinition(
+    'replenishment', 'Reorder Suggestions', ERP_SCHEMA,
+    '''
+    SELECT
+        p.product_name AS product_name,
+        r.balance AS balance,
+        r.reorder_point AS reorder_point,
+        r.safety_stock AS safety_stock,
+        r.suggested_qty AS suggested_qty,
+        COALESCE(s.supplier_name, r.supplier_code, '') AS supplier_name,
+        r.suggested_qty * r.unit_cost AS order_value
+    FROM replenishment_plan r
+    JOIN products p ON p.product_code = r.product_code
+    LEFT JOIN suppliers s ON s.supplier_code = r.supplier_code
+    WHERE r.suggested_qty > 0
+      AND (:product IS NULL OR r.product_code = :product)
+    ''',
+    [
+        ReportColumn('product_name', 'Product Name', 'text', 150),
+        ReportColumn('balance', 'Current Balance', 'int', 100),
+        ReportColumn('reorder_point', 'Reorder Point', 'int', 100),
+        ReportColumn('safety_stock', 'Safety Stock', 'int', 100),
+        ReportColumn('suggested_qty', 'Suggested Qty', 'int', 100),
+        ReportColumn('supplier_name', 'Supplier', 'text', 150),
+        ReportColumn('order_value', 'Order Value', 'money', 100),
+    ],
+    parameters=('product',),
+    default_sort='order_value DESC',
+    tables=('replenishment_plan', 'products', 'suppliers'),
+))
+
+# ===== erp_simple_english.py Reports =====
+
+register_report(ReportDefinition(
+    'sales', 'Sales Report', SIMPLE_SCHEMA,
+    '''
+    SELECT
+        s.invoice_number AS invoice_number,
+        s.invoice_date AS invoice_date,
+        c.customer_name AS customer_name,
+        s.invoice_total AS invoice_total,
+        s.discount AS discount,
+        s.net_invoice AS net_invoice,
+        s.invoice_status AS invoice_status
+    FROM sales s
+    LEFT JOIN customers c ON s.customer_code = c.customer_code
+    WHERE DATE(s.invoice_date) BETWEEN :date_from AND :date_to
+      AND (:customer IS NULL OR s.customer_code = :customer)
+      AND (:status IS NULL OR s.invoice_status = :status)
+    ''',
+    [
+        ReportColumn('invoice_number', 'Invoice #', 'text', 100),
+        ReportColumn('invoice_date', 'Date', 'date', 100),
+        ReportColumn('customer_name', 'Customer', 'text', 100),
+        ReportColumn('invoice_total', 'Total', 'money', 100),
+        ReportColumn('discount', 'Discount', 'money', 100),
+        ReportColumn('net_invoice', 'Net', 'money', 100),
+        ReportColumn('invoice_status', 'Status', 'text', 100),
+    ],
+    parameters=('date_from', 'date_to', 'customer', 'status'),
+    default_sort='invoice_date DESC',
+    tables=('sales', 'customers'),
+))
+
+register_report(ReportDefinition(
+    'inventory', 'Inventory Report', SIMPLE_SCHEMA,
+    '''
+    SELECT
+        p.product_name AS product_name,
+        COALESCE(b.qty_in, 0) AS total_in,
+        COALESCE(b.qty_out, 0) AS total_out,
+        COALESCE(b.balance, 0) AS balance
+    FROM products p
+    LEFT JOIN stock_balances b ON b.product_key = p.product_name
+    WHERE (:product IS NULL OR p.product_name = :product)
+    ''',
+    [
+        ReportColumn('product_name', 'Product Name'),
+        ReportColumn('total_in', 'In', 'int'),
+        ReportColumn('total_out', 'Out', 'int'),
+        ReportColumn('balance', 'Balance', 'int'),
+    ],
+    parameters=('product',),
+    default_sort='product_name',
+    tables=('products', 'stock_balances'),
+))
+
+register_report(ReportDefinition(
+    'customers', 'Customers Report', SIMPLE_SCHEMA,
+    '''
+    SELECT
+        c.customer_code AS customer_code,
+        c.customer_name AS customer_name,
+        c.phone AS phone,
+        c.email AS email,
+        COALESCE(r.net, 0) AS total_purchases
+    FROM customers c
+    LEFT JOIN (
+        SELECT customer_code, SUM(net) AS net
+        FROM sales_daily
+        WHERE day BETWEEN :date_from AND :date_to
+        GROUP BY customer_code
+    ) r ON r.customer_code = c.customer_code
+    WHERE (:customer IS NULL OR c.customer_code = :customer)
+    ''',
+    [
+        ReportColumn('customer_code', 'Code'),
+        ReportColumn('customer_name', 'Name'),
+        ReportColumn('phone', 'Phone'),
+        ReportColumn('email', 'Email'),
+        ReportColumn('total_purchases', 'Total Purchases', 'money'),
+    ],
+    parameters=('date_from', 'date_to', 'customer'),
+    default_sort='total_purchases DESC',
+    tables=('sales_daily', 'customers'),
+))
+
+register_report(ReportDefinition(
+    'products', 'Products Report', SIMPLE_SCHEMA,
+    '''
+    SELECT
+        p.product_name AS product_name,
+        p.Quantitee AS unit,
+        p.purchase_price AS purchase_price,
+        p.selling_price AS selling_price,
+        COALESCE(b.balance, 0) AS stock
+    FROM products p
+    LEFT JOIN stock_balances b ON b.product_key = p.product_name
+    WHERE (:product IS NULL OR p.product_name = :product)
+    ''',
+    [
+        ReportColumn('product_name', 'Product Name', 'text', 100),
+        ReportColumn('unit', 'Unit', 'text', 100),
+        ReportColumn('purchase_price', 'Purchase Price', 'money', 100),
+        ReportColumn('selling_price', 'Selling Price', 'money', 100),
+        ReportColumn('stock', 'Stock', 'int', 100),
+    ],
+    parameters=('product',),
+    default_sort='product_name',
+    tables=('products', 'stock_balances'),
+))
+
+
+# ===== Margin Reports =====
+
+def register_margin_reports(schema, prefix=''):
+    """Register margin reports for a schema, reading costs captured in the rollups"""
+    register_report(ReportDefinition(
+        prefix + 'margin_by_product', 'Margin by Product', schema,
+        '''
+        SELECT
+            COALESCE(p.product_name, r.product_code) AS product_name,
+            r.quantity AS quantity,
+            r.revenue AS revenue,
+            r.cost AS cost,
+            r.revenue - r.cost AS margin,
+            CASE WHEN r.revenue > 0 THEN ROUND(100.0 * (r.revenue - r.cost) / r.revenue, 2) END AS margin_pct
+        FROM (
+            SELECT product_code, SUM(quantity) AS quantity, SUM(revenue) AS revenue, SUM(cost) AS cost
+            FROM sales_product_daily
+            WHERE day BETWEEN :date_from AND :date_to
+              AND (:product IS NULL OR product_code = :product)
+            GROUP BY product_code
+        ) r
+        LEFT JOIN products p ON p.product_code = r.product_code
+        ''',
+        [
+            ReportColumn('product_name', 'Product Name', 'text', 150),
+            ReportColumn('quantity', 'Quantity', 'int', 100),
+            ReportColumn('revenue', 'Revenue', 'money', 100),
+            ReportColumn('cost', 'Cost', 'money', 100),
+            ReportColumn('margin', 'Margin', 'money', 100),
+            ReportColumn('margin_pct', 'Margin %', 'float', 80),
+        ],
+        parameters=('date_from', 'date_to', 'product'),
+        default_sort='margin DESC',
+        tables=('sales_product_daily', 'products'),
+    ))
+
+    register_report(ReportDefinition(
+        prefix + 'margin_by_customer', 'Margin by Customer', schema,
+        '''
+        SELECT
+            COALESCE(c.customer_name, r.customer_code) AS customer_name,
+            r.invoice_count AS invoice_count,
+            r.net AS revenue,
+            r.cost AS cost,
+            r.net - r.cost AS margin,
+            CASE WHEN r.net > 0 THEN ROUND(100.0 * (r.net - r.cost) / r.net, 2) END AS margin_pct
+        FROM (
+            SELECT customer_code, SUM(invoice_count) AS invoice_count, SUM(net) AS net, SUM(cost) AS cost
+            FROM sales_daily
+            WHERE day BETWEEN :date_from AND :date_to
+              AND (:customer IS NULL OR customer_code = :customer)
+            GROUP BY customer_code
+        ) r
+        LEFT JOIN customers c ON c.customer_code = r.customer_code
+        ''',
+        [
+            ReportColumn('customer_name', 'Customer Name', 'text', 150),
+            ReportColumn('invoice_count', 'Invoice Count', 'int', 100),
+            ReportColumn('revenue', 'Net Sales', 'money', 100),
+            ReportColumn('cost', 'Cost', 'money', 100),
+            ReportColumn('margin', 'Margin', 'money', 100),
+            ReportColumn('margin_pct', 'Margin %', 'float', 80),
+        ],
+        parameters=('date_from', 'date_to', 'customer'),
+        default_sort='margin DESC',
+        tables=('sales_daily', 'customers'),
+    ))
+
+    register_report(ReportDefinition(
+        prefix + 'margin_by_month', 'Margin by Month', schema,
+        '''
+        SELECT
+            strftime('%Y-%m', day) AS month,
+            SUM(invoice_count) AS invoice_count,
+            SUM(net) AS revenue,
+            SUM(cost) AS cost,
+            SUM(net) - SUM(cost) AS margin,
+            CASE WHEN SUM(net) > 0 THEN ROUND(100.0 * (SUM(net) - SUM(cost)) / SUM(net), 2) END AS margin_pct
+        FROM sales_daily
+        WHERE day BETWEEN :date_from AND :date_to
+          AND (:customer IS NULL OR customer_code = :customer)
+        GROUP BY month
+        ''',
+        [
+            ReportColumn('month', 'Month', 'text', 100),
+            ReportColumn('invoice_count', 'Invoice Count', 'int', 100),
+            ReportColumn('revenue', 'Net Sales', 'money', 100),
+            ReportColumn('cost', 'Cost', 'money', 100),
+            ReportColumn('margin', 'Margin', 'money', 100),
+            ReportColumn('margin_pct', 'Margin %', 'float', 80),
+        ],
+        parameters=('date_from', 'date_to', 'customer'),
+        default_sort='month',
+        tables=('sales_daily',),
+    ))
+
+
+register_margin_reports(ERP_SCHEMA)
+register_margin_reports(SIMPLE_SCHEMA, 'simple_')
@@ -0,0 +1,230 @@
+import argparse
+import sqlite3
+
+from erp_schema import add_column, detect_schema, profile, table_exists
+
+
+# Draft purchase invoices are proposals, not received stock, so the rollups leave them out
+DRAFT_STATUS = 'draft'
+
+
+class RollupStore:
+    def __init__(self, conn, schema=None):
+        self.conn = conn
+        self.schema = schema or detect_schema(conn)
+        self.sales_total = profile(self.schema)['sales_total']
+
+    def has_purchases(self):
+        """Check whether the database has purchase tables"""
+        return table_exists(self.conn, 'purchases') and table_exists(self.conn, 'purchase_details')
+
+    def create_tables(self):
+        """Create rollup tables, backfilling them on first use"""
+        is_new = not table_exists(self.conn, 'sales_daily')
+
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS sales_daily (
+                day DATE NOT NULL,
+                customer_code TEXT NOT NULL DEFAULT '',
+                invoice_count INTEGER NOT NULL DEFAULT 0,
+                gross REAL NOT NULL DEFAULT 0,
+                discount REAL NOT NULL DEFAULT 0,
+                net REAL NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, customer_code)
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS sales_product_daily (
+                day DATE NOT NULL,
+                product_code TEXT NOT NULL DEFAULT '',
+                quantity INTEGER NOT NULL DEFAULT 0,
+                revenue REAL NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, product_code)
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS purchases_daily (
+                day DATE NOT NULL,
+                supplier_code TEXT NOT NULL DEFAULT '',
+                invoice_count INTEGER NOT NULL DEFAULT 0,
+                gross REAL NOT NULL DEFAULT 0,
+                discount REAL NOT NULL DEFAULT 0,
+                net REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, supplier_code)
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS purchases_product_daily (
+                day DATE NOT NULL,
+                product_code TEXT NOT NULL DEFAULT '',
+                quantity INTEGER NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, product_code)
+            )
+        ''')
+        # Cost of goods sold, captured per sales line at save time
+        add_column(self.conn, 'sales_details', 'unit_cost', 'REAL')
+        migrated = add_column(self.conn, 'sales_daily', 'cost', 'REAL NOT NULL DEFAULT 0')
+        migrated = add_column(self.conn, 'sales_product_daily', 'cost', 'REAL NOT NULL DEFAULT 0') or migrated
+
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sales_daily_customer ON sales_daily (customer_code, day)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sales_product_daily_product ON sales_product_daily (product_code, day)")
+
+        # Incremental updates look up the lines of one invoice
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sales_details_invoice ON sales_details (invoice_number)")
+        if self.has_purchases():
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_purchase_details_invoice ON purchase_details (invoice_number)")
+
+        self.conn.commit()
+
+        if is_new or migrated:
+            self.rebuild()
+        return is_new
+
+    # ===== Incremental Updates =====
+
+    def add_sales_invoice(self, cursor, invoice_number):
+        """Add a saved sales invoice to the rollups, inside the caller's transaction"""
+        cursor.execute(f'''
+            INSERT INTO sales_daily (day, customer_code, invoice_count, gross, discount, net, cost)
+            SELECT COALESCE(DATE(invoice_date), ''), COALESCE(customer_code, ''), 1,
+                   COALESCE({self.sales_total}, 0), COALESCE(discount, 0), COALESCE(net_invoice, 0),
+                   (SELECT COALESCE(SUM(quantity * unit_cost), 0) FROM sales_details
+                    WHERE invoice_number = sales.invoice_number)
+            FROM sales
+            WHERE invoice_number = ?
+            ON CONFLICT (day, customer_code) DO UPDATE SET
+                invoice_count = invoice_count + excluded.invoice_count,
+                gross = gross + excluded.gross,
+                discount = discount + excluded.discount,
+                net = net + excluded.net,
+                cost = cost + excluded.cost
+        ''', (invoice_number,))
+
+        cursor.execute('''
+            INSERT INTO sales_product_daily (day, product_code, quantity, revenue, cost)
+            SELECT COALESCE(DATE(s.invoice_date), ''), COALESCE(d.product_code, ''),
+                   SUM(COALESCE(d.quantity, 0)), SUM(COALESCE(d.total, 0)),
+                   SUM(COALESCE(d.quantity * d.unit_cost, 0))
+            FROM sales_details d
+            JOIN sales s ON s.invoice_number = d.invoice_number
+            WHERE d.invoice_number = ?
+            GROUP BY d.product_code
+            ON CONFLICT (day, product_code) DO UPDATE SET
+                quantity = quantity + excluded.quantity,
+                revenue = revenue + excluded.revenue,
+                cost = cost + excluded.cost
+        ''', (invoice_number,))
+
+    def add_purchase_invoice(self, cursor, invoice_number):
+        """Add a saved purchase invoice to the rollups, inside the caller's transaction"""
+        cursor.execute('''
+            INSERT INTO purchases_daily (day, supplier_code, invoice_count, gross, discount, net)
+            SELECT COALESCE(DATE(invoice_date), ''), COALESCE(supplier_code, ''), 1,
+                   COALESCE(total_invoice, 0), COALESCE(discount, 0), COALESCE(net_invoice, 0)
+            FROM purchases
+            WHERE invoice_number = ?
+            ON CONFLICT (day, supplier_code) DO UPDATE SET
+                invoice_count = invoice_count + excluded.invoice_count,
+                gross = gross + excluded.gross,
+                discount = discount + excluded.discount,
+                net = net + excluded.net
+        ''', (invoice_number,))
+
+        cursor.execute('''
+            INSERT INTO purchases_product_daily (day, product_code, quantity, cost)
+            SELECT COALESCE(DATE(p.invoice_date), ''), COALESCE(d.product_code, ''),
+                   SUM(COALESCE(d.quantity, 0)), SUM(COALESCE(d.total, 0))
+            FROM purchase_details d
+            JOIN purchases p ON p.invoice_number = d.invoice_number
+            WHERE d.invoice_number = ?
+            GROUP BY d.product_code
+            ON CONFLICT (day, product_code) DO UPDATE SET
+                quantity = quantity + excluded.quantity,
+                cost = cost + excluded.cost
+        ''', (invoice_number,))
+
+    # ===== Backfill =====
+
+    def rebuild(self):
+        """Rebuild all rollups from invoice history"""
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("DELETE FROM sales_daily")
+            cursor.execute("DELETE FROM sales_product_daily")
+            cursor.execute("DELETE FROM purchases_daily")
+            cursor.execute("DELETE FROM purchases_product_daily")
+
+            cursor.execute(f'''
+                INSERT INTO sales_daily (day, customer_code, invoice_count, gross, discount, net, cost)
+                SELECT COALESCE(DATE(s.invoice_date), ''), COALESCE(s.customer_code, ''), COUNT(*),
+                       SUM(COALESCE(s.{self.sales_total}, 0)), SUM(COALESCE(s.discount, 0)),
+                       SUM(COALESCE(s.net_invoice, 0)), SUM(COALESCE(c.cost, 0))
+                FROM sales s
+                LEFT JOIN (
+                    SELECT invoice_number, SUM(quantity * unit_cost) AS cost
+                    FROM sales_details
+                    GROUP BY invoice_number
+                ) c ON c.invoice_number = s.invoice_number
+                GROUP BY COALESCE(DATE(s.invoice_date), ''), COALESCE(s.customer_code, '')
+            ''')
+            cursor.execute('''
+                INSERT INTO sales_product_daily (day, product_code, quantity, revenue, cost)
+                SELECT COALESCE(DATE(s.invoice_date), ''), COALESCE(d.product_code, ''),
+                       SUM(COALESCE(d.quantity, 0)), SUM(COALESCE(d.total, 0)),
+                       SUM(COALESCE(d.quantity * d.unit_cost, 0))
+                FROM sales_details d
+                JOIN sales s ON s.invoice_number = d.invoice_number
+                GROUP BY COALESCE(DATE(s.invoice_date), ''), COALESCE(d.product_code, '')
+            ''')
+
+            # Draft purchase invoices are suggestions, not purchases
+            if self.has_purchases():
+                cursor.execute('''
+                    INSERT INTO purchases_daily (day, supplier_code, invoice_count, gross, discount, net)
+                    SELECT COALESCE(DATE(invoice_date), ''), COALESCE(supplier_code, ''), COUNT(*),
+                           SUM(COALESCE(total_invoice, 0)), SUM(COALESCE(discount, 0)),
+                           SUM(COALESCE(net_invoice, 0))
+                    FROM purchases
+                    WHERE COALESCE(invoice_status, '') != ?
+                    GROUP BY COALESCE(DATE(invoice_date), ''), COALESCE(supplier_code, '')
+                ''', (DRAFT_STATUS,))
+                cursor.execute('''
+                    INSERT INTO purchases_product_daily (day, product_code, quantity, cost)
+                    SELECT COALESCE(DATE(p.invoice_date), ''), COALESCE(d.product_code, ''),
+                           SUM(COALESCE(d.quantity, 0)), SUM(COALESCE(d.total, 0))
+                    FROM purchase_details d
+                    JOIN purchases p ON p.invoice_number = d.invoice_number
+                    WHERE COALESCE(p.invoice_status, '') != ?
+                    GROUP BY COALESCE(DATE(p.invoice_date), ''), COALESCE(d.product_code, '')
+                ''', (DRAFT_STATUS,))
+
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+def main():
+    """Rebuild rollup tables from the command line"""
+    parser = argparse.ArgumentParser(description="Rebuild sales and purchases rollup tables")
+    parser.add_argument('database', help="SQLite database file")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        store = RollupStore(conn)
+        if not store.create_tables():
+            store.rebuild()
+        count = conn.execute("SELECT COUNT(*) FROM sales_daily").fetchone()[0]
+        print(f"Rollups rebuilt: {count} daily sales rows")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+from costing import CostingEngine
+from erp_schema import ERP_SCHEMA, SIMPLE_SCHEMA, detect_schema, profile
+from rollups import RollupStore
+from stock_levels import DEFAULT_RESERVATION_HOURS, StockLevels
+
+
+INVOICE_PREFIX = 'INV-'
+
+# Status a saved invoice starts in, per schema
+SAVED_STATUS = {
+    ERP_SCHEMA: 'open',
+    SIMPLE_SCHEMA: 'closed',
+}
+
+
+class SalesLedger:
+    def __init__(self, conn, schema=None, stock_levels=None, costing=None, rollups=None, allow_oversell=False):
+        self.conn = conn
+        self.schema = schema or detect_schema(conn)
+        self.profile = profile(self.schema)
+        self.product_key = self.profile['inventory_key']
+        self.stock_levels = stock_levels or StockLevels(conn, self.schema)
+        self.costing = costing or CostingEngine(conn, self.schema)
+        self.rollups = rollups or RollupStore(conn, self.schema)
+        # Sell beyond the stock balance, as before stock checks existed
+        self.allow_oversell = allow_oversell
+
+    def next_invoice_number(self, cursor):
+        """Get the invoice number after the highest one saved"""
+        # Compared as text INV-99999 sorts after INV-100000, so take the highest number
+        cursor.execute("SELECT MAX(CAST(substr(invoice_number, ?) AS INTEGER)) FROM sales WHERE invoice_number LIKE ?",
+                       (len(INVOICE_PREFIX) + 1, INVOICE_PREFIX + '%'))
+        last_number = cursor.fetchone()[0]
+        return f"{INVOICE_PREFIX}{(last_number or 0) + 1:05d}"
+
+    def reference(self, invoice_number):
+        """Get the inventory and cost layer reference of an invoice"""
+        return invoice_number if self.schema == ERP_SCHEMA else f"Invoice {invoice_number}"
+
+    def product_keys(self, cursor, product_codes):
+        """Map product codes to the inventory key of the schema"""
+        if self.product_key == 'product_code':
+            return {str(code): str(code) for code in product_codes}
+        keys = {}
+        codes = list(dict.fromkeys(str(code) for code in product_codes))
+        for start in range(0, len(codes), 500):
+            chunk = codes[start:start + 500]
+            cursor.execute(f'''
+                SELECT product_code, {self.product_key} FROM products
+                WHERE product_code IN ({', '.join('?' for _ in chunk)})
+            ''', chunk)
+            keys.update((str(code), key) for code, key in cursor.fetchall())
+        return keys
+
+    def line_quantities(self, cursor, lines):
+        """Get (product_code -> key, key -> total quantity) for (product_code, quantity, ...) lines"""
+        keys = self.product_keys(cursor, [line[0] for line in lines])
+        quantities = {}
+        for product_code, quantity, *_ in lines:
+            key = keys.get(str(product_code))
+            if key is None:
+                raise ValueError(f"Product {product_code} not found")
+            quantities[key] = quantities.get(key, 0) + int(quantity)
+        return keys, quantities
+
+    def reserve(self, cursor, reference, lines, hours=DEFAULT_RESERVATION_HOURS):
+        """Hold stock for an open quotation and return when the hold expires"""
+        _, quantities = self.line_quantities(cursor, lines)
+        return self.stock_levels.reserve(cursor, reference, quantities, hours)
+
+    def save_invoice(self, cursor, invoice_number, customer_code, lines, discount=0.0, invoice_date=None,
+                     reservation=None):
+        """Save an invoice with its lines, stock and cost updates inside the caller's transaction"""
+        lines = [(str(code), int(quantity), float(price)) for code, quantity, price in lines]
+        total = round(sum(quantity * price for _, quantity, price in lines), 2)
+        discount = float(discount or 0)
+        net = round(total - discount, 2)
+
+        columns = ['invoice_number', 'customer_code', self.profile['sales_total'],
+                   'discount', 'net_invoice', 'invoice_status']
+        values = [invoice_number, customer_code, total, discount, net, SAVED_STATUS[self.schema]]
+        if invoice_date:
+            columns.append('invoice_date')
+            values.append(invoice_date)
+        cursor.execute(f'''
+            INSERT INTO sales ({', '.join(columns)})
+            VALUES ({', '.join('?' for _ in columns)})
+        ''', values)
+
+        # The header insert holds the write lock, so no other till can sell the same units
+        # between this check and the balance update below
+        keys, quantities = self.line_quantities(cursor, lines)
+        if not self.allow_oversell:
+            self.stock_levels.check_available(cursor, quantities, reservation)
+
+        reference = self.reference(invoice_number)
+        movements = []
+        cost_total = 0.0
+        for product_code, quantity, price in lines:
+            key = keys[product_code]
+
+            # Cost of the stock issued, kept on the line for margin reports
+            cost = self.costing.issue(cursor, key, quantity, reference)
+            unit_cost = cost / quantity if quantity else 0
+            cost_total += cost
+
+            cursor.execute('''
+                INSERT INTO sales_details (invoice_number, product_code, quantity, price, total, unit_cost)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (invoice_number, product_code, quantity, price, round(quantity * price, 2), unit_cost))
+
+            cursor.execute(f'''
+                INSERT INTO inventory ({self.product_key}, movement, quantity, reference)
+                VALUES (?, 'out', ?, ?)
+            ''', (key, quantity, reference))
+            movements.append((key, 'out', quantity))
+
+        if reservation:
+            # The quotation's hold becomes the sale
+            self.stock_levels.release(cursor, reservation)
+        self.rollups.add_sales_invoice(cursor, invoice_number)
+        stock_changes = self.stock_levels.apply_movements(cursor, movements)
+
+        invoice = {
+            'invoice_number': invoice_number,
+            'customer_code': customer_code,
+            'total': total,
+            'discount': discount,
+            'net': net,
+            'cost': round(cost_total, 4),
+            'lines': len(lines),
+        }
+        return invoice, stock_changes
+
+    def get_invoice(self, cursor, invoice_number):
+        """Get a saved invoice with its lines as a dict, or None"""
+        cursor.execute(f'''
+            SELECT invoice_number, invoice_date, customer_code, {self.profile['sales_total']},
+                   discount, net_invoice, invoice_status
+            FROM sales WHERE invoice_number = ?
+        ''', (invoice_number,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        invoice = dict(zip(('invoice_number', 'invoice_date', 'customer_code', 'total',
+                            'discount', 'net', 'status'), row))
+        cursor.execute('''
+            SELECT product_code, quantity, price, total FROM sales_details
+            WHERE invoice_number = ? ORDER BY id
+        ''', (invoice_number,))
+        invoice['lines'] = [dict(zip(('product_code', 'quantity', 'price', 'total'), line))
+                            for line in cursor.fetchall()]
+        return invoice
@@ -0,0 +1,324 @@
+import argparse
+import sqlite3
+
+from erp_schema import detect_schema, profile, table_exists
+
+
+# Alert statuses, most severe first
+OUT_OF_STOCK = 'out'
+LOW_STOCK = 'low'
+
+STATUS_LABELS = {
+    OUT_OF_STOCK: 'Out of Stock',
+    LOW_STOCK: 'Low',
+    None: 'Normal',
+}
+
+# Hours an open quotation holds its stock
+DEFAULT_RESERVATION_HOURS = 24
+
+
+class InsufficientStock(ValueError):
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__("Insufficient stock: " + ", ".join(
+            f"{product_key} (requested {requested}, available {max(available, 0)})"
+            for product_key, requested, available in shortages))
+
+
+def stock_status(balance, minimum_limit):
+    """Get alert status for a balance, or None when stock is normal"""
+    if balance <= 0:
+        return OUT_OF_STOCK
+    if balance < (minimum_limit or 0):
+        return LOW_STOCK
+    return None
+
+
+class StockLevels:
+    def __init__(self, conn, schema=None):
+        self.conn = conn
+        self.schema = schema or detect_schema(conn)
+        # Inventory rows reference products by product_code, or by product_name in the simple schema
+        self.product_key = profile(self.schema)['inventory_key']
+        self.listeners = []
+
+    def create_tables(self):
+        """Create balance and alert tables, backfilling them on first use"""
+        is_new = not table_exists(self.conn, 'stock_balances')
+
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS stock_balances (
+                product_key TEXT PRIMARY KEY,
+                qty_in INTEGER NOT NULL DEFAULT 0,
+                qty_out INTEGER NOT NULL DEFAULT 0,
+                balance INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS stock_alerts (
+                product_key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                balance INTEGER NOT NULL,
+                minimum_limit INTEGER NOT NULL DEFAULT 0,
+                raised_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_alerts_status ON stock_alerts (status, balance)")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS stock_reservations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                reference TEXT NOT NULL,
+                product_key TEXT NOT NULL,
+                quantity INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                expires_at DATETIME NOT NULL
+            )
+        ''')
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_stock_reservations_product ON stock_reservations (product_key, expires_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_reservations_reference ON stock_reservations (reference)")
+        self.conn.execute("DELETE FROM stock_reservations WHERE expires_at <= CURRENT_TIMESTAMP")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_inventory_{self.product_key} ON inventory ({self.product_key})")
+        if self.product_key != 'product_code':
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_products_{self.product_key} ON products ({self.product_key})")
+        self.conn.commit()
+
+        if is_new:
+            self.rebuild()
+        return is_new
+
+    def add_listener(self, callback):
+        """Register a callback(product_key, old_status, new_status, balance) for alert changes"""
+        self.listeners.append(callback)
+
+    def notify(self, changes):
+        """Send committed alert changes to listeners"""
+        for change in changes:
+            for callback in self.listeners:
+                callback(*change)
+
+    # ===== Incremental Updates =====
+
+    def apply_movements(self, cursor, movements):
+        """Apply (product_key, movement, quantity) rows inside the caller's transaction"""
+        totals = {}
+        for product_key, movement, quantity in movements:
+            # Keys are TEXT columns; Treeview values may come back as ints
+            product_key = str(product_key)
+            qty_in, qty_out = totals.get(product_key, (0, 0))
+            if movement == 'in':
+                qty_in += int(quantity)
+            elif movement == 'out':
+                qty_out += int(quantity)
+            totals[product_key] = (qty_in, qty_out)
+
+        cursor.executemany('''
+            INSERT INTO stock_balances (product_key, qty_in, qty_out, balance)
+            VALUES (?, ?, ?, ? - ?)
+            ON CONFLICT (product_key) DO UPDATE SET
+                qty_in = qty_in + excluded.qty_in,
+                qty_out = qty_out + excluded.qty_out,
+                balance = balance + excluded.balance
+        ''', [(key, qty_in, qty_out, qty_in, qty_out) for key, (qty_in, qty_out) in totals.items()])
+
+        return self.evaluate(cursor, totals.keys())
+
+    def evaluate(self, cursor, product_keys):
+        """Re-check alerts for the given products and return the changes"""
+        product_keys = [str(key) for key in product_keys if key is not None]
+        changes = []
+        # Stay well below SQLite's bound parameter limit
+        for start in range(0, len(product_keys), 500):
+            chunk = product_keys[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+
+            cursor.execute(f'''
+                SELECT p.{self.product_key}, p.minimum_limit, COALESCE(b.balance, 0)
+                FROM products p
+                LEFT JOIN stock_balances b ON b.product_key = p.{self.product_key}
+                WHERE p.{self.product_key} IN ({placeholders})
+            ''', chunk)
+            current = {row[0]: row[1:] for row in cursor.fetchall()}
+
+            cursor.execute(
+                f"SELECT product_key, status FROM stock_alerts WHERE product_key IN ({placeholders})", chunk)
+            previous = dict(cursor.fetchall())
+
+            for product_key in chunk:
+                old_status = previous.get(product_key)
+                if product_key in current:
+                    minimum_limit, balance = current[product_key]
+                    new_status = stock_status(balance, minimum_limit)
+                else:
+                    # Product was deleted
+                    minimum_limit, balance, new_status = 0, 0, None
+
+                if new_status is None:
+                    if old_status is not None:
+                        cursor.execute("DELETE FROM stock_alerts WHERE product_key = ?", (product_key,))
+                else:
+                    cursor.execute('''
+                        INSERT INTO stock_alerts (product_key, status, balance, minimum_limit)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT (product_key) DO UPDATE SET
+                            status = excluded.status,
+                            balance = excluded.balance,
+                            minimum_limit = excluded.minimum_limit,
+                            raised_at = CASE WHEN status = excluded.status
+                                             THEN raised_at ELSE excluded.raised_at END
+                    ''', (product_key, new_status, balance, minimum_limit or 0))
+
+                if new_status != old_status:
+                    changes.append((product_key, old_status, new_status, balance))
+        return changes
+
+    # ===== Reservations =====
+
+    def shortages(self, cursor, quantities, reference=None):
+        """Get (product_key, requested, available) for products short of the requested quantities"""
+        # Balances less unexpired reservations, except those held by the reference itself
+        items = [(str(key), int(quantity)) for key, quantity in quantities.items()]
+        shortages = []
+        for start in range(0, len(items), 400):
+            chunk = items[start:start + 400]
+            cursor.execute(f'''
+                WITH wanted (product_key, quantity) AS (VALUES {', '.join('(?, ?)' for _ in chunk)})
+                SELECT product_key, quantity, available FROM (
+                    SELECT w.product_key, w.quantity,
+                           COALESCE(b.balance, 0) - COALESCE((
+                               SELECT SUM(r.quantity) FROM stock_reservations r
+                               WHERE r.product_key = w.product_key
+                                 AND r.expires_at > CURRENT_TIMESTAMP
+                                 AND r.reference IS NOT ?
+                           ), 0) AS available
+                    FROM wanted w
+                    LEFT JOIN stock_balances b ON b.product_key = w.product_key
+                )
+                WHERE available < quantity
+            ''', [value for item in chunk for value in item] + [reference])
+            shortages.extend(cursor.fetchall())
+        return shortages
+
+    def check_available(self, cursor, quantities, reference=None):
+        """Raise InsufficientStock unless every requested quantity is available"""
+        shortages = self.shortages(cursor, quantities, reference)
+        if shortages:
+            raise InsufficientStock(shortages)
+
+    def reserve(self, cursor, reference, quantities, hours=DEFAULT_RESERVATION_HOURS):
+        """Hold stock for a quotation until it expires, replacing its earlier reservation"""
+        self.check_available(cursor, quantities, reference)
+        cursor.execute("SELECT DATETIME(CURRENT_TIMESTAMP, ?)", (f"+{float(hours)} hours",))
+        expires_at = cursor.fetchone()[0]
+        cursor.execute("DELETE FROM stock_reservations WHERE reference = ?", (reference,))
+        cursor.executemany('''
+            INSERT INTO stock_reservations (reference, product_key, quantity, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', [(reference, str(key), int(quantity), expires_at) for key, quantity in quantities.items()])
+        return expires_at
+
+    def release(self, cursor, reference):
+        """Drop the reservation of a quotation"""
+        cursor.execute("DELETE FROM stock_reservations WHERE reference = ?", (reference,))
+        return cursor.rowcount
+
+    def purge_expired(self, cursor):
+        """Delete expired reservations"""
+        cursor.execute("DELETE FROM stock_reservations WHERE expires_at <= CURRENT_TIMESTAMP")
+        return cursor.rowcount
+
+    # ===== Reads =====
+
+    def get_balance(self, product_key):
+        """Get the current balance of a product"""
+        row = self.conn.execute(
+            "SELECT balance FROM stock_balances WHERE product_key = ?", (product_key,)).fetchone()
+        return row[0] if row else 0
+
+    def get_reserved(self, product_key):
+        """Get the quantity of a product held by unexpired reservations"""
+        row = self.conn.execute('''
+            SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations
+            WHERE product_key = ? AND expires_at > CURRENT_TIMESTAMP
+        ''', (str(product_key),)).fetchone()
+        return row[0]
+
+    def alert_counts(self):
+        """Get the number of alerts per status"""
+        counts = {OUT_OF_STOCK: 0, LOW_STOCK: 0}
+        counts.update(self.conn.execute(
+            "SELECT status, COUNT(*) FROM stock_alerts GROUP BY status").fetchall())
+        return counts
+
+    def get_alerts(self, status=None):
+        """Get current alerts, most urgent first"""
+        if status is None:
+            return self.conn.execute(
+                "SELECT product_key, status, balance, minimum_limit, raised_at FROM stock_alerts "
+                "ORDER BY status DESC, balance").fetchall()
+        return self.conn.execute(
+            "SELECT product_key, status, balance, minimum_limit, raised_at FROM stock_alerts "
+            "WHERE status = ? ORDER BY balance", (status,)).fetchall()
+
+    # ===== Rebuild =====
+
+    def rebuild(self):
+        """Recompute all balances and alerts from inventory movements"""
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("DELETE FROM stock_balances")
+            cursor.execute("DELETE FROM stock_alerts")
+            cursor.execute(f'''
+                INSERT INTO stock_balances (product_key, qty_in, qty_out, balance)
+                SELECT {self.product_key},
+                       SUM(CASE WHEN movement = 'in' THEN quantity ELSE 0 END),
+                       SUM(CASE WHEN movement = 'out' THEN quantity ELSE 0 END),
+                       SUM(CASE WHEN movement = 'in' THEN quantity
+                                WHEN movement = 'out' THEN -quantity ELSE 0 END)
+                FROM inventory
+                WHERE {self.product_key} IS NOT NULL
+                GROUP BY {self.product_key}
+            ''')
+            cursor.execute(f'''
+                INSERT INTO stock_alerts (product_key, status, balance, minimum_limit)
+                SELECT * FROM (
+                    SELECT p.{self.product_key} AS product_key,
+                           CASE WHEN COALESCE(b.balance, 0) <= 0 THEN '{OUT_OF_STOCK}'
+                                WHEN COALESCE(b.balance, 0) < p.minimum_limit THEN '{LOW_STOCK}'
+                           END AS status,
+                           COALESCE(b.balance, 0) AS balance,
+                           COALESCE(p.minimum_limit, 0) AS minimum_limit
+                    FROM products p
+                    LEFT JOIN stock_balances b ON b.product_key = p.{self.product_key}
+                    WHERE p.{self.product_key} IS NOT NULL
+                )
+                WHERE status IS NOT NULL
+            ''')
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+def main():
+    """Rebuild stock balances and alerts from the command line"""
+    parser = argparse.ArgumentParser(description="Rebuild stock balances and alerts")
+    parser.add_argument('database', help="SQLite database file")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    try:
+        levels = StockLevels(conn)
+        if not levels.create_tables():
+            levels.rebuild()
+        counts = levels.alert_counts()
+        print(f"Balances rebuilt: {counts[OUT_OF_STOCK]} out of stock, {counts[LOW_STOCK]} low")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
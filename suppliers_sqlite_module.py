@@ -1,11 +1,14 @@
-import sqlite3
 from tkinter import ttk, messagebox
 
+from db_targets import FILE, is_read_only, open_target
+
 
 class SupplierDB:
-    def __init__(self, db_name="erp.db"):
-        self.conn = sqlite3.connect(db_name)
-        self.create_table()
+    def __init__(self, db_name="erp.db", mode=FILE):
+        # ':memory:' keeps tests and demos off the real file
+        self.conn = open_target(db_name, mode)
+        if not is_read_only(mode):
+            self.create_table()
 
     def create_table(self):
         query = """
@@ -39,8 +42,8 @@ class SupplierDB:
 
 
 class SupplierUI:
-    def __init__(self, parent):
-        self.db = SupplierDB()
+    def __init__(self, parent, db=None):
+        self.db = db or SupplierDB()
         self.selected_id = None
 
         frame = ttk.Frame(parent)
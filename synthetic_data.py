@@ -0,0 +1,503 @@
+import argparse
+import datetime
+import math
+import random
+import sqlite3
+import time
+from collections import Counter
+from itertools import accumulate
+
+from costing import CostingEngine
+from erp import ErpServices
+from erp_schema import ERP_SCHEMA, SIMPLE_SCHEMA, profile, table_exists
+from expenses import ExpenseLedger
+from sales import INVOICE_PREFIX, SAVED_STATUS, SalesLedger
+
+
+# Volumes per scale; each can be overridden from the command line
+SCALES = {
+    'tiny': {'customers': 200, 'products': 100, 'invoices': 2000, 'movements': 6000, 'expenses': 200},
+    'small': {'customers': 5000, 'products': 2000, 'invoices': 100000, 'movements': 300000, 'expenses': 2000},
+    'large': {'customers': 100000, 'products': 50000, 'invoices': 2000000, 'movements': 5000000,
+              'expenses': 50000},
+}
+VOLUMES = ('customers', 'products', 'invoices', 'movements', 'expenses')
+
+# Rows buffered before they are written and committed
+BATCH_ROWS = 200000
+
+# Zipf exponents: a few products and customers account for most of the sales
+PRODUCT_SKEW = 1.1
+CUSTOMER_SKEW = 0.8
+
+LINE_COUNTS = (1, 2, 3, 4, 5, 6)
+LINE_WEIGHTS = (35, 25, 18, 10, 7, 5)
+QUANTITIES = (1, 2, 3, 4, 5, 10)
+QUANTITY_WEIGHTS = (55, 20, 10, 6, 5, 4)
+# Monday first; Saturday is the busiest day and Sunday the quietest
+WEEKDAY_WEIGHTS = (0.9, 0.95, 1.0, 1.0, 1.15, 1.25, 0.6)
+DISCOUNT_SHARE = 0.1
+
+FIRST_NAMES = ('Ahmed', 'Sara', 'Omar', 'Lina', 'Youssef', 'Nour', 'Karim', 'Maya', 'Hassan', 'Amal',
+               'Ali', 'Huda', 'Samir', 'Rana', 'Tarek', 'Dina', 'Walid', 'Salma', 'Fares', 'Rima')
+LAST_NAMES = ('Haddad', 'Khalil', 'Mansour', 'Saleh', 'Nasser', 'Farouk', 'Aziz', 'Hamdan', 'Rahman',
+              'Qasim', 'Bakr', 'Zaid', 'Sabri', 'Jaber', 'Amin', 'Darwish', 'Kamel', 'Taha')
+COMPANY_SUFFIXES = ('Trading', 'Stores', 'Establishment', 'Company', 'Group', 'Supplies', 'Services')
+CITIES = ('Riyadh', 'Jeddah', 'Dammam', 'Cairo', 'Amman', 'Dubai', 'Doha', 'Kuwait', 'Muscat', 'Tunis')
+BRANDS = ('Dell', 'HP', 'Lenovo', 'Canon', 'Logitech', 'Samsung', 'LG', 'Asus', 'Epson', 'Philips',
+          'Sony', 'Acer', 'Brother', 'Kingston', 'Sandisk', 'Anker', 'Xiaomi', 'Bosch', 'Tefal', 'Braun')
+CATALOG = {
+    'Computers': ('Laptop', 'Desktop', 'Tablet', 'Mini PC', 'Workstation'),
+    'Peripherals': ('Mouse', 'Keyboard', 'Headset', 'Webcam', 'Speaker', 'Monitor'),
+    'Printing': ('Printer', 'Scanner', 'Toner', 'Ink Cartridge', 'Paper Ream'),
+    'Storage': ('USB Drive', 'SSD', 'Hard Disk', 'Memory Card', 'NAS'),
+    'Networking': ('Router', 'Switch', 'Access Point', 'Cable', 'Adapter'),
+    'Appliances': ('Kettle', 'Iron', 'Blender', 'Toaster', 'Fan', 'Heater'),
+}
+UNITS = ('unit', 'piece', 'box', 'pack', 'set')
+# (category, title, typical amount, share of expenses)
+EXPENSE_TYPES = (
+    ('Rent', 'Shop rent', 4000, 2),
+    ('Utilities', 'Electricity bill', 600, 6),
+    ('Utilities', 'Water bill', 150, 4),
+    ('Salaries', 'Staff salaries', 9000, 2),
+    ('Transport', 'Delivery fuel', 120, 20),
+    ('Maintenance', 'Equipment repair', 350, 6),
+    ('Marketing', 'Online ads', 500, 8),
+    ('Office', 'Office supplies', 80, 20),
+    ('General', 'Miscellaneous', 60, 12),
+)
+
+
+def code_width(count):
+    """Get the number of digits codes need for a count"""
+    return max(4, len(str(count)))
+
+
+def zipf_weights(count, skew):
+    """Get cumulative Zipf weights for ranks 1..count"""
+    return list(accumulate(1 / (rank ** skew) for rank in range(1, count + 1)))
+
+
+class DataGenerator:
+    def __init__(self, conn, schema=SIMPLE_SCHEMA, seed=1, days=730, end=None):
+        self.conn = conn
+        self.schema = schema
+        self.profile = profile(schema)
+        self.rng = random.Random(seed)
+        self.end = end or datetime.date.today()
+        self.days = [self.end - datetime.timedelta(days=offset) for offset in range(days - 1, -1, -1)]
+        # Simple schema dates carry a time of day
+        self.timestamps = schema == SIMPLE_SCHEMA
+        self.pending = {}
+        self.customer_codes = []
+        self.supplier_codes = []
+        self.products = []
+
+    # ===== Schema =====
+
+    def create_base_tables(self):
+        """Create the tables the desktop app creates on first start"""
+        if self.schema == ERP_SCHEMA:
+            product_code = 'product_code TEXT PRIMARY KEY'
+            product_columns = 'unit_of_measure TEXT, purchase_price REAL DEFAULT 0, sale_price REAL DEFAULT 0'
+            product_key = 'product_code TEXT'
+            date_type = 'DATE DEFAULT CURRENT_DATE'
+        else:
+            product_code = 'product_code INTEGER PRIMARY KEY AUTOINCREMENT, Category TEXT'
+            product_columns = 'Quantitee TEXT, purchase_price REAL DEFAULT 0, selling_price REAL DEFAULT 0'
+            product_key = 'product_name TEXT'
+            date_type = 'DATETIME DEFAULT CURRENT_TIMESTAMP'
+
+        for table in ('customers', 'suppliers'):
+            prefix = table[:-1]
+            self.conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {prefix}_code TEXT PRIMARY KEY,
+                    {prefix}_name TEXT NOT NULL,
+                    phone TEXT,
+                    address TEXT,
+                    email TEXT,
+                    registration_date DATE DEFAULT CURRENT_DATE
+                )
+            ''')
+        self.conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS products (
+                {product_code},
+                product_name TEXT NOT NULL,
+                {product_columns},
+                minimum_limit INTEGER DEFAULT 10,
+                date_added DATE DEFAULT CURRENT_DATE
+            )
+        ''')
+        self.conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS inventory (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {product_key},
+                movement TEXT,
+                quantity INTEGER,
+                date {date_type},
+                reference TEXT
+            )
+        ''')
+        self.conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS sales (
+                invoice_number TEXT PRIMARY KEY,
+                invoice_date {date_type},
+                customer_code TEXT,
+                {self.profile['sales_total']} REAL DEFAULT 0,
+                discount REAL DEFAULT 0,
+                net_invoice REAL DEFAULT 0,
+                invoice_status TEXT DEFAULT 'open'
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS sales_details (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                invoice_number TEXT,
+                product_code TEXT,
+                quantity INTEGER,
+                price REAL,
+                total REAL,
+                unit_cost REAL
+            )
+        ''')
+        if self.schema == ERP_SCHEMA:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS purchases (
+                    invoice_number TEXT PRIMARY KEY,
+                    invoice_date DATE DEFAULT CURRENT_DATE,
+                    supplier_code TEXT,
+                    total_invoice REAL DEFAULT 0,
+                    discount REAL DEFAULT 0,
+                    net_invoice REAL DEFAULT 0,
+                    invoice_status TEXT DEFAULT 'open'
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS purchase_details (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    invoice_number TEXT,
+                    product_code TEXT,
+                    quantity INTEGER,
+                    price REAL,
+                    total REAL
+                )
+            ''')
+        else:
+            ExpenseLedger(self.conn).create_tables()
+        self.conn.commit()
+
+    # ===== Buffered Writes =====
+
+    def add_row(self, sql, row):
+        """Buffer a row for a bulk insert"""
+        self.pending.setdefault(sql, []).append(row)
+
+    def flush(self, force=False):
+        """Write buffered rows in one transaction once enough have piled up"""
+        if not force and sum(len(rows) for rows in self.pending.values()) < BATCH_ROWS:
+            return
+        try:
+            for sql, rows in self.pending.items():
+                self.conn.executemany(sql, rows)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.pending = {}
+
+    def timestamp(self, day, index=0, count=1):
+        """Get a date value, spreading a day's rows over opening hours in the simple schema"""
+        if not self.timestamps:
+            return day.isoformat()
+        seconds = 8 * 3600 + (index + 1) * 12 * 3600 // (count + 1)
+        return f"{day.isoformat()} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+    def registration_date(self):
+        return (self.days[0] - datetime.timedelta(days=self.rng.randint(0, 1000))).isoformat()
+
+    # ===== Master Data =====
+
+    def contact(self, name, code):
+        """Get (phone, address, email) for a customer or supplier"""
+        slug = ''.join(ch for ch in name.lower() if ch.isalnum())[:12]
+        return (f"05{self.rng.randint(0, 99999999):08d}",
+                f"{self.rng.choice(CITIES)} - Street {self.rng.randint(1, 300)}",
+                f"{slug}{code[-4:]}@example.com")
+
+    def generate_customers(self, count):
+        """Create customers, both people and companies"""
+        width = code_width(count)
+        sql = '''
+            INSERT INTO customers (customer_code, customer_name, phone, address, email, registration_date)
+            VALUES (?, ?, ?, ?, ?, ?)
+        '''
+        for number in range(1, count + 1):
+            code = f"CUS-{number:0{width}d}"
+            if self.rng.random() < 0.3:
+                name = f"{self.rng.choice(LAST_NAMES)} {self.rng.choice(COMPANY_SUFFIXES)}"
+            else:
+                name = f"{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)}"
+            self.add_row(sql, (code, name) + self.contact(name, code) + (self.registration_date(),))
+            self.customer_codes.append(code)
+        self.flush(force=True)
+
+    def generate_suppliers(self, count):
+        """Create suppliers"""
+        width = code_width(count)
+        sql = '''
+            INSERT INTO suppliers (supplier_code, supplier_name, phone, address, email, registration_date)
+            VALUES (?, ?, ?, ?, ?, ?)
+        '''
+        for number in range(1, count + 1):
+            code = f"SUP-{number:0{width}d}"
+            name = f"{self.rng.choice(BRANDS)} {self.rng.choice(COMPANY_SUFFIXES)}"
+            self.add_row(sql, (code, name) + self.contact(name, code) + (self.registration_date(),))
+            self.supplier_codes.append(code)
+        self.flush(force=True)
+
+    def generate_products(self, count):
+        """Create products with log-normal prices; keeps (code, inventory key, price, cost) per product"""
+        width = code_width(count)
+        categories = list(CATALOG)
+        for number in range(1, count + 1):
+            category = self.rng.choice(categories)
+            name = f"{self.rng.choice(BRANDS)} {self.rng.choice(CATALOG[category])} {number:0{width}d}"
+            cost = round(max(1.0, math.exp(self.rng.gauss(3.5, 1.1))), 2)
+            price = round(cost * self.rng.uniform(1.15, 1.8), 2)
+            unit = self.rng.choice(UNITS)
+            minimum_limit = self.rng.choice((5, 10, 10, 20, 50))
+            added = self.registration_date()
+            if self.schema == ERP_SCHEMA:
+                code = f"P{number:0{width}d}"
+                self.add_row('''
+                    INSERT INTO products (product_code, product_name, unit_of_measure, purchase_price,
+                                          sale_price, minimum_limit, date_added)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (code, name, unit, cost, price, minimum_limit, added))
+                self.products.append((code, code, price, cost))
+            else:
+                self.add_row('''
+                    INSERT INTO products (product_code, Category, product_name, Quantitee, purchase_price,
+                                          selling_price, minimum_limit, date_added)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (number, category, name, unit, cost, price, minimum_limit, added))
+                self.products.append((str(number), name, price, cost))
+        self.flush(force=True)
+
+    # ===== Sales and Receipts =====
+
+    def day_weights(self):
+        """Get cumulative weights of the days: December peak, busy weekends, steady growth"""
+        weights = []
+        for index, day in enumerate(self.days):
+            season = 1 + 0.25 * math.cos(2 * math.pi * (day.timetuple().tm_yday - 350) / 365.25)
+            growth = 1 + 0.3 * index / len(self.days)
+            weights.append(season * growth * WEEKDAY_WEIGHTS[day.weekday()])
+        return list(accumulate(weights))
+
+    def generate_activity(self, invoices, movements):
+        """Create invoices and the stock receipts that keep them supplied, in date order"""
+        rng = self.rng
+        sales = SalesLedger(self.conn, self.schema)
+        key_column = self.profile['inventory_key']
+        inventory_sql = f'''
+            INSERT INTO inventory ({key_column}, movement, quantity, date, reference)
+            VALUES (?, ?, ?, ?, ?)
+        '''
+        sales_sql = f'''
+            INSERT INTO sales (invoice_number, invoice_date, customer_code, {self.profile['sales_total']},
+                               discount, net_invoice, invoice_status)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        '''
+        details_sql = '''
+            INSERT INTO sales_details (invoice_number, product_code, quantity, price, total, unit_cost)
+            VALUES (?, ?, ?, ?, ?, ?)
+        '''
+
+        # Popularity ranks are shuffled so product 1 is not always the best seller
+        product_order = list(range(len(self.products)))
+        rng.shuffle(product_order)
+        product_weights = zipf_weights(len(self.products), PRODUCT_SKEW)
+        customer_order = list(range(len(self.customer_codes)))
+        rng.shuffle(customer_order)
+        customer_weights = zipf_weights(len(self.customer_codes), CUSTOMER_SKEW)
+        per_day = Counter(rng.choices(range(len(self.days)), cum_weights=self.day_weights(), k=invoices))
+
+        # Receipts fill the movements left after the expected sales lines; each restocks this many units
+        mean_lines = sum(c * w for c, w in zip(LINE_COUNTS, LINE_WEIGHTS)) / sum(LINE_WEIGHTS)
+        mean_quantity = sum(q * w for q, w in zip(QUANTITIES, QUANTITY_WEIGHTS)) / sum(QUANTITY_WEIGHTS)
+        receipts = max(movements - int(invoices * mean_lines), len(self.products) * 2)
+        restock = max(1.0, invoices * mean_lines * mean_quantity / (receipts - len(self.products)))
+
+        balances = [0] * len(self.products)
+        counts = {'invoices': 0, 'receipts': 0, 'movements': 0}
+        # At least the width SalesLedger.next_invoice_number pads to, which carries on from the highest number
+        width = max(5, len(str(invoices)))
+        purchase_width = code_width(receipts)
+
+        def receive(product, when, shortfall=0):
+            code, key, _, cost = self.products[product]
+            quantity = shortfall + max(1, int(restock * rng.uniform(0.7, 1.3)))
+            counts['receipts'] += 1
+            number = f"PUR-{counts['receipts']:0{purchase_width}d}"
+            if self.schema == ERP_SCHEMA:
+                total = round(quantity * cost, 2)
+                self.add_row('''
+                    INSERT INTO purchases (invoice_number, invoice_date, supplier_code, total_invoice,
+                                           discount, net_invoice, invoice_status)
+                    VALUES (?, ?, ?, ?, 0, ?, 'open')
+                ''', (number, when, self.supplier_codes[product % len(self.supplier_codes)], total, total))
+                self.add_row('''
+                    INSERT INTO purchase_details (invoice_number, product_code, quantity, price, total)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (number, code, quantity, cost, total))
+                reference = number
+            else:
+                reference = f"Purchase {number}"
+            self.add_row(inventory_sql, (key, 'in', quantity, when, reference))
+            balances[product] += quantity
+            counts['movements'] += 1
+
+        # Opening stock
+        for product in range(len(self.products)):
+            receive(product, self.timestamp(self.days[0], 0, 1))
+
+        for day_index, day in enumerate(self.days):
+            count = per_day.get(day_index, 0)
+            if not count:
+                continue
+            customers = rng.choices(customer_order, cum_weights=customer_weights, k=count)
+            line_counts = rng.choices(LINE_COUNTS, weights=LINE_WEIGHTS, k=count)
+            for index in range(count):
+                when = self.timestamp(day, index, count)
+                counts['invoices'] += 1
+                invoice_number = f"{INVOICE_PREFIX}{counts['invoices']:0{width}d}"
+                reference = sales.reference(invoice_number)
+                picked = dict.fromkeys(rng.choices(product_order, cum_weights=product_weights,
+                                                   k=line_counts[index]))
+                quantities = rng.choices(QUANTITIES, weights=QUANTITY_WEIGHTS, k=len(picked))
+
+                total = 0.0
+                for product, quantity in zip(picked, quantities):
+                    code, key, price, cost = self.products[product]
+                    if balances[product] < quantity:
+                        # Delivered just in time; sales never run stock negative
+                        receive(product, when, quantity - balances[product])
+                    line_total = round(quantity * price, 2)
+                    total += line_total
+                    # Purchase prices do not drift, so average cost is the catalog cost
+                    self.add_row(details_sql, (invoice_number, code, quantity, price, line_total, cost))
+                    self.add_row(inventory_sql, (key, 'out', quantity, when, reference))
+                    balances[product] -= quantity
+                    counts['movements'] += 1
+
+                total = round(total, 2)
+                discount = round(total * rng.choice((0.05, 0.1)), 2) if rng.random() < DISCOUNT_SHARE else 0.0
+                self.add_row(sales_sql, (invoice_number, when, self.customer_codes[customers[index]], total,
+                                         discount, round(total - discount, 2), SAVED_STATUS[self.schema]))
+            self.flush()
+        self.flush(force=True)
+        return counts
+
+    def generate_expenses(self, count):
+        """Create expenses spread over the period"""
+        sql = '''
+            INSERT INTO expenses (title, amount, expense_date, notes, category)
+            VALUES (?, ?, ?, ?, ?)
+        '''
+        types = self.rng.choices(EXPENSE_TYPES, weights=[share for *_, share in EXPENSE_TYPES], k=count)
+        for category, title, amount, _ in types:
+            day = self.rng.choice(self.days)
+            self.add_row(sql, (title, round(amount * self.rng.uniform(0.6, 1.4), 2), day.isoformat(),
+                               '', category))
+        self.flush(force=True)
+        return count
+
+    # ===== Derived Tables =====
+
+    def build_derived(self):
+        """Create the rollups, balances and valuation the apps maintain"""
+        # Replaying millions of movements through the costing engine is slow; with fixed purchase
+        # prices the average cost valuation follows directly from the balances
+        CostingEngine(self.conn, self.schema).create_tables(backfill=False)
+        ErpServices(self.conn, self.schema).create_tables()
+        key = self.profile['inventory_key']
+        self.conn.execute("DELETE FROM inventory_valuation")
+        self.conn.execute(f'''
+            INSERT INTO inventory_valuation (product_key, quantity, total_cost, unit_cost, cogs_total)
+            SELECT b.product_key, b.balance, ROUND(b.balance * p.purchase_price, 4), p.purchase_price,
+                   ROUND(b.qty_out * p.purchase_price, 4)
+            FROM stock_balances b
+            JOIN products p ON p.{key} = b.product_key
+        ''')
+        self.conn.commit()
+        self.conn.execute("ANALYZE")
+
+    def generate(self, customers, products, invoices, movements, expenses=0, report=print):
+        """Fill an empty database and return the row counts"""
+        if table_exists(self.conn, 'products') and self.conn.execute("SELECT 1 FROM products LIMIT 1").fetchone():
+            raise ValueError("The database already has products; generate into a new file")
+
+        # Bulk loading: nothing is lost that a rerun cannot recreate
+        self.conn.execute("PRAGMA journal_mode = MEMORY")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("PRAGMA cache_size = -200000")
+
+        counts = {}
+        steps = [
+            ('tables', self.create_base_tables),
+            ('customers', lambda: self.generate_customers(customers)),
+            ('suppliers', lambda: self.generate_suppliers(max(5, products // 200))),
+            ('products', lambda: self.generate_products(products)),
+            ('invoices', lambda: counts.update(self.generate_activity(invoices, movements))),
+        ]
+        if self.schema == SIMPLE_SCHEMA:
+            steps.append(('expenses', lambda: counts.update(expenses=self.generate_expenses(expenses))))
+        steps.append(('derived tables', self.build_derived))
+
+        for name, step in steps:
+            start = time.perf_counter()
+            step()
+            report(f"{name:<16}{time.perf_counter() - start:>8.1f} s")
+
+        self.conn.execute("PRAGMA journal_mode = DELETE")
+        self.conn.execute("PRAGMA synchronous = FULL")
+        counts.update(customers=len(self.customer_codes), suppliers=len(self.supplier_codes),
+                      products=len(self.products))
+        return counts
+
+
+def main():
+    """Generate a synthetic database from the command line"""
+    parser = argparse.ArgumentParser(description="Fill a new database with seeded synthetic data")
+    parser.add_argument('database', help="New SQLite database file")
+    parser.add_argument('--schema', choices=(SIMPLE_SCHEMA, ERP_SCHEMA), default=SIMPLE_SCHEMA,
+                        help="Application schema (simple: erp_simple_english.py, erp: ERPSystem.py)")
+    parser.add_argument('--scale', choices=SCALES, default='small', help="Preset volumes")
+    for volume in VOLUMES:
+        parser.add_argument(f"--{volume}", type=int, help=f"Number of {volume} (overrides --scale)")
+    parser.add_argument('--days', type=int, default=730, help="Days of history")
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help="Last day (default: today)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    volumes = dict(SCALES[args.scale])
+    volumes.update({volume: getattr(args, volume) for volume in VOLUMES if getattr(args, volume) is not None})
+
+    conn = sqlite3.connect(args.database)
+    try:
+        start = time.perf_counter()
+        generator = DataGenerator(conn, args.schema, args.seed, args.days, args.end)
+        counts = generator.generate(**volumes)
+        print(", ".join(f"{count} {name}" for name, count in counts.items()))
+        print(f"Generated {args.database} in {time.perf_counter() - start:.1f} s")
+    except ValueError as e:
+        raise SystemExit(str(e))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import argparse
+import bisect
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from erp_logging import swallowed
+from query_stats import BUCKETS_MS
+
+
+DEFAULT_FLUSH_SECONDS = 15
+METRIC_PREFIX = 'erp_span'
+
+log = logging.getLogger('erp.metrics')
+
+
+def escape_label(value):
+    """Escape a Prometheus label value"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_bound(ms):
+    """Get a bucket bound in seconds as Prometheus writes it"""
+    return f"{ms / 1000:g}"
+
+
+class SpanStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, elapsed, failed):
+        self.count += 1
+        self.errors += failed
+        self.total += elapsed
+        self.histogram[bisect.bisect_left(BUCKETS_MS, elapsed * 1000)] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'sum_seconds': round(self.total, 6),
+            'histogram': list(self.histogram),
+        }
+
+
+class Tracer:
+    def __init__(self, metrics_path=None, flush_seconds=DEFAULT_FLUSH_SECONDS):
+        self.metrics_path = metrics_path
+        self.flush_seconds = flush_seconds
+        self.spans = {}
+        # Extra counters as {metric name: (help text, source)}, source() gives {labels: value}
+        self.counters = {}
+        self.written_counters = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.changes = 0
+        self.flushed_changes = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @contextmanager
+    def span(self, name):
+        """Time a block, named under the span it runs in, e.g. 'sale/database'"""
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        path = f"{stack[-1]}/{name}" if stack else name
+        stack.append(path)
+        failed = False
+        start = time.perf_counter()
+        try:
+            yield path
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                stats = self.spans.get(path)
+                if stats is None:
+                    stats = self.spans[path] = SpanStats()
+                stats.add(elapsed, failed)
+                self.changes += 1
+
+    def snapshot(self):
+        """Get totals per span path"""
+        with self.lock:
+            return {path: stats.to_dict() for path, stats in sorted(self.spans.items())}
+
+    def add_counters(self, name, help_text, source):
+        """Export counters kept elsewhere, source() returns {((label, value), ...): count}"""
+        self.counters[name] = (help_text, source)
+
+    def counter_values(self):
+        return {name: (help_text, source()) for name, (help_text, source) in self.counters.items()}
+
+    # ===== Export =====
+
+    def start(self):
+        """Write the metrics file every flush_seconds on a background thread"""
+        if self.metrics_path and self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='erp-metrics', daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopping.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except OSError:
+                swallowed(log, "Could not write metrics to %s", self.metrics_path)
+
+    def close(self):
+        """Stop the writer thread and write the final totals"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.metrics_path:
+            self.flush()
+
+    def flush(self):
+        """Write the metrics file if anything was traced since the last write"""
+        with self.lock:
+            changes = self.changes
+        counters = self.counter_values()
+        if changes == self.flushed_changes and counters == self.written_counters:
+            return False
+        spans = self.snapshot()
+        if self.metrics_path.endswith('.jsonl'):
+            record = {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                      'buckets_ms': list(BUCKETS_MS), 'spans': spans,
+                      'counters': {name: [dict(labels, value=value) for labels, value in sorted(values.items())]
+                                   for name, (_, values) in counters.items()}}
+            with open(self.metrics_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+        else:
+            # The textfile collector may read at any time, so swap in a complete file
+            temp_path = self.metrics_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(prometheus_text(spans, counters))
+            os.replace(temp_path, self.metrics_path)
+        self.flushed_changes = changes
+        self.written_counters = counters
+        return True
+
+
+def prometheus_text(spans, counters=None):
+    """Format span totals and counters in the Prometheus text exposition format"""
+    lines = [f"# HELP {METRIC_PREFIX}_duration_seconds Time spent in ERP actions and their steps",
+             f"# TYPE {METRIC_PREFIX}_duration_seconds histogram"]
+    for path, stats in spans.items():
+        label = f'span="{escape_label(path)}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS_MS, stats['histogram']):
+            cumulative += count
+            lines.append(f'{METRIC_PREFIX}_duration_seconds_bucket{{{label},le="{format_bound(bound)}"}} {cumulative}')
+        lines.append(f'{METRIC_PREFIX}_duration_seconds_bucket{{{label},le="+Inf"}} {stats["count"]}')
+        lines.append(f'{METRIC_PREFIX}_duration_seconds_sum{{{label}}} {stats["sum_seconds"]}')
+        lines.append(f'{METRIC_PREFIX}_duration_seconds_count{{{label}}} {stats["count"]}')
+    lines.append(f"# HELP {METRIC_PREFIX}_errors_total ERP actions and steps that raised an error")
+    lines.append(f"# TYPE {METRIC_PREFIX}_errors_total counter")
+    for path, stats in spans.items():
+        lines.append(f'{METRIC_PREFIX}_errors_total{{span="{escape_label(path)}"}} {stats["errors"]}')
+    for name, (help_text, values) in (counters or {}).items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in sorted(values.items()):
+            label_text = ','.join(f'{key}="{escape_label(str(label))}"' for key, label in labels)
+            lines.append(f'{name}{{{label_text}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def print_spans(spans, out=None):
+    """Print span totals with mean and approximate p95 times"""
+    out = out or sys.stdout
+    print(f"{'count':>8}{'errors':>8}{'total s':>10}{'mean ms':>10}{'p95 ms':>9}  span", file=out)
+    for path, stats in spans.items():
+        count = stats['count']
+        rank, seen, p95 = count * 0.95, 0, float('inf')
+        for bound, bucket in zip(BUCKETS_MS, stats['histogram']):
+            seen += bucket
+            if seen >= rank:
+                p95 = bound
+                break
+        mean = stats['sum_seconds'] / count * 1000 if count else 0.0
+        print(f"{count:>8}{stats['errors']:>8}{stats['sum_seconds']:>10.3f}{mean:>10.2f}{p95:>9}  {path}", file=out)
+
+
+def main():
+    """Summarize the latest totals from a JSON lines metrics file"""
+    parser = argparse.ArgumentParser(description="Summarize span timings written by the desktop app")
+    parser.add_argument('metrics', help="JSON lines metrics file")
+    args = parser.parse_args()
+    last = None
+    with open(args.metrics, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                last = line
+    if last is None:
+        raise SystemExit("No metrics recorded yet")
+    record = json.loads(last)
+    print(f"Totals at {record['time']}")
+    print_spans(record['spans'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import argparse
+import os
+import queue
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+from data_io import backup_database
+from erp import open_database
+from sales import SalesLedger
+
+
+# Seconds the writer waits for more units after the first one of a batch
+DEFAULT_WINDOW = 0.005
+DEFAULT_MAX_BATCH = 200
+
+BENCH_MODES = ('direct', 'serial', 'group')
+
+
+class WriteCoordinator:
+    def __init__(self, open_connection, window=DEFAULT_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+        self.open_connection = open_connection
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.queue = queue.SimpleQueue()
+        self.conn = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.startup_error = None
+        self.batches = 0
+        self.units = 0
+
+    def start(self):
+        """Open the writer connection on its own thread and start taking writes"""
+        self.thread = threading.Thread(target=self.run, name='erp-writer', daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.startup_error is not None:
+            raise self.startup_error
+        return self
+
+    def submit(self, func, *args):
+        """Queue a write unit func(cursor, *args) and return a Future for its result"""
+        # Units run inside the writer's transaction and must not commit themselves
+        future = Future()
+        self.queue.put((func, args, future))
+        return future
+
+    def call(self, func, *args):
+        """Run a write unit and wait until it is committed"""
+        return self.submit(func, *args).result()
+
+    def pending(self):
+        """Get the number of queued write units"""
+        return self.queue.qsize()
+
+    def close(self):
+        """Commit the queued writes and stop the writer"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    # ===== Writer Thread =====
+
+    def run(self):
+        try:
+            self.conn = self.open_connection()
+        except Exception as e:
+            self.startup_error = e
+            self.ready.set()
+            return
+        self.ready.set()
+
+        try:
+            while True:
+                batch = self.collect()
+                if batch is None:
+                    break
+                self.commit_batch(batch)
+        finally:
+            self.conn.close()
+
+    def collect(self):
+        """Wait for a write, then gather more until the window closes or the batch is full"""
+        unit = self.queue.get()
+        if unit is None:
+            return None
+        batch = [unit]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                unit = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if unit is None:
+                # Stop after this batch
+                self.queue.put(None)
+                break
+            batch.append(unit)
+        return batch
+
+    def commit_batch(self, batch):
+        """Run write units in one transaction, each in its own savepoint"""
+        cursor = self.conn.cursor()
+        done = []
+        try:
+            # Take the write lock up front so other processes wait on the busy timeout
+            cursor.execute("BEGIN IMMEDIATE")
+            for func, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cursor.execute("SAVEPOINT write_unit")
+                try:
+                    result = func(cursor, *args)
+                except Exception as e:
+                    # Only the failed unit is undone, the rest of the batch still commits
+                    cursor.execute("ROLLBACK TO write_unit")
+                    cursor.execute("RELEASE write_unit")
+                    future.set_exception(e)
+                else:
+                    cursor.execute("RELEASE write_unit")
+                    done.append((future, result))
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            for future, _ in done:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            cursor.close()
+
+        self.batches += 1
+        self.units += len(done)
+        # Callers only see results once they are durable
+        for future, result in done:
+            future.set_result(result)
+
+
+# ===== Benchmark =====
+
+def load_codes(path):
+    """Get customer and product codes to build benchmark invoices from"""
+    conn = sqlite3.connect(path)
+    try:
+        customers = [row[0] for row in conn.execute("SELECT customer_code FROM customers LIMIT 1000")]
+        products = [str(row[0]) for row in conn.execute("SELECT product_code FROM products LIMIT 1000")]
+    finally:
+        conn.close()
+    if not customers or not products:
+        raise SystemExit("The database needs customers and products to benchmark invoices")
+    return customers, products
+
+
+def bench_invoices(seed, count, customers, products):
+    """Build a thread's invoices as (invoice_number, customer_code, lines)"""
+    rng = random.Random(seed)
+    return [(f"BENCH-{seed}-{number:06d}", rng.choice(customers),
+             [(code, rng.randint(1, 3), 1.0) for code in rng.sample(products, min(3, len(products)))])
+            for number in range(count)]
+
+
+def save_unit(sales):
+    """Get a write unit saving one benchmark invoice"""
+    def unit(cursor, invoice_number, customer_code, lines):
+        invoice, _ = sales.save_invoice(cursor, invoice_number, customer_code, lines)
+        return invoice
+    return unit
+
+
+def run_bench(path, mode, threads, writes, window, customers, products):
+    """Save invoices from concurrent threads and return (seconds, saved, errors, batches)"""
+    workloads = [bench_invoices(seed, writes, customers, products) for seed in range(threads)]
+    results = {'saved': 0, 'errors': 0}
+    lock = threading.Lock()
+    coordinator = None
+    if mode != 'direct':
+        state = {}
+
+        def open_writer():
+            conn = sqlite3.connect(path)
+            # Stock-outs would measure the sample data, not the write path
+            state['unit'] = save_unit(SalesLedger(conn, allow_oversell=True))
+            return conn
+
+        coordinator = WriteCoordinator(open_writer, window if mode == 'group' else 0,
+                                       DEFAULT_MAX_BATCH if mode == 'group' else 1).start()
+
+    def worker(invoices):
+        saved = errors = 0
+        if coordinator is not None:
+            for invoice in invoices:
+                try:
+                    coordinator.call(state['unit'], *invoice)
+                    saved += 1
+                except (ValueError, sqlite3.Error):
+                    errors += 1
+        else:
+            # Each thread commits on its own connection, as separate processes would
+            conn = sqlite3.connect(path)
+            unit = save_unit(SalesLedger(conn, allow_oversell=True))
+            for invoice in invoices:
+                cursor = conn.cursor()
+                try:
+                    unit(cursor, *invoice)
+                    conn.commit()
+                    saved += 1
+                except (ValueError, sqlite3.Error):
+                    # An open transaction would keep the write lock from the other threads
+                    conn.rollback()
+                    errors += 1
+                finally:
+                    cursor.close()
+            conn.close()
+        with lock:
+            results['saved'] += saved
+            results['errors'] += errors
+
+    workers = [threading.Thread(target=worker, args=(invoices,)) for invoices in workloads]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if coordinator is not None:
+        coordinator.close()
+    elapsed = time.perf_counter() - start
+    return elapsed, results['saved'], results['errors'], coordinator.batches if coordinator else results['saved']
+
+
+def main():
+    """Compare independent commits with serialized and group commits"""
+    parser = argparse.ArgumentParser(description="Benchmark concurrent invoice writes on a copy of a database")
+    parser.add_argument('database', help="SQLite database file with customers and products")
+    parser.add_argument('--threads', type=int, default=8, help="Concurrent writers")
+    parser.add_argument('--writes', type=int, default=200, help="Invoices per writer")
+    parser.add_argument('--window', type=float, default=DEFAULT_WINDOW * 1000, help="Group commit window in ms")
+    parser.add_argument('--mode', action='append', choices=BENCH_MODES, help="Mode to run, repeatable (default: all)")
+    args = parser.parse_args()
+
+    customers, products = load_codes(args.database)
+    print(f"{args.threads} threads x {args.writes} invoices")
+    print(f"{'mode':<10}{'saved':>8}{'errors':>8}{'commits':>9}{'seconds':>9}{'per sec':>10}")
+    for mode in args.mode or BENCH_MODES:
+        # Every mode starts from the same copy of the database
+        handle, path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(os.path.abspath(args.database)))
+        os.close(handle)
+        source = sqlite3.connect(args.database)
+        try:
+            backup_database(source, path)
+        finally:
+            source.close()
+        try:
+            # Create the derived tables before the writers start
+            open_database(path).conn.close()
+            elapsed, saved, errors, commits = run_bench(path, mode, args.threads, args.writes,
+                                                        args.window / 1000, customers, products)
+        finally:
+            os.remove(path)
+        print(f"{mode:<10}{saved:>8}{errors:>8}{commits:>9}{elapsed:>9.2f}{saved / elapsed:>10.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()